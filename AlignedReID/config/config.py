@@ -29,7 +29,7 @@ class Config(object):
     parser.add_argument('--train_dataset', type=str, default='market1501',
                     choices=['market1501', 'cuhk03', 'duke', 'msmt17', 'combine'])
     parser.add_argument('--test_dataset', type=str, default='')
-    parser.add_argument('--train_dataset_partitions', type=str, default='/data/DataSet/market1501/partitions.pkl')
+    parser.add_argument('--train_dataset_partitions', type=str, default='/data/DataSet/market1501/partitions.npz')
     parser.add_argument('--test_dataset_partitions', type=str, default='')
     parser.add_argument('--trainset_part', type=str, default='trainval',
                         choices=['trainval', 'train'])
@@ -37,6 +37,12 @@ class Config(object):
     # Only for training set.
     parser.add_argument('--ids_per_batch', type=int, default=32)
     parser.add_argument('--ims_per_id', type=int, default=4)
+    parser.add_argument('--id_weight', type=str, default='uniform',
+                        choices=['uniform', 'count', 'sqrt'])
+    parser.add_argument('--cam_balanced', type=str2bool, default=False)
+    parser.add_argument('--hard_id_mining', type=str2bool, default=False)
+    parser.add_argument('--hard_ratio', type=float, default=0.5)
+    parser.add_argument('--centroid_momentum', type=float, default=0.5)
 
     parser.add_argument('--log_to_file', type=str2bool, default=False)
     parser.add_argument('--normalize_feature', type=str2bool, default=False)
@@ -68,6 +74,29 @@ class Config(object):
     parser.add_argument('--staircase_decay_multiply_factor',
                         type=float, default=0.1)
     parser.add_argument('--total_epochs', type=int, default=300)
+    parser.add_argument('--mixed_precision', type=str2bool, default=False)
+    parser.add_argument('--micro_batch_size', type=int, default=0)
+    parser.add_argument('--ckpt_keep', type=int, default=0)
+    parser.add_argument('--profile_every', type=int, default=0)
+    parser.add_argument('--profile_trace_dir', type=str, default='')
+    parser.add_argument('--profile_trace_start', type=int, default=10)
+    parser.add_argument('--profile_trace_steps', type=int, default=5)
+    parser.add_argument('--quant_calib_images', type=int, default=512)
+    parser.add_argument('--quant_backend', type=str, default='fbgemm',
+                        choices=['fbgemm', 'x86', 'qnnpack'])
+    parser.add_argument('--quant_max_map_drop', type=float, default=0.01)
+    parser.add_argument('--quant_file', type=str, default='')
+    parser.add_argument('--gallery_codec', type=str, default='none',
+                        choices=['none', 'float16', 'int8', 'pq'])
+    parser.add_argument('--pq_subspaces', type=int, default=64)
+    parser.add_argument('--num_threads', type=int, default=0)
+    parser.add_argument('--interop_threads', type=int, default=0)
+    parser.add_argument('--channels_last', type=str2bool, default=False)
+    parser.add_argument('--pin_workers', type=str2bool, default=False)
+    parser.add_argument('--tune_runtime', type=str2bool, default=False)
+    parser.add_argument('--tune_threads', type=str, default='')
+    parser.add_argument('--distributed', type=str2bool, default=False)
+    parser.add_argument('--dist_timeout', type=int, default=60)
 
     args = parser.parse_known_args()[0]
 
@@ -111,6 +140,16 @@ class Config(object):
     
     self.ids_per_batch = args.ids_per_batch
     self.ims_per_id = args.ims_per_id
+    # How ids are drawn for a batch: 'uniform' visits every id once per epoch,
+    # 'count'/'sqrt' draw ids with probability ~ (sqrt of) their image number.
+    self.id_weight = args.id_weight
+    # Spread the images of an id in a batch over its cameras.
+    self.cam_balanced = args.cam_balanced
+    # Fill hard_ratio of the batches with ids whose running global feature
+    # centroids are close; camera balanced regardless of cam_balanced.
+    self.hard_id_mining = args.hard_id_mining
+    self.hard_ratio = args.hard_ratio
+    self.centroid_momentum = args.centroid_momentum
 
     self.test_batch_size = 32
     self.val_at_epoch = 20
@@ -174,10 +213,29 @@ class Config(object):
     self.staircase_decay_multiply_factor = args.staircase_decay_multiply_factor
     # Number of epochs to train
     self.total_epochs = args.total_epochs
+    # Run forward and backward under autocast: bfloat16 on cpu, float16 with
+    # loss scaling on gpu. Distances and losses stay in float32.
+    self.mixed_precision = args.mixed_precision
+    # Split every P x K batch into chunks of this many images that fit the
+    # device (GradCache), hard examples are still mined over the whole batch.
+    # 0 disables it.
+    self.micro_batch_size = args.micro_batch_size
 
     # How often (in batches) to log. If only need to log the average
     # information for each epoch, set this to a large value, e.g. 1e10.
     self.log_steps = 1e10
+    # Scalars for tensorboard are buffered and written every this many
+    # seconds by a background thread.
+    self.log_flush_secs = 30
+    # Print the time split of training steps (data wait, h2d copy, forward,
+    # loss, backward, optimizer) every this many steps, 0 disables it.
+    # The device is synchronized between phases while profiling.
+    self.profile_every = args.profile_every
+    # Write a torch.profiler trace of profile_trace_steps steps, starting at
+    # step profile_trace_start, to this directory. '' disables it.
+    self.profile_trace_dir = args.profile_trace_dir
+    self.profile_trace_start = args.profile_trace_start
+    self.profile_trace_steps = args.profile_trace_steps
 
     self.resume = args.resume
 
@@ -188,6 +246,46 @@ class Config(object):
     self.single_gallery_shot = False
     self.first_match_break = True
 
+    # Post-training int8 quantization (script/quantize.py): number of random
+    # test images the activation ranges are calibrated on, the quantized
+    # kernel backend (fbgemm/x86 for x86 servers, qnnpack for arm boxes),
+    # the largest mAP drop from the float model that is accepted, and the
+    # path of the quantized TorchScript model, '' to not save it.
+    self.quant_calib_images = args.quant_calib_images
+    self.quant_backend = args.quant_backend
+    self.quant_max_map_drop = args.quant_max_map_drop
+    self.quant_file = args.quant_file
+    # Store the test gallery features compressed (reid_common/codec.py):
+    # 'float16', 'int8' with a scale per vector, or 'pq' product
+    # quantization with pq_subspaces bytes per vector. 'none' keeps float32.
+    self.gallery_codec = args.gallery_codec
+    self.pq_subspaces = args.pq_subspaces
+
+    ###########
+    # Runtime #
+    ###########
+    # Intra-op and inter-op threads of torch, 0 keeps the default.
+    self.num_threads = args.num_threads
+    self.interop_threads = args.interop_threads
+    # Run the model and its inputs in channels_last (NHWC) memory format.
+    self.channels_last = args.channels_last
+    # Pin the process to its first num_threads cores and every data loader
+    # worker to one of the other cores.
+    self.pin_workers = args.pin_workers
+    # Only measure the images/sec of the model for every thread count in
+    # tune_threads (comma separated, '' for powers of 2 up to the cores),
+    # with and without channels_last, then exit.
+    self.tune_runtime = args.tune_runtime
+    self.tune_threads = [int(n) for n in args.tune_threads.split(',') if n != '']
+    # Train with one process per rank under torchrun, wrapped in
+    # DistributedDataParallel on cpu, over gloo. ids_per_batch is the
+    # number of identities of every rank, the features of all ranks are
+    # gathered so the losses mine the global batch. Only rank 0 saves the
+    # checkpoints, logs to file and validates, the other ranks wait for it
+    # up to dist_timeout minutes.
+    self.distributed = args.distributed
+    self.dist_timeout = args.dist_timeout
+
 
     #######
     # Log #
@@ -242,4 +340,6 @@ class Config(object):
 
     # Saving model weights and optimizer states, for resuming.
     self.ckpt_file = osp.join(self.exp_dir, 'ckpt.pth')
+    # Number of per epoch checkpoints kept besides ckpt_file, 0 keeps none.
+    self.ckpt_keep = args.ckpt_keep
     self.model_weight_file = args.model_weight_file
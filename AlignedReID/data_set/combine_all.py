@@ -12,14 +12,14 @@ ospap = osp.abspath
 
 import numpy as np
 from collections import defaultdict
-import shutil
 
 import sys
 sys.path.append('../')
 
 from reid_utils.common_utils import may_make_dir
-from reid_utils.common_utils import save_pickle
-from reid_utils.common_utils import load_pickle
+from reid_utils.partition_utils import load_partitions
+from reid_utils.partition_utils import save_partitions
+from reid_utils.prepare_utils import copy_files
 
 from reid_utils.dataset_utils import new_im_name_tmpl
 from reid_utils.dataset_utils import parse_full_path_new_im_name
@@ -35,8 +35,11 @@ def move_ims(
         new_im_dir,
         parse_im_name,
         new_im_name_tmpl,
-        new_start_id):
-    """Rename and move images to new directory."""
+        new_start_id,
+        num_workers=None,
+        manifest_file=None):
+    """Rename and move images to new directory (hard linked when possible,
+    images recorded in `manifest_file` by an earlier run are skipped)."""
     ids = [parse_im_name(osp.basename(p), 'id') for p in ori_im_paths]
     cams = [parse_im_name(osp.basename(p), 'cam') for p in ori_im_paths]
 
@@ -51,8 +54,8 @@ def move_ims(
         new_id = id_mapping[id]
         cnt[(new_id, cam)] += 1
         new_im_name = new_im_name_tmpl.format(new_id, cam, cnt[(new_id, cam)] - 1)
-        shutil.copy(im_path, ospj(new_im_dir, new_im_name))
         new_im_names.append(ospj(new_im_dir, new_im_name))
+    copy_files(ori_im_paths, new_im_names, num_workers, manifest_file)
     return new_im_names, id_mapping
 
 
@@ -71,18 +74,23 @@ def combine_trainval_sets(
         im_dirs,
         partition_files,
         data_sets,
-        save_dir):
+        save_dir,
+        num_workers=None):
     new_im_dir = ospj(save_dir, 'trainval_images')
+    # new names only depend on the sorted inputs, so a rerun resumes the copies
+    manifest_file = ospj(save_dir, 'trainval_images.copied')
     may_make_dir(new_im_dir)
     new_im_names = []
     new_start_id = 0
     for im_dir, partition_file, data_set in zip(im_dirs, partition_files, data_sets):
         parse_im_name = get_parse_im_funtion(data_set)
-        partitions = load_pickle(partition_file)
-        im_paths = [ospj(im_dir, n) for n in partitions['trainval_im_names']]
+        partitions = load_partitions(
+            partition_file, lambda n, t: parse_im_name(osp.basename(n), t))
+        im_paths = [ospj(im_dir, n) for n in partitions.im_names('trainval')]
         im_paths.sort()
         new_im_names_, id_mapping = move_ims(
-            im_paths, new_im_dir, parse_im_name, new_im_name_tmpl, new_start_id)
+            im_paths, new_im_dir, parse_im_name, new_im_name_tmpl, new_start_id,
+            num_workers, manifest_file)
         new_start_id += len(id_mapping)
         new_im_names += new_im_names_
 
@@ -109,8 +117,8 @@ def combine_trainval_sets(
                     'val_im_names': val_im_names,
                     'val_marks': val_marks,
                     }
-    partition_file = ospj(save_dir, 'partitions.pkl')
-    save_pickle(partitions, partition_file)
+    partition_file = ospj(save_dir, 'partitions.npz')
+    save_partitions(partitions, partition_file, parse_full_path_new_im_name)
     print('Partition file saved to {}'.format(partition_file))
 
 
@@ -129,7 +137,7 @@ if __name__ == '__main__':
     parser.add_argument(
         '--market1501_partition_file',
         type=str,
-        default=ospeu('/data/DataSet/market1501/partitions.pkl')
+        default=ospeu('/data/DataSet/market1501/partitions.npz')
     )
 
     cuhk03_im_type = ['detected', 'labeled'][0]
@@ -143,7 +151,7 @@ if __name__ == '__main__':
         '--cuhk03_partition_file',
         type=str,
         # Remember to select the detected or labeled set.
-        default=ospeu('/data/DataSet/cuhk03/{}/partitions.pkl'.format(cuhk03_im_type))
+        default=ospeu('/data/DataSet/cuhk03/{}/partitions.npz'.format(cuhk03_im_type))
     )
 
     parser.add_argument(
@@ -153,7 +161,7 @@ if __name__ == '__main__':
     parser.add_argument(
         '--duke_partition_file',
         type=str,
-        default=ospeu('/data/DataSet/duke/partitions.pkl')
+        default=ospeu('/data/DataSet/duke/partitions.npz')
     )
 
     parser.add_argument(
@@ -163,7 +171,7 @@ if __name__ == '__main__':
     parser.add_argument(
         '--msmt17_partition_file',
         type=str,
-        default=ospeu('/data/DataSet/msmt17/partitions.pkl')
+        default=ospeu('/data/DataSet/msmt17/partitions.npz')
     )
 
     parser.add_argument(
@@ -172,6 +180,13 @@ if __name__ == '__main__':
         default=ospeu('/data/DataSet/combine')
     )
 
+    parser.add_argument(
+        '--num_workers',
+        type=int,
+        default=None,
+        help='copy threads, the cpu count by default'
+    )
+
     args = parser.parse_args()
 
     im_dirs = [
@@ -193,4 +208,4 @@ if __name__ == '__main__':
         save_dir = save_dir + '_' + data_set
     may_make_dir(save_dir)
 
-    combine_trainval_sets(im_dirs, partition_files, data_sets, save_dir)
+    combine_trainval_sets(im_dirs, partition_files, data_sets, save_dir, args.num_workers)
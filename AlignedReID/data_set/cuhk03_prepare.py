@@ -4,12 +4,11 @@
 #===================================
 
 from __future__ import print_function
-from zipfile import ZipFile
 import os.path as osp
 import sys
 import h5py
 from scipy.misc import imsave
-from itertools import chain
+from multiprocessing import Pool
 import numpy as np
 
 import sys
@@ -17,72 +16,103 @@ sys.path.append('../')
 
 from reid_utils.common_utils import may_make_dir
 from reid_utils.common_utils import load_pickle
-from reid_utils.common_utils import save_pickle
+from reid_utils.partition_utils import save_partitions
+from reid_utils.prepare_utils import PrepareManifest
+from reid_utils.prepare_utils import default_num_workers
+from reid_utils.prepare_utils import extract_archive
 
 from reid_utils.dataset_utils import get_im_names
 from reid_utils.dataset_utils import partition_train_val_set
 from reid_utils.dataset_utils import new_im_name_tmpl
 from reid_utils.dataset_utils import parse_original_new_im_name
+from reid_utils.dataset_utils import parse_full_path_new_im_name
 
 
-def save_images(mat_file, save_dir, new_im_name_tmpl):
-    def deref(mat, ref):
-        return mat[ref][:].T
+# h5py file of the current worker process, see _open_mat
+_mat = None
 
-    def dump(mat, refs, pid, cam, im_dir):
-        """Save the images of a person under one camera."""
-        for i, ref in enumerate(refs):
-            im = deref(mat, ref)
-            if im.size == 0 or im.ndim < 2: 
-                break
-            fname = new_im_name_tmpl.format(pid, cam, i)
-            imsave(osp.join(im_dir, fname), im)
 
-    mat = h5py.File(mat_file, 'r')
+def _open_mat(mat_file):
+    """Pool initializer: h5py handles can not be shared, every process opens its own."""
+    global _mat
+    _mat = h5py.File(mat_file, 'r')
+
+
+def _deref(mat, ref):
+    return mat[ref][:].T
+
+
+def _dump(mat, refs, pid, cam, im_dir, new_im_name_tmpl):
+    """Save the images of a person under one camera."""
+    for i, ref in enumerate(refs):
+        im = _deref(mat, ref)
+        if im.size == 0 or im.ndim < 2:
+            break
+        fname = new_im_name_tmpl.format(pid, cam, i)
+        imsave(osp.join(im_dir, fname), im)
+
+
+def _save_person(args):
+    """Worker of save_images: decode and save all images of one person."""
+    pair, i, pid, labeled_im_dir, detected_im_dir, new_im_name_tmpl = args
+    labeled = _deref(_mat, _mat['labeled'][0][pair])
+    detected = _deref(_mat, _mat['detected'][0][pair])
+    # We don't care about whether different persons are under same cameras,
+    # we only care about the same person being under different cameras or not.
+    _dump(_mat, labeled[i, :5], pid, 0, labeled_im_dir, new_im_name_tmpl)
+    _dump(_mat, labeled[i, 5:], pid, 1, labeled_im_dir, new_im_name_tmpl)
+    _dump(_mat, detected[i, :5], pid, 0, detected_im_dir, new_im_name_tmpl)
+    _dump(_mat, detected[i, 5:], pid, 1, detected_im_dir, new_im_name_tmpl)
+    return pid
+
+
+def save_images(mat_file, save_dir, new_im_name_tmpl, num_workers=None):
+    """
+    Decode the images of every person with a process pool. Persons saved by
+    an interrupted run (listed in `images.saved`) are skipped.
+    """
     labeled_im_dir = osp.join(save_dir, 'labeled/images')
     detected_im_dir = osp.join(save_dir, 'detected/images')
-    #all_im_dir = osp.join(save_dir, 'all/images')
 
     may_make_dir(labeled_im_dir)
     may_make_dir(detected_im_dir)
-    #may_make_dir(all_im_dir)
-
-    # loop through camera pairs
-    pid = 0
-    for labeled, detected in zip(mat['labeled'][0], mat['detected'][0]):
-        labeled, detected = deref(mat, labeled), deref(mat, detected)
-        assert labeled.shape == detected.shape
-        # loop through ids in a camera pair
-        for i in range(labeled.shape[0]):
-            # We don't care about whether different persons are under same cameras,
-            # we only care about the same person being under different cameras or not.
-            dump(mat, labeled[i, :5], pid, 0, labeled_im_dir)
-            dump(mat, labeled[i, 5:], pid, 1, labeled_im_dir)
-            dump(mat, detected[i, :5], pid, 0, detected_im_dir)
-            dump(mat, detected[i, 5:], pid, 1, detected_im_dir)
-            #dump(mat, chain(detected[i, :5], labeled[i, :5]), pid, 0, all_im_dir)
-            #dump(mat, chain(detected[i, 5:], labeled[i, 5:]), pid, 1, all_im_dir)
-            pid += 1
-        if pid % 100 == 0:
-            sys.stdout.write('\033[F\033[K')
-            print('Saving images {}/{}'.format(pid, 1467))
+
+    # loop through camera pairs to number the persons, pids follow the mat order
+    jobs = []
+    with h5py.File(mat_file, 'r') as mat:
+        for pair, labeled in enumerate(mat['labeled'][0]):
+            for i in range(_deref(mat, labeled).shape[0]):
+                jobs.append((pair, i, len(jobs), labeled_im_dir, detected_im_dir,
+                             new_im_name_tmpl))
+    num_persons = len(jobs)
+
+    with PrepareManifest(osp.join(save_dir, 'images.saved')) as manifest:
+        jobs = [job for job in jobs if str(job[2]) not in manifest]
+        pool = Pool(default_num_workers(num_workers), _open_mat, (mat_file,))
+        try:
+            for n, pid in enumerate(pool.imap_unordered(_save_person, jobs, chunksize=8)):
+                manifest.add([str(pid)])
+                if (n + 1) % 100 == 0:
+                    sys.stdout.write('\033[F\033[K')
+                    print('Saving images {}/{}'.format(len(manifest), num_persons))
+        finally:
+            pool.close()
+            pool.join()
     return labeled_im_dir, detected_im_dir
 
 
-def transform(zip_file, train_test_partition_file, save_dir=None):
+def transform(zip_file, train_test_partition_file, save_dir=None, num_workers=None):
     """Save images and partition the train/val/test set.
     """
     print("Extracting zip file")
     root = osp.dirname(osp.abspath(zip_file))
     if save_dir is None:
         save_dir = root
-    may_make_dir(save_dir)
-    with ZipFile(zip_file) as z:
-        z.extractall(path=save_dir)
+    extract_archive(zip_file, save_dir, num_workers)
     print("Extracting zip file done")
     mat_file = osp.join(save_dir, osp.basename(zip_file)[:-4], 'cuhk-03.mat')
 
-    labeled_im_dir, detected_im_dir = save_images(mat_file, save_dir, new_im_name_tmpl)
+    labeled_im_dir, detected_im_dir = save_images(mat_file, save_dir, new_im_name_tmpl, num_workers)
     
     if osp.exists(train_test_partition_file):
         train_test_partition = load_pickle(train_test_partition_file)
@@ -136,8 +166,8 @@ def transform(zip_file, train_test_partition_file, save_dir=None):
                     'val_marks': val_marks,
                     'test_im_names': test_im_names,
                     'test_marks': test_marks}
-        partition_file = osp.join(save_dir, im_type, 'partitions.pkl')
-        save_pickle(partitions, partition_file)
+        partition_file = osp.join(save_dir, im_type, 'partitions.npz')
+        save_partitions(partitions, partition_file, parse_full_path_new_im_name)
         print('Partition file for "{}" saved to {}'.format(im_type, partition_file))
 
 
@@ -156,10 +186,15 @@ if __name__ == '__main__':
         '--train_test_partition_file',
         type=str,
         default='/data/DataSet/cuhk03/re_ranking_train_test_split.pkl')
+    parser.add_argument(
+        '--num_workers',
+        type=int,
+        default=None,
+        help='extraction and image saving processes, the cpu count by default')
 
     args = parser.parse_args()
     zip_file = osp.abspath(osp.expanduser(args.zip_file))
     train_test_partition_file = osp.abspath(osp.expanduser(
         args.train_test_partition_file))
     save_dir = osp.abspath(osp.expanduser(args.save_dir))
-    transform(zip_file, train_test_partition_file, save_dir)
\ No newline at end of file
+    transform(zip_file, train_test_partition_file, save_dir, args.num_workers)
\ No newline at end of file
@@ -9,12 +9,11 @@ from __future__ import print_function
 import sys
 sys.path.append('../')
 
-from zipfile import ZipFile
 import os.path as osp
 import numpy as np
 
-from reid_utils.common_utils import may_make_dir
-from reid_utils.common_utils import save_pickle
+from reid_utils.partition_utils import save_partitions
+from reid_utils.prepare_utils import extract_archive
 
 
 from reid_utils.dataset_utils import get_im_names
@@ -23,7 +22,7 @@ from reid_utils.dataset_utils import parse_original_market1501_im_name
 from reid_utils.dataset_utils import parse_full_path_market1501_im_name
 
 
-def get_images_split(zip_file, save_dir=None):
+def get_images_split(zip_file, save_dir=None, num_workers=None):
     """
     Rename and move all used images to a directory.
     """
@@ -32,9 +31,7 @@ def get_images_split(zip_file, save_dir=None):
     root = osp.dirname(osp.abspath(zip_file))
     if save_dir is None:
         save_dir = root
-    may_make_dir(osp.abspath(save_dir))
-    with ZipFile(zip_file) as z:
-        z.extractall(path=save_dir)
+    extract_archive(zip_file, osp.abspath(save_dir), num_workers)
     print("Extracting zip file done")
 
     raw_dir = osp.join(save_dir, osp.basename(zip_file)[:-4])
@@ -86,13 +83,13 @@ def get_images_split(zip_file, save_dir=None):
     return split
 
 
-def transform(zip_file, save_dir=None):
+def transform(zip_file, save_dir=None, num_workers=None):
     """
     Refactor file directories, partition the train/val/test set.
     """
 
     #train_test_split_file = osp.join(save_dir, 'train_test_split.pkl')
-    train_test_split = get_images_split(zip_file, save_dir)
+    train_test_split = get_images_split(zip_file, save_dir, num_workers)
   
     # == partition train/val/ set ==
     # get the trainval_ids by set data structure
@@ -138,8 +135,8 @@ def transform(zip_file, save_dir=None):
                     'val_marks': val_marks,
                     'test_im_names': test_im_names,
                     'test_marks': test_marks}
-    partition_file = osp.join(save_dir, 'partitions.pkl')
-    save_pickle(partitions, partition_file)
+    partition_file = osp.join(save_dir, 'partitions.npz')
+    save_partitions(partitions, partition_file, parse_full_path_market1501_im_name)
     print('Partition file saved to {}'.format(partition_file))
 
 
@@ -151,7 +148,9 @@ if __name__ == '__main__':
                         default='/data/DataSet/market1501/Market-1501-v15.09.15.zip')
     parser.add_argument('--save_dir', type=str,
                         default='/data/DataSet/market1501')
+    parser.add_argument('--num_workers', type=int, default=None,
+                        help='extraction processes, the cpu count by default')
     args = parser.parse_args()
     zip_file = osp.abspath(osp.expanduser(args.zip_file))
     save_dir = osp.abspath(osp.expanduser(args.save_dir))
-    transform(zip_file, save_dir)
+    transform(zip_file, save_dir, args.num_workers)
@@ -9,11 +9,11 @@ from __future__ import print_function
 import sys
 sys.path.append('../')
 
-import tarfile
+import os.path as osp
 import numpy as np
 
-from reid_utils.common_utils import may_make_dir
-from reid_utils.common_utils import save_pickle
+from reid_utils.partition_utils import save_partitions
+from reid_utils.prepare_utils import extract_archive
 
 
 from reid_utils.dataset_utils import partition_train_val_set
@@ -48,9 +48,8 @@ def get_images_split(zip_file, save_dir=None):
     root = osp.dirname(osp.abspath(zip_file))
     if save_dir is None:
         save_dir = root
-    may_make_dir(osp.abspath(save_dir))
-    with tarfile.open(zip_file) as z:
-        z.extractall(path=save_dir)
+    # a tar.gz is extracted serially, but skips members of an interrupted run
+    extract_archive(zip_file, osp.abspath(save_dir))
     print("Extracting zip file done")
 
     raw_dir = osp.join(save_dir, osp.basename(zip_file)[:-7])
@@ -147,8 +146,8 @@ def transform(zip_file, save_dir=None):
                     'val_marks': val_marks,
                     'test_im_names': test_im_names,
                     'test_marks': test_marks}
-    partition_file = osp.join(save_dir, 'partitions.pkl')
-    save_pickle(partitions, partition_file)
+    partition_file = osp.join(save_dir, 'partitions.npz')
+    save_partitions(partitions, partition_file, parse_full_path_msmt17_im_name)
     print('Partition file saved to {}'.format(partition_file))
 
 
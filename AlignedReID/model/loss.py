@@ -95,12 +95,16 @@ def compute_dist_np(array1, array2, type='euclidean'):
     Compute the euclidean or cosine distance of all pairs.
     Args:
         array1: numpy array with shape [m1, n]
-        array2: numpy array with shape [m2, n]
+        array2: numpy array with shape [m2, n], or the EncodedEmbeddings of
+            a compressed gallery (reid_common/codec.py), the distances are
+            then computed on the codes
         type: one of ['cosine', 'euclidean']
     Returns:
         numpy array with shape [m1, m2]
     """
     assert type in ['cosine', 'euclidean']
+    if getattr(array2, 'codec', None) is not None:
+        return array2.codec.dist(array1, array2, type=type)
     if type == 'cosine':
         array1 = normalize_np(array1, axis=1)
         array2 = normalize_np(array2, axis=1)
@@ -312,7 +316,7 @@ def hard_example_mining(dist_mat, labels, return_inds=False):
     Args:
         dist_mat: pytorch Variable, pair wise distance between samples, shape [N, N]
         labels: pytorch LongTensor, with shape [N]
-        return_inds: whether to return the indices. Save time if `False`(?)
+        return_inds: whether to return the indices
     Returns:
         dist_ap: pytorch Variable, distance(anchor, positive); shape [N]
         dist_an: pytorch Variable, distance(anchor, negative); shape [N]
@@ -320,40 +324,27 @@ def hard_example_mining(dist_mat, labels, return_inds=False):
         indices of selected hard positive samples; 0 <= p_inds[i] <= N - 1
         n_inds: pytorch LongTensor, with shape [N];
         indices of selected hard negative samples; 0 <= n_inds[i] <= N - 1
-    NOTE: Only consider the case in which all labels have same num of samples, 
-        thus we can cope with all anchors in parallel.
+    NOTE: Labels may have any number of samples. The other samples are masked
+        with an infinite distance instead of being gathered, so all anchors
+        are still mined in parallel. An anchor is its own positive (distance
+        ~0) when its label has no other sample, and has an infinite `dist_an`
+        when the batch holds no other label.
     """
 
     assert len(dist_mat.size()) == 2
     assert dist_mat.size(0) == dist_mat.size(1)
-    N = dist_mat.size(0)
 
     # shape [N, N]
-    is_pos = labels.expand(N, N).eq(labels.expand(N, N).t())
-    is_neg = labels.expand(N, N).ne(labels.expand(N, N).t())
+    is_pos = labels.unsqueeze(0).eq(labels.unsqueeze(1))
 
     # `dist_ap` means distance(anchor, positive)
-    # both `dist_ap` and `relative_p_inds` with shape [N]
-    dist_ap, relative_p_inds = torch.max(
-        dist_mat[is_pos].contiguous().view(N, -1), 1)
+    # both `dist_ap` and `p_inds` with shape [N]
+    dist_ap, p_inds = torch.max(dist_mat.masked_fill(~is_pos, float('-inf')), 1)
     # `dist_an` means distance(anchor, negative)
-    # both `dist_an` and `relative_n_inds` with shape [N]
-    dist_an, relative_n_inds = torch.min(
-        dist_mat[is_neg].contiguous().view(N, -1), 1)
+    # both `dist_an` and `n_inds` with shape [N]
+    dist_an, n_inds = torch.min(dist_mat.masked_fill(is_pos, float('inf')), 1)
 
     if return_inds:
-        # shape [N, N]
-        ind = (labels.new().resize_as_(labels)
-            .copy_(torch.arange(0, N).long())
-            .unsqueeze(0).expand(N, N))
-        # shape [N, 1]
-        p_inds = torch.gather(
-                    ind[is_pos].contiguous().view(N, -1), 1, relative_p_inds.data.view(-1,1))
-        n_inds = torch.gather(
-                    ind[is_neg].contiguous().view(N, -1), 1, relative_n_inds.data.view(-1,1))
-        # shape [N]
-        p_inds = p_inds.squeeze(1)
-        n_inds = n_inds.squeeze(1)
         return dist_ap, dist_an, p_inds, n_inds
 
     return dist_ap, dist_an
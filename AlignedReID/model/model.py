@@ -2,6 +2,8 @@
 #===================================
 # extract feature model
 #===================================
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
 import torch.nn.init as init
@@ -28,18 +30,26 @@ class Model(nn.Module):
       init.normal_(self.fc.weight, std=0.001)
       init.constant_(self.fc.bias, 0)
 
-  def forward(self, x):
+  def forward(self, x, mode='train'):
     """
+    Args:
+      mode: 'train', every output; 'embed', the features without the logits;
+        'embed_global', the global feature only, the local branch and the
+        classifier are skipped
     Returns:
       global_feat: shape [N, C]
-      local_feat: shape [N, H, c]
+      local_feat: shape [N, H, c], not with 'embed_global'
+      logits: shape [N, num_classes], only with 'train' and num_classes
     """
+    assert mode in ('train', 'embed', 'embed_global')
     # shape [N, C, H, W]
     feat = self.base(x)
     # shape [N, C, 1]
     global_feat = F.avg_pool2d(feat, feat.size()[2:])
     # shape [N, C]
     global_feat = global_feat.view(global_feat.size(0), -1)
+    if mode == 'embed_global':
+      return global_feat
 
     # shape [N, C, H, 1]
     local_feat = torch.mean(feat, -1, keepdim=True)
@@ -47,8 +57,20 @@ class Model(nn.Module):
     # shape [N, H, c]
     local_feat = local_feat.squeeze(-1).permute(0, 2, 1)
 
-    if hasattr(self, 'fc'):
+    if hasattr(self, 'fc') and mode == 'train':
       logits = self.fc(global_feat)
       return global_feat, local_feat, logits
 
     return global_feat, local_feat
+
+  def export_state_dict(self, mode='embed_global'):
+    """
+    The state dict of what `forward(x, mode)` runs: without the classifier,
+    and without the local branch for 'embed_global'. It loads into a model
+    built without num_classes with load_test_model, the stripped entries
+    keep their initial values.
+    """
+    assert mode in ('embed', 'embed_global')
+    skip = ('fc.',) if mode == 'embed' else ('fc.', 'local_')
+    return OrderedDict((name, value) for name, value in self.state_dict().items()
+                       if not name.startswith(skip))
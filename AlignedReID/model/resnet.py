@@ -153,7 +153,7 @@ class ResNet(nn.Module):
 
 def remove_fc(state_dict):
   """Remove the fc layer parameters from state_dict."""
-  for key, value in state_dict.items():
+  for key in list(state_dict.keys()):
     if key.startswith('fc.'):
       del state_dict[key]
   return state_dict
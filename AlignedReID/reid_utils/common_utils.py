@@ -11,10 +11,7 @@ sys.path.append('../')
 import sys
 import os
 import os.path as osp
-if sys.version_info.major == 2:
-    import pickle
-else:
-    import cPickle as pickle
+import pickle
 import numpy as np
 from scipy import io
 import datetime
@@ -15,10 +15,10 @@ import glob
 import matplotlib.pyplot as plt
 import pickle
 import threading
-import Queue
 import time
 from collections import defaultdict
-import shutil
+
+from reid_utils.prepare_utils import copy_files
 
 new_im_name_tmpl = '{:08d}_{:04d}_{:08d}.jpg'
 
@@ -104,8 +104,10 @@ def get_im_names(im_dir, pattern='*.jpg', return_np=True, return_path=False):
     return ret
     
 
-def move_ims(ori_im_paths, new_im_dir, parse_im_name, new_im_name_tmpl):
-    """Rename and move images to new directory."""
+def move_ims(ori_im_paths, new_im_dir, parse_im_name, new_im_name_tmpl,
+             num_workers=None, manifest_file=None):
+    """Rename and move images to new directory (hard linked when possible,
+    images recorded in `manifest_file` by an earlier run are skipped)."""
     cnt = defaultdict(int)
     new_im_names = []
     for im_path in ori_im_paths:
@@ -114,8 +116,9 @@ def move_ims(ori_im_paths, new_im_dir, parse_im_name, new_im_name_tmpl):
         cam = parse_im_name(im_name, 'cam')
         cnt[(id, cam)] += 1
         new_im_name = new_im_name_tmpl.format(id, cam, cnt[(id, cam)] - 1)
-        shutil.copy(im_path, osp.join(new_im_dir, new_im_name))
         new_im_names.append(new_im_name)
+    copy_files(ori_im_paths, [osp.join(new_im_dir, n) for n in new_im_names],
+               num_workers, manifest_file)
     return new_im_names
 
 
@@ -124,6 +127,9 @@ def partition_train_val_set(im_names, parse_im_name,
                             val_ids_num=None, val_prop=None, seed=1):
     """
     Partition the trainval set into train and val set. 
+    For every val id, one random image per camera goes to the val query set if
+    the id has a gallery image under another camera; all its other images form
+    the val gallery. Ids without any valid query are never chosen for val.
     Args:
         im_names: trainval image names
         parse_im_name: a function to parse id and camera from image name
@@ -134,66 +140,53 @@ def partition_train_val_set(im_names, parse_im_name,
     Returns:
         a dict with keys (`train_im_names`, 
                         `val_query_im_names`, 
-                        `val_gallery_im_names`)
+                        `val_gallery_im_names`),
+        names keep their order in `im_names`
     """
-    np.random.seed(seed)
+    rng = np.random.RandomState(seed)
     # Transform to numpy array for slicing.
     if not isinstance(im_names, np.ndarray):
         im_names = np.array(im_names)
-    np.random.shuffle(im_names)
     ids = np.array([parse_im_name(n, 'id') for n in im_names])
     cams = np.array([parse_im_name(n, 'cam') for n in im_names])
-    unique_ids = np.unique(ids)
-    np.random.shuffle(unique_ids)
-
-    # Query indices and gallery indices
-    query_inds = []
-    gallery_inds = []
+    unique_ids, id_inds = np.unique(ids, return_inverse=True)
+    num_ids = len(unique_ids)
 
     if val_ids_num is None:
         assert 0 < val_prop <= 1
-        val_ids_num = int(len(unique_ids) * val_prop)
-    num_selected_ids = 0
-    for unique_id in unique_ids:
-        query_inds_ = []
-        # The indices of this id in trainval set.
-        inds = np.argwhere(unique_id == ids).flatten()
-        # The cams that this id has.
-        unique_cams = np.unique(cams[inds])
-        # For each cam, select one image for query set.
-        for unique_cam in unique_cams:
-            query_inds_.append(
-                inds[np.argwhere(cams[inds] == unique_cam).flatten()[0]])
-        gallery_inds_ = list(set(inds) - set(query_inds_))
-        # For each query image, if there is no same-id different-cam images in
-        # gallery, put it in gallery.
-        for query_ind in query_inds_:
-            if len(gallery_inds_) == 0 \
-                or len(np.argwhere(cams[gallery_inds_] != cams[query_ind])
-                            .flatten()) == 0:
-                query_inds_.remove(query_ind)
-                gallery_inds_.append(query_ind)
-        # If no query image is left, leave this id in train set.
-        if len(query_inds_) == 0:
-            continue
-        query_inds.append(query_inds_)
-        gallery_inds.append(gallery_inds_)
-        num_selected_ids += 1
-        if num_selected_ids >= val_ids_num:
-            break
-
-    query_inds = np.hstack(query_inds)
-    gallery_inds = np.hstack(gallery_inds)
-    val_inds = np.hstack([query_inds, gallery_inds])
-    trainval_inds = np.arange(len(im_names))
-    train_inds = np.setdiff1d(trainval_inds, val_inds)
-
-    train_inds = np.sort(train_inds)
-    query_inds = np.sort(query_inds)
-    gallery_inds = np.sort(gallery_inds)
+        val_ids_num = int(num_ids * val_prop)
+
+    # Group images by (id, cam), in random order inside every group.
+    order = np.lexsort((rng.random_sample(len(im_names)), cams, id_inds))
+    group_start = np.ones(len(order), dtype=bool)
+    group_start[1:] = (id_inds[order][1:] != id_inds[order][:-1]) \
+                    | (cams[order][1:] != cams[order][:-1])
+    # The first image of every (id, cam) group is the query candidate, the
+    # others are gallery images.
+    first_inds = order[group_start]
+    group_gallery_num = np.diff(np.append(np.flatnonzero(group_start), len(order))) - 1
+    id_gallery_num = np.bincount(id_inds[first_inds], weights=group_gallery_num,
+                                minlength=num_ids)
+    # A query needs a same-id different-cam image in gallery.
+    valid = id_gallery_num[id_inds[first_inds]] - group_gallery_num > 0
+    query_cand_inds = first_inds[valid]
+
+    # Select val ids in random order among ids having at least one query.
+    has_query = np.bincount(id_inds[query_cand_inds], minlength=num_ids) > 0
+    val_ids = rng.permutation(np.flatnonzero(has_query))[:val_ids_num]
+    is_val_id = np.zeros(num_ids, dtype=bool)
+    is_val_id[val_ids] = True
+
+    is_val = is_val_id[id_inds]
+    is_query = np.zeros(len(im_names), dtype=bool)
+    is_query[query_cand_inds[is_val_id[id_inds[query_cand_inds]]]] = True
+
+    train_inds = np.flatnonzero(~is_val)
+    query_inds = np.flatnonzero(is_query)
+    gallery_inds = np.flatnonzero(is_val & ~is_query)
 
     partitions = dict(train_im_names=im_names[train_inds],
                         val_query_im_names=im_names[query_inds],
                         val_gallery_im_names=im_names[gallery_inds])
 
-    return partitions
\ No newline at end of file
+    return partitions
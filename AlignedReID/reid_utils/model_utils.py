@@ -18,8 +18,10 @@ import datetime
 import time
 from contextlib import contextmanager
 import reid_utils.common_utils as common_utils 
+from reid_common.checkpoint_utils import AsyncCheckpointWriter
 
 import torch
+import torch.nn as nn
 from torch.autograd import Variable
 
 
@@ -43,6 +45,64 @@ class AverageMeter(object):
         self.avg = float(self.sum) / (self.count + 1e-20)
 
 
+class MetricAccumulator(object):
+    """
+    Running sums of per step metrics kept as tensors on the device, so that a
+    step never waits for the device to report its numbers. `sync` copies them
+    to the host in one transfer and fills `meters`, AverageMeter's holding
+    the value of the last step (val) and the average since `reset` (avg).
+    Args:
+        names: the metric names, also the keys of `meters`
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.meters = dict((name, AverageMeter()) for name in self.names)
+        self.reset()
+
+    def reset(self):
+        self.last = None
+        self.sums = None
+        self.count = 0
+        for meter in self.meters.values():
+            meter.reset()
+
+    def update(self, n=1, **metrics):
+        """
+        Args:
+            n: weight of the step in the average
+            metrics: name -> 0-d tensor (or number) of the step, missing names
+                count as 0
+        """
+        ref = [v for v in metrics.values() if torch.is_tensor(v)][0].detach()
+        vals = []
+        for name in self.names:
+            v = metrics.get(name, 0)
+            if torch.is_tensor(v):
+                vals.append(v.detach().float().reshape(()))
+            else:
+                # filled on the device, a host tensor would be copied every step
+                vals.append(torch.full((), float(v), dtype=torch.float, device=ref.device))
+        self.last = torch.stack(vals)
+        if self.sums is None:
+            self.sums = self.last * n
+        else:
+            self.sums += self.last * n
+        self.count += n
+
+    def sync(self):
+        """Copy the sums to the host, this waits for the device."""
+        if self.last is None:
+            return
+        last, sums = torch.stack([self.last, self.sums]).cpu().tolist()
+        for name, val, sum_ in zip(self.names, last, sums):
+            meter = self.meters[name]
+            meter.val = val
+            meter.sum = sum_
+            meter.count = self.count
+            meter.avg = float(sum_) / (self.count + 1e-20)
+
+
 
 def load_ckpt(model, optimizer, ckpt_file, load_to_cpu=False, verbose=True):
     """
@@ -64,7 +124,7 @@ def load_ckpt(model, optimizer, ckpt_file, load_to_cpu=False, verbose=True):
     return checkpoint['epoch']
 
 
-def save_ckpt(model, optimizer, epoch, ckpt_file):
+def save_ckpt(model, optimizer, epoch, ckpt_file, writer=None, keep=0):
     """
     Save state_dict's of modules/optimizers to file. 
     Args:
@@ -72,6 +132,10 @@ def save_ckpt(model, optimizer, epoch, ckpt_file):
         optimizer:torch.nn.optimizer 
         epoch: the current epoch number
         ckpt_file: The file path.
+        writer: an AsyncCheckpointWriter to save in the background; None
+        saves before returning
+        keep: also keep the checkpoints of the last `keep` epochs as
+        `<ckpt_file>.ep<epoch>`, ckpt_file is then a hard link to the newest
     Note:
         torch.save() reserves device type and id of tensors to save, so when 
         loading ckpt, you have to inform torch.load() to load these tensors to 
@@ -80,8 +144,29 @@ def save_ckpt(model, optimizer, epoch, ckpt_file):
     ckpt = dict(state_dicts=model.state_dict(),
                 optimizer = optimizer.state_dict(),
                 epoch=epoch)
-    common_utils.may_make_dir(osp.dirname(osp.abspath(ckpt_file)))
-    torch.save(ckpt, ckpt_file)
+    if keep > 0:
+        path = '{}.ep{}'.format(ckpt_file, epoch)
+        links = (ckpt_file,)
+        rotate = (ckpt_file + '.ep*', keep)
+    else:
+        path, links, rotate = ckpt_file, (), None
+    if writer is None:
+        AsyncCheckpointWriter._write((ckpt, None), path, links, rotate)
+    else:
+        writer.save(ckpt, path, links, rotate)
+
+
+_checkpoint_writer = None
+
+
+def checkpoint_writer():
+    """
+    The AsyncCheckpointWriter shared by the training loop.
+    """
+    global _checkpoint_writer
+    if _checkpoint_writer is None:
+        _checkpoint_writer = AsyncCheckpointWriter()
+    return _checkpoint_writer
 
 
 def adjust_lr_exp(optimizer, base_lr, epoch, total_epoch, start_decay_at_epoch):
@@ -190,6 +275,60 @@ def adjust_lr_staircase_every(optimizer, base_lr, epoch, decay_every_epochs, fac
 
 
 
+def autocast(cfg):
+    '''
+    The autocast context of the training step, see `cfg.mixed_precision`.
+    '''
+    if torch.cuda.is_available():
+        return torch.autocast('cuda', dtype=torch.float16, enabled=cfg.mixed_precision)
+    return torch.autocast('cpu', dtype=torch.bfloat16, enabled=cfg.mixed_precision)
+
+
+def grad_scaler(cfg):
+    '''
+    Loss scaler for float16 training on gpu; bfloat16 has the range of
+    float32 and needs none, the scaler then passes everything through.
+    '''
+    return torch.cuda.amp.GradScaler(
+        enabled=cfg.mixed_precision and torch.cuda.is_available())
+
+
+def cached_forward(model, ims, micro_batch_size, cfg):
+    '''
+    First pass of GradCache: forward the batch in micro batches without
+    building a graph. BatchNorm running statistics are restored afterwards,
+    since `cached_backward` forwards the same images again.
+    returns:
+        the model outputs of the whole batch as float32 leaf tensors that
+        require grad; the losses of the full batch are computed on them.
+    '''
+    bn_buffers = [(buf, buf.clone()) for m in model.modules()
+                  if isinstance(m, nn.modules.batchnorm._BatchNorm)
+                  for buf in m.buffers()]
+    with torch.no_grad(), autocast(cfg):
+        outputs = [model(ims_) for ims_ in ims.split(micro_batch_size)]
+    for buf, saved in bn_buffers:
+        buf.copy_(saved)
+    return [torch.cat(o).float().requires_grad_() for o in zip(*outputs)]
+
+
+def cached_backward(model, ims, cached_outputs, micro_batch_size, cfg):
+    '''
+    Second pass of GradCache: forward every micro batch again with a graph
+    and backpropagate the gradients the losses left on `cached_outputs`.
+    Parameter gradients accumulate over the micro batches.
+    '''
+    grads = [o.grad for o in cached_outputs]
+    start = 0
+    for ims_ in ims.split(micro_batch_size):
+        with autocast(cfg):
+            outputs = model(ims_)
+        pairs = [(o, g[start:start + len(ims_)].to(o.dtype))
+                 for o, g in zip(outputs, grads) if g is not None]
+        torch.autograd.backward([o for o, _ in pairs], [g for _, g in pairs])
+        start += len(ims_)
+
+
 def transer_var_tensor(var_or_tensor, device_id = 0):
     '''
     Return a copy of the input Variable or Tensor on specified device.
@@ -229,4 +368,4 @@ def load_test_model(model, cfg):
         except (Exception, msg):
             print("Warning: Error occurs when copying '{}': {}".format(name, str(msg)))
 
-    return model
\ No newline at end of file
+    return model
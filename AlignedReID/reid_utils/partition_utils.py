@@ -0,0 +1,195 @@
+#-*- coding:utf-8 -*-
+#===================================
+# columnar partition file utils
+#===================================
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import os.path as osp
+import struct
+from zipfile import ZipFile, ZIP_STORED
+
+import numpy as np
+
+from reid_utils.common_utils import load_pickle
+from reid_utils.common_utils import may_make_dir
+
+# A partition file is an uncompressed .npz holding
+#   path_blob, path_offsets: the interned table of all image paths (utf-8)
+# and for every split present (trainval, train, val, test):
+#   <split>_path_inds: index of every image into the path table
+#   <split>_ids, <split>_cams: int32 person id and camera of every image
+#   <split>_labels, <split>_label_ids: (train splits) int32 label of every
+#       image, and the id of every label
+#   <split>_marks: (val/test) int32 query (0), gallery (1), multi query (2)
+PARTITION_SPLITS = ('trainval', 'train', 'val', 'test')
+
+
+class PathTable(object):
+    """
+    Read only sequence of image paths, decoded from the path table on access,
+    so that no python string is built for images that are never read.
+    """
+
+    def __init__(self, blob, offsets, inds):
+        self.blob = blob
+        self.offsets = offsets
+        self.inds = inds
+
+    def __len__(self):
+        return len(self.inds)
+
+    def __getitem__(self, index):
+        i = self.inds[index]
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+class Partitions(object):
+    """
+    Columns of a partition file, see `load_partitions`.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def has_split(self, split):
+        return split + '_path_inds' in self.columns
+
+    def im_names(self, split):
+        return PathTable(self.columns['path_blob'], self.columns['path_offsets'],
+                         self.columns[split + '_path_inds'])
+
+    def ids(self, split):
+        return self.columns[split + '_ids']
+
+    def cams(self, split):
+        return self.columns[split + '_cams']
+
+    def labels(self, split):
+        return self.columns[split + '_labels']
+
+    def marks(self, split):
+        return self.columns[split + '_marks']
+
+    def ids2labels(self, split):
+        label_ids = self.columns[split + '_label_ids']
+        return dict(zip(label_ids.tolist(), range(len(label_ids))))
+
+
+def partitions_to_columns(partitions, parse_im_name):
+    """
+    Args:
+        partitions: dict in the pickled layout, with `<split>_im_names`,
+            `<split>_ids2labels` and `<split>_marks` entries
+        parse_im_name: a function to parse id and camera from full path image name
+    Returns:
+        a dict of numpy columns, see the top of this file
+    """
+    splits = [s for s in PARTITION_SPLITS if s + '_im_names' in partitions]
+    names = [np.asarray(partitions[s + '_im_names'], dtype=str) for s in splits]
+    # intern the paths, the splits overlap (train and val are in trainval)
+    unique_names, inds = np.unique(np.concatenate(names), return_inverse=True)
+    encoded = [n.encode('utf-8') for n in unique_names]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    columns = dict(path_blob=np.frombuffer(b''.join(encoded), dtype=np.uint8),
+                   path_offsets=offsets)
+
+    start = 0
+    for split, names_ in zip(splits, names):
+        columns[split + '_path_inds'] = inds[start:start + len(names_)].astype(np.int32)
+        start += len(names_)
+        ids = np.array([parse_im_name(n, 'id') for n in names_], dtype=np.int32)
+        columns[split + '_ids'] = ids
+        columns[split + '_cams'] = np.array([parse_im_name(n, 'cam') for n in names_], dtype=np.int32)
+        if split + '_ids2labels' in partitions:
+            ids2labels = partitions[split + '_ids2labels']
+            label_ids = np.zeros(len(ids2labels), dtype=np.int32)
+            label_ids[list(ids2labels.values())] = list(ids2labels.keys())
+            columns[split + '_label_ids'] = label_ids
+            columns[split + '_labels'] = np.array([ids2labels[id] for id in ids.tolist()],
+                                                  dtype=np.int32)
+        if split + '_marks' in partitions:
+            columns[split + '_marks'] = np.array(partitions[split + '_marks'], dtype=np.int32)
+    return columns
+
+
+def save_partitions(partitions, path, parse_im_name):
+    """
+    Write a dict in the pickled partition layout as a partition file.
+    Args:
+        partitions: see `partitions_to_columns`
+        path: the .npz file
+        parse_im_name: a function to parse id and camera from full path image name
+    """
+    columns = partitions_to_columns(partitions, parse_im_name)
+    may_make_dir(osp.dirname(osp.abspath(path)))
+    tmp_path = path + '.tmp.npz'
+    # not compressed, so that load_partitions can memory map the columns
+    np.savez(tmp_path, **columns)
+    os.replace(tmp_path, path)
+
+
+def load_npz_mmap(path):
+    """
+    Memory map every array of an uncompressed .npz, nothing is read before
+    a column is used. Compressed members are read normally.
+    """
+    columns = {}
+    with ZipFile(path) as z, open(path, 'rb') as f:
+        for info in z.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type != ZIP_STORED:
+                with z.open(info) as member:
+                    columns[name] = np.lib.format.read_array(member)
+                continue
+            # skip the local file header, which is followed by the .npy data
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if int(np.prod(shape)) == 0:
+                columns[name] = np.empty(shape, dtype=dtype)
+                continue
+            columns[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(),
+                                      shape=shape, order='F' if fortran_order else 'C')
+    return columns
+
+
+def load_partitions(path, parse_im_name):
+    """
+    Load a partition file. A pickled partition dict (the old format) is
+    converted to `<name>.npz` next to it on first use; a `<name>.pkl` path is
+    served from a `<name>.npz` that is at least as new.
+    Args:
+        path: the .npz or .pkl partition file
+        parse_im_name: a function to parse id and camera from full path image
+            name, only used to convert a pickle
+    Returns:
+        a Partitions object
+    """
+    npz_path = osp.splitext(path)[0] + '.npz'
+    pkl_path = osp.splitext(path)[0] + '.pkl'
+    if osp.exists(npz_path) and (not osp.exists(pkl_path)
+                                 or osp.getmtime(npz_path) >= osp.getmtime(pkl_path)):
+        return Partitions(load_npz_mmap(npz_path))
+
+    assert osp.exists(pkl_path), 'no partition file at {}'.format(path)
+    partitions = load_pickle(pkl_path)
+    try:
+        save_partitions(partitions, npz_path, parse_im_name)
+    except (IOError, OSError):
+        # read only dataset location, convert in memory every time
+        return Partitions(partitions_to_columns(partitions, parse_im_name))
+    print('Partition file converted to {}'.format(npz_path))
+    return Partitions(load_npz_mmap(npz_path))
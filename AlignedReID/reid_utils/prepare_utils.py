@@ -0,0 +1,187 @@
+#-*- coding:utf-8 -*-
+#===================================
+# parallel utils for data set prepare
+#===================================
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import os.path as osp
+import shutil
+import tarfile
+from zipfile import ZipFile
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+
+from reid_utils.common_utils import may_make_dir
+
+
+class PrepareManifest(object):
+    """
+    Record of the items (usually output files) a prepare step has completed,
+    so that an interrupted run resumes where it stopped. Items are appended
+    one per line only after they are written, hence a listed item is complete.
+    Usage:
+        with PrepareManifest(path) as manifest:
+            todo = [n for n in names if n not in manifest]
+            ...
+            manifest.add(done_names)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if osp.exists(path):
+            with open(path, 'r') as f:
+                # a line without newline was cut by an interruption, skip it
+                self.done = set(line[:-1] for line in f if line.endswith('\n'))
+        may_make_dir(osp.dirname(osp.abspath(path)))
+        self.f = open(path, 'a')
+
+    def __contains__(self, item):
+        return item in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, items):
+        """Mark items completed, flushed at once."""
+        items = [item for item in items if item not in self.done]
+        if len(items) == 0:
+            return
+        self.f.write(''.join(item + '\n' for item in items))
+        self.f.flush()
+        self.done.update(items)
+
+    def close(self):
+        self.f.close()
+
+
+def default_num_workers(num_workers=None):
+    return num_workers if num_workers else cpu_count()
+
+
+def chunk(items, num_chunks):
+    """Split a list into at most num_chunks contiguous, non empty lists."""
+    size = max((len(items) + num_chunks - 1) // num_chunks, 1)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _extract_zip_members(args):
+    """Worker of extract_archive, every process reads the zip on its own."""
+    zip_file, save_dir, names = args
+    with ZipFile(zip_file) as z:
+        for name in names:
+            z.extract(name, save_dir)
+    return names
+
+
+def extract_archive(archive, save_dir, num_workers=None):
+    """
+    Extract a zip with a process pool (every process inflates its own chunk of
+    members) or a tar archive serially, skipping the members a previous run
+    has already extracted.
+    Args:
+        archive: path of a .zip or .tar(.gz) file
+        save_dir: directory to extract into
+        num_workers: processes for zip files, defaults to the cpu count
+    """
+    num_workers = default_num_workers(num_workers)
+    may_make_dir(save_dir)
+    manifest_file = osp.join(save_dir, osp.basename(archive) + '.extracted')
+
+    with PrepareManifest(manifest_file) as manifest:
+        if tarfile.is_tarfile(archive):
+            # gzip streams can not be split, tar members are extracted in order
+            with tarfile.open(archive) as tar:
+                for member in tar:
+                    if member.name in manifest:
+                        continue
+                    tar.extract(member, save_dir)
+                    if member.isfile():
+                        manifest.add([member.name])
+            return
+
+        with ZipFile(archive) as z:
+            infos = z.infolist()
+        names = [info.filename for info in infos
+                 if not info.filename.endswith('/') and info.filename not in manifest]
+        if len(names) == 0:
+            return
+        # create directories up front, workers would race on them
+        for dir_name in set(osp.dirname(name) for name in names):
+            may_make_dir(osp.join(save_dir, dir_name))
+
+        jobs = [(archive, save_dir, names_) for names_ in chunk(names, num_workers * 8)]
+        pool = Pool(num_workers)
+        try:
+            for done in pool.imap_unordered(_extract_zip_members, jobs):
+                manifest.add(done)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def link_or_copy(src, dst, link=True):
+    """
+    Hard link dst to src, falling back to a copy when linking is impossible
+    (e.g. another filesystem). An existing dst is replaced.
+    """
+    if osp.lexists(dst):
+        os.remove(dst)
+    if link:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copy(src, dst)
+
+
+def _link_or_copy_pairs(args):
+    """Worker of copy_files."""
+    pairs, link = args
+    for src, dst in pairs:
+        link_or_copy(src, dst, link)
+    return [dst for _, dst in pairs]
+
+
+def copy_files(src_paths, dst_paths, num_workers=None, manifest_file=None):
+    """
+    Copy files with a thread pool (copies wait on disk, not on the GIL), using
+    hard links when sources and destinations share a filesystem.
+    Args:
+        src_paths: source file paths
+        dst_paths: destination file paths, their directories must exist
+        num_workers: threads, defaults to the cpu count
+        manifest_file: record completed destinations here to skip them in a
+            later run; None copies everything
+    """
+    num_workers = default_num_workers(num_workers)
+    pairs = list(zip(src_paths, dst_paths))
+    if len(pairs) == 0:
+        return
+    link = os.stat(pairs[0][0]).st_dev == \
+        os.stat(osp.dirname(osp.abspath(pairs[0][1]))).st_dev
+
+    manifest = PrepareManifest(manifest_file) if manifest_file is not None else None
+    if manifest is not None:
+        pairs = [(src, dst) for src, dst in pairs if dst not in manifest]
+    pool = ThreadPool(num_workers)
+    try:
+        jobs = [(pairs_, link) for pairs_ in chunk(pairs, num_workers * 8)]
+        for done in pool.imap_unordered(_link_or_copy_pairs, jobs):
+            if manifest is not None:
+                manifest.add(done)
+    finally:
+        pool.close()
+        pool.join()
+        if manifest is not None:
+            manifest.close()
@@ -7,7 +7,9 @@ from __future__ import division
 from __future__ import print_function
 
 import sys
-sys.append('../')
+sys.path.append('../')
+# the repository root, for the reid_common package
+sys.path.append('../../')
 
 from sklearn.utils.linear_assignment_ import linear_assignment
 import os
@@ -18,6 +20,7 @@ from torch.autograd import Variable
 from model.model import Model
 import reid_utils.common_utils as common_utils 
 import reid_utils.model_utils as model_utils
+import reid_common.runtime_utils as runtime_utils
 from reid_utils.model_utils import transer_var_tensor
 import  model.loss as loss
 from reid_utils.common_utils import measure_time
@@ -50,11 +53,19 @@ class ReId(object):
     def __init__(self, 
                 model_path,
                 identy_threshold,
-                device_id = 0):
+                device_id = 0,
+                torchscript = False,
+                channels_last = False,
+                num_threads = 0):
         '''
         args:
             model_path: the model file path
             image_path: the image file path
+            torchscript: model_path is a frozen TorchScript model of
+                script/export.py, loaded without building the Model
+            channels_last: run the eager model and its inputs in channels_last
+            num_threads: intra-op threads, 0 keeps the torch default, see
+                runtime_utils.tune_runtime for the best value of the host
         '''
         class Config(object):
             pass
@@ -63,15 +74,25 @@ class ReId(object):
         cfg.ckpt_file = model_path
         self.device_id = device_id
         self.identy_threshold = identy_threshold
+        self.torchscript = torchscript
+        self.channels_last = channels_last and not torchscript
         common_utils.set_device(device_id)
-        # create model
-        self.model = Model(local_conv_out_channels=128, pretrained = False)
-        # load model param
-        self.model = model_utils.load_test_model(self.model, cfg)
+        runtime_utils.configure_runtime(num_threads)
+        if torchscript:
+            # frozen weights are constants, .cuda() does not move them
+            use_cuda = torch.cuda.is_available() and device_id >= 0
+            self.model = torch.jit.load(
+                model_path, map_location='cuda:{}'.format(device_id) if use_cuda else 'cpu')
+        else:
+            # create model
+            self.model = Model(local_conv_out_channels=128, pretrained = False)
+            # load model param
+            self.model = model_utils.load_test_model(self.model, cfg)
         self.model.eval()
         # after load model
         if torch.cuda.is_available() and device_id >= 0:
             self.model = self.model.cuda()
+        self.model = runtime_utils.to_channels_last(self.model, self.channels_last)
     
     def __parse_image_name__(self, image_name):
         '''
@@ -85,6 +106,20 @@ class ReId(object):
         scene_id = int(image_name[10])
         return mark, person_id, camera_id, scene_id
 
+    def __embed__(self, ims_var, use_local_distance=False):
+        '''
+        the global features, and the local features if use_local_distance.
+        '''
+        ims_var = runtime_utils.to_channels_last(ims_var, self.channels_last)
+        if not self.torchscript:
+            return self.model(ims_var, mode='embed' if use_local_distance else 'embed_global')
+        # the exported mode decides the outputs
+        outputs = self.model(ims_var)
+        if isinstance(outputs, tuple):
+            return outputs if use_local_distance else outputs[0]
+        assert not use_local_distance, 'the model was exported without the local branch'
+        return outputs
+
     def get_threshold(self):
         return self.identy_threshold
 
@@ -100,7 +135,7 @@ class ReId(object):
         pictures = np.array(pictures)
         with torch.no_grad():
             ims_var = Variable(transer_var_tensor(torch.from_numpy(pictures), self.device_id).float())
-        global_feats, local_feats = self.model(ims_var)[:2]
+            global_feats = self.__embed__(ims_var)
         global_feats = global_feats.data.cpu().numpy()
         return global_feats
 
@@ -351,15 +386,19 @@ class ReId(object):
         returns:
             the finnal distance matrix
         '''
-        with measure_time('Extrating feature...'):
-            ims_var = Variable(transer_var_tensor(torch.from_numpy(images), self.device_id).float(), volatile=True)
-            global_feats, local_feats = self.model(ims_var)[:2]
+        with measure_time('Extrating feature...'), torch.no_grad():
+            ims_var = Variable(transer_var_tensor(torch.from_numpy(images), self.device_id).float())
+            if use_local_distance:
+                global_feats, local_feats = self.__embed__(ims_var, True)
+                local_feats = local_feats.data.cpu().numpy()
+            else:
+                global_feats = self.__embed__(ims_var)
             global_feats = global_feats.data.cpu().numpy()
-            local_feats = local_feats.data.cpu().numpy()
 
         if normalize_feature:
             global_feats = loss.normalize_np(global_feats, axis=1)
-            local_feats = loss.normalize_np(local_feats, axis=-1)
+            if use_local_distance:
+                local_feats = loss.normalize_np(local_feats, axis=-1)
 
         # Global Distance 
         with measure_time('Computing global distance...'):
@@ -0,0 +1,43 @@
+#-*- coding:utf-8 -*-
+#===================================
+# export program
+#===================================
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+sys.path.append('../')
+# the repository root, for the reid_common package
+sys.path.append('../../')
+
+import argparse
+
+import reid_utils.model_utils as model_utils
+import reid_common.export_utils as export_utils
+from model.model import Model
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the embedding model for deployment')
+    parser.add_argument('--ckpt_file', type=str, default='', help='checkpoint saved by train.py')
+    parser.add_argument('--model_weight_file', type=str, default='', help='state dict, used instead of --ckpt_file')
+    parser.add_argument('--mode', type=str, default='embed_global', choices=['embed', 'embed_global'],
+                        help="'embed' also outputs the local features")
+    parser.add_argument('--height', type=int, default=416)
+    parser.add_argument('--width', type=int, default=208)
+    parser.add_argument('--torchscript_file', type=str, default='', help='path of the frozen TorchScript model')
+    parser.add_argument('--onnx_file', type=str, default='', help='path of the ONNX model')
+    parser.add_argument('--optimize', action='store_true', help='apply torch.jit.optimize_for_inference')
+    cfg = parser.parse_args()
+    assert cfg.torchscript_file != '' or cfg.onnx_file != '', 'nothing to export'
+
+    model = Model(local_conv_out_channels=128, pretrained=False)
+    model = model_utils.load_test_model(model, cfg)
+    export_utils.export_model(model, (cfg.height, cfg.width), cfg.mode,
+                              torchscript_file=cfg.torchscript_file, onnx_file=cfg.onnx_file,
+                              optimize=cfg.optimize)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,10 @@ from __future__ import print_function
 
 import sys
 sys.path.append('../')
+# the repository root, for the reid_common package
+sys.path.append('../../')
 
+import os
 
 from PIL import Image
 import random
@@ -22,11 +25,15 @@ import torch.optim as optim
 import config.config as config
 import reid_utils.common_utils as common_utils 
 import reid_utils.model_utils as model_utils
+import reid_common.log_utils as log_utils
+import reid_common.runtime_utils as runtime_utils
+import reid_common.dist_utils as dist_utils
 from data_set.data_set import ReIdDataSet
 from model.model import Model
 from train import train
 from test import test
 from model.loss import TripletLoss
+from reid_common.sampler import BatchSampler, HardIdentityBatchSampler, DistributedBatchSampler
 from torch.utils.data import DataLoader
 import torchvision.transforms as transforms
 
@@ -38,6 +45,17 @@ def main():
 
     # set cpu or gpus which will be used
     common_utils.set_devices(cfg.sys_device_ids)
+    local_rank, local_world_size = dist_utils.get_local_rank() if cfg.distributed else (0, 1)
+    runtime_utils.configure_runtime(cfg.num_threads, cfg.interop_threads, cfg.pin_workers,
+                                    local_rank, local_world_size)
+
+    # join the other ranks of a torchrun launch, only rank 0 logs to file
+    if cfg.distributed:
+        dist_utils.init_distributed('gloo', cfg.dist_timeout)
+        cfg.log_to_file = cfg.log_to_file and dist_utils.is_main_process()
+    # the inputs go to gpu 0, or stay on cpu with distributed training or
+    # without a gpu
+    device_id = -1 if cfg.distributed or not torch.cuda.is_available() else 0
 
     # set seed for all possibale moudel
     if cfg.seed is not None:
@@ -56,6 +74,14 @@ def main():
     print('-' * 60)
     
 
+    if cfg.tune_runtime:
+        def make_model():
+            model = Model(local_conv_out_channels=128, pretrained=False)
+            return model.cuda() if torch.cuda.is_available() else model
+        thread_counts = cfg.tune_threads or [2 ** i for i in range(os.cpu_count().bit_length())]
+        runtime_utils.tune_runtime(make_model, cfg.im_resize_size, cfg.test_batch_size, thread_counts)
+        return
+
     # test on test set
     if cfg.only_test:
         test_loader, _ = create_data_loader(cfg, 'test')
@@ -69,8 +95,9 @@ def main():
             model = nn.DataParallel(model)
         if torch.cuda.is_available():
             model.cuda()
+        model = runtime_utils.to_channels_last(model, cfg.channels_last)
         # just for test
-        test(test_loader, model, cfg)
+        test(test_loader, model, cfg, device_id)
         return
 
 
@@ -83,11 +110,22 @@ def main():
     model = Model(local_conv_out_channels=128, 
                   num_classes=len(train_dataset.ids2labels))
 
-    if torch.cuda.device_count() > 1:
-        print("Let's use", torch.cuda.device_count(), "GPUs for tain!")
-        model = nn.DataParallel(model)
-    if torch.cuda.is_available():
-        model.cuda()
+    if cfg.distributed:
+        # the cached backward of GradCache would all-reduce every micro batch
+        assert cfg.micro_batch_size == 0, 'micro batches are not supported with distributed'
+        model = runtime_utils.to_channels_last(model, cfg.channels_last)
+        print("Let's use", dist_utils.get_world_size(), "processes for train!")
+        # the local branch and the classifier get no gradient when their
+        # losses are off
+        model = nn.parallel.DistributedDataParallel(model,
+            find_unused_parameters=cfg.l_loss_weight == 0 or cfg.id_loss_weight == 0)
+    else:
+        if torch.cuda.device_count() > 1:
+            print("Let's use", torch.cuda.device_count(), "GPUs for tain!")
+            model = nn.DataParallel(model)
+        if torch.cuda.is_available():
+            model.cuda()
+        model = runtime_utils.to_channels_last(model, cfg.channels_last)
 
 
     # define loss
@@ -118,7 +156,12 @@ def main():
     # If your input size is changing a lot, then it might hurt runtime
     # if not, it should be much faster.
     #cudnn.benchmark = True
-    torch.backends.cudnn.enabled = False
+    # float16 convolutions are only fast with cuDNN
+    torch.backends.cudnn.enabled = cfg.mixed_precision
+    scaler = model_utils.grad_scaler(cfg)
+    profiler = log_utils.StepProfiler(
+        cfg.profile_every, trace_dir=cfg.profile_trace_dir,
+        trace_start=cfg.profile_trace_start, trace_steps=cfg.profile_trace_steps)
 
     start_epoch = resume_epoch if cfg.resume else 0
     for epoch in range(start_epoch, cfg.total_epochs):
@@ -146,21 +189,30 @@ def main():
                 cfg.staircase_decay_multiply_factor)
 
         # for the purpose gradually increase the random patch 
-        train_loader, _ = create_data_loader(cfg, cfg.trainset_part, epoch, cfg.total_epochs)
+        # (the sampler is kept, it carries the centroids of hard id mining)
+        train_loader, _ = create_data_loader(cfg, cfg.trainset_part, epoch, cfg.total_epochs,
+                            batch_sampler=train_loader.batch_sampler)
         # train for one epoch
-        train(train_loader, model, loss_dict, optimizer, epoch, cfg)
+        train(train_loader, model, loss_dict, optimizer, epoch, cfg, scaler, profiler,
+              device_id)
         if (epoch+1) % cfg.val_at_epoch == 0:
-            # validata for one epoch
-            test(val_loader, model, cfg)
+            # validata for one epoch, on rank 0 with the unwrapped model
+            if cfg.distributed:
+                if dist_utils.is_main_process():
+                    test(val_loader, model.module, cfg, device_id)
+                dist_utils.barrier()
+            else:
+                test(val_loader, model, cfg, device_id)
 
 
 
-def create_data_loader(cfg, data_type, epoch=1, total_epoch=1e5):
+def create_data_loader(cfg, data_type, epoch=1, total_epoch=1e5, batch_sampler=None):
     '''
     create the loader for train/val/test
     args:
         cfg:the object of Config
         data_type:'train','val','test' to decide the data type
+        batch_sampler: reuse this training batch sampler instead of a new one
     returns:
         the data loader of train/val/test data
     '''
@@ -199,8 +251,9 @@ def create_data_loader(cfg, data_type, epoch=1, total_epoch=1e5):
         random_w = [random_w1, random_w2]
         random_w.sort()
 
-        img_array = np.asarray(img)
-        img_array.flags.writeable = True
+        # a writable copy, numpy >= 1.17 does not let the view of the PIL
+        # image be made writable
+        img_array = np.array(img)
         img_array[random_h[0]:random_h[1], random_w[0]:random_w[1], :] \
             = np.random.randint(0,255,size=(random_h[1]-random_h[0], random_w[1]-random_w[0], 3))
         img = Image.fromarray(np.uint8(img_array))
@@ -208,8 +261,6 @@ def create_data_loader(cfg, data_type, epoch=1, total_epoch=1e5):
 
 
     if data_type == 'train' or data_type == 'trainval' :
-        data_shuffle = True
-        batch_size = cfg.ids_per_batch
         transform = transforms.Compose(
                             [
                             transforms.Lambda(img_cut_out),
@@ -224,8 +275,6 @@ def create_data_loader(cfg, data_type, epoch=1, total_epoch=1e5):
                             transforms.Normalize(mean=cfg.im_mean, std=cfg.im_std)]
                             ) 
     else:
-        data_shuffle = False
-        batch_size=cfg.test_batch_size
         transform = transforms.Compose(
                     [
                     transforms.Resize(cfg.im_resize_size),
@@ -239,10 +288,44 @@ def create_data_loader(cfg, data_type, epoch=1, total_epoch=1e5):
     dataset = ReIdDataSet(data_type,
                         cfg,
                         transform)
-    data_loader = torch.utils.data.DataLoader(
-                        dataset, batch_size=batch_size,
-                        shuffle = data_shuffle,
-                        num_workers=cfg.workers, pin_memory=True)
+    worker_init_fn = runtime_utils.WorkerAffinity(cfg.num_threads) if cfg.pin_workers else None
+    if data_type == 'train' or data_type == 'trainval' :
+        # every batch holds ids_per_batch ids with ims_per_id images each
+        # with distributed, the ids of all ranks, split by DistributedBatchSampler
+        world_size = dist_utils.get_world_size() if cfg.distributed else 1
+        seed = dist_utils.shared_seed() if cfg.distributed and batch_sampler is None else None
+        if batch_sampler is None and cfg.hard_id_mining:
+            batch_sampler = HardIdentityBatchSampler(dataset.im_labels,
+                            cfg.ids_per_batch * world_size,
+                            cfg.ims_per_id,
+                            cams=dataset.im_cams,
+                            hard_ratio=cfg.hard_ratio,
+                            momentum=cfg.centroid_momentum,
+                            drop_last=cfg.distributed,
+                            seed=seed)
+        elif batch_sampler is None:
+            batch_sampler = BatchSampler(dataset.im_labels,
+                            cfg.ids_per_batch * world_size,
+                            cfg.ims_per_id,
+                            cams=dataset.im_cams,
+                            id_weight=cfg.id_weight,
+                            cam_balanced=cfg.cam_balanced,
+                            drop_last=cfg.distributed,
+                            seed=seed)
+        if cfg.distributed and not isinstance(batch_sampler, DistributedBatchSampler):
+            # the global batch of all ranks, drawn the same on every rank
+            batch_sampler = DistributedBatchSampler(batch_sampler,
+                            dist_utils.get_world_size(), dist_utils.get_rank())
+        data_loader = torch.utils.data.DataLoader(
+                            dataset, batch_sampler=batch_sampler,
+                            num_workers=cfg.workers, pin_memory=True,
+                            worker_init_fn=worker_init_fn)
+    else:
+        data_loader = torch.utils.data.DataLoader(
+                            dataset, batch_size=cfg.test_batch_size,
+                            shuffle = False,
+                            num_workers=cfg.workers, pin_memory=True,
+                            worker_init_fn=worker_init_fn)
 
 
     return data_loader, dataset
@@ -0,0 +1,89 @@
+#-*- coding:utf-8 -*-
+#===================================
+# post-training quantization program
+#===================================
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+sys.path.append('../')
+# the repository root, for the reid_common package
+sys.path.append('../../')
+
+import time
+import os.path as osp
+
+import numpy as np
+import torch
+import config.config as config
+import reid_utils.common_utils as common_utils 
+import reid_utils.model_utils as model_utils
+import reid_common.export_utils as export_utils
+from model.model import Model
+from main import create_data_loader
+from test import test
+
+
+def calib_batches(dataset, num_images, batch_size, seed=0):
+    '''
+    a random sample of the dataset images as cpu batches.
+    '''
+    rng = np.random.RandomState(seed)
+    indices = rng.choice(len(dataset), min(num_images, len(dataset)), replace=False)
+    loader = torch.utils.data.DataLoader(
+        torch.utils.data.Subset(dataset, indices.tolist()), batch_size=batch_size, shuffle=False)
+    return [ims_.float() for ims_, _, _, _ in loader]
+
+
+def main():
+    '''
+    calibrate and quantize the model of cfg.ckpt_file (or
+    cfg.model_weight_file) on test images, then evaluate the float and the
+    quantized model on cpu and report the mAP/CMC deltas. Exits with 1 when
+    the mAP drops more than cfg.quant_max_map_drop.
+    '''
+    cfg = config.Config()
+    test_loader, test_dataset = create_data_loader(cfg, 'test')
+
+    model = Model(local_conv_out_channels=128, pretrained=False)
+    model = model_utils.load_test_model(model, cfg).eval()
+    use_local_distance = (cfg.l_loss_weight > 0) \
+                        and cfg.local_dist_own_hard_sample
+    mode = 'embed' if use_local_distance else 'embed_global'
+
+    with common_utils.measure_time('Calibrating...'):
+        batches = calib_batches(test_dataset, cfg.quant_calib_images, cfg.test_batch_size)
+        q_model = export_utils.quantize_model(model, batches, mode, cfg.quant_backend)
+
+    scores = []
+    for name, m in [('float', model), ('int8', q_model)]:
+        print('-' * 60)
+        print('Testing the {} model on cpu'.format(name))
+        start = time.time()
+        mAP, cmc_scores, _, _ = test(test_loader, m, cfg, device_id=-1)
+        scores.append((mAP, cmc_scores, time.time() - start))
+
+    (f_map, f_cmc, f_time), (q_map, q_cmc, q_time) = scores
+    print('-' * 60)
+    print('{:6s} {:>8s} {:>8s} {:>8s} {:>8s} {:>8s}'.format('', 'mAP', 'cmc1', 'cmc5', 'cmc10', 'time'))
+    print('{:6s} {:8.2%} {:8.2%} {:8.2%} {:8.2%} {:7.1f}s'.format('float', f_map, *(list(f_cmc[[0, 4, 9]]) + [f_time])))
+    print('{:6s} {:8.2%} {:8.2%} {:8.2%} {:8.2%} {:7.1f}s'.format('int8', q_map, *(list(q_cmc[[0, 4, 9]]) + [q_time])))
+    print('{:6s} {:+8.2%} {:+8.2%} {:+8.2%} {:+8.2%} {:7.2f}x'.format(
+        'delta', q_map - f_map, *(list(q_cmc[[0, 4, 9]] - f_cmc[[0, 4, 9]]) + [f_time / max(q_time, 1e-12)])))
+
+    if cfg.quant_file != '':
+        example = batches[0]
+        with torch.no_grad():
+            traced = torch.jit.freeze(torch.jit.trace(q_model.module, example))
+        common_utils.may_make_dir(osp.dirname(osp.abspath(cfg.quant_file)))
+        torch.jit.save(traced, cfg.quant_file)
+        print('Quantized TorchScript model saved to {}'.format(cfg.quant_file))
+
+    if f_map - q_map > cfg.quant_max_map_drop:
+        print('mAP drop {:.2%} is over the accepted {:.2%}'.format(f_map - q_map, cfg.quant_max_map_drop))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,8 @@ from __future__ import print_function
 
 import sys
 sys.path.append('../')
+# the repository root, for the reid_common package
+sys.path.append('../../')
 
 
 import time
@@ -20,47 +22,60 @@ import torch.optim as optim
 import reid_utils.common_utils as common_utils 
 from reid_utils.common_utils import measure_time
 import reid_utils.model_utils as model_utils
+import reid_common.runtime_utils as runtime_utils
 import model.model as model 
 import reid_utils.model_utils as model_utils
 from reid_utils.model_utils import transer_var_tensor
 from reid_utils.re_ranking import re_ranking
 from reid_utils.metric import cmc, mean_ap
+from reid_common.codec import make_codec
 import  model.loss as loss
 
 
-def test(val_loader, model, cfg):
+def test(val_loader, model, cfg, device_id=0):
     '''
     validate function
+    args:
+        device_id: gpu of the inputs, -1 for cpu (e.g. a quantized model)
     '''
     # switch to evaluate mode
     model.eval()
 
     global_feats, local_feats, ids, cams, marks = \
       [], [], [], [], []
+    use_local_distance = (cfg.l_loss_weight > 0) \
+                        and cfg.local_dist_own_hard_sample
+    # the local branch only runs when its distance is evaluated
+    mode = 'embed' if use_local_distance else 'embed_global'
     
     with measure_time('Extracting feature...'):
         for i, (ims_, ids_, cams_, marks_) in enumerate(val_loader):
             with torch.no_grad():
-                ims_var = Variable(transer_var_tensor(ims_).float())
-            global_feat, local_feat = model(ims_var)[:2]
+                ims_var = Variable(transer_var_tensor(ims_, device_id).float())
+                ims_var = runtime_utils.to_channels_last(ims_var, cfg.channels_last)
+                if use_local_distance:
+                    global_feat, local_feat = model(ims_var, mode=mode)
+                    local_feats.append(local_feat.data.cpu().numpy())
+                else:
+                    global_feat = model(ims_var, mode=mode)
 
             global_feat = global_feat.data.cpu().numpy()
-            local_feat = local_feat.data.cpu().numpy()
             global_feats.append(global_feat)
-            local_feats.append(local_feat)
 
             ids.append(ids_.cpu().numpy())
             cams.append(cams_.cpu().numpy())
             marks.append(marks_.cpu().numpy())
 
     global_feats = np.vstack(global_feats)
-    local_feats = np.concatenate(local_feats)
+    if use_local_distance:
+        local_feats = np.concatenate(local_feats)
     ids = np.hstack(ids)
     cams = np.hstack(cams)
     marks = np.hstack(marks)
     if cfg.normalize_feature:
         global_feats = loss.normalize_np(global_feats, axis=1)
-        local_feats = loss.normalize_np(local_feats, axis=-1)
+        if use_local_distance:
+            local_feats = loss.normalize_np(local_feats, axis=-1)
     ###################################
     # measure accuracy and record loss#
     ###################################
@@ -69,11 +84,21 @@ def test(val_loader, model, cfg):
     g_inds = marks == 1
     mq_inds = marks == 2
 
+    # the gallery is kept compressed, distances are computed on its codes
+    gallery_feats = global_feats[g_inds]
+    if cfg.gallery_codec != 'none':
+        kwargs = dict(num_subspaces=cfg.pq_subspaces) if cfg.gallery_codec == 'pq' else {}
+        codec = make_codec(cfg.gallery_codec, **kwargs)
+        with measure_time('Encoding gallery as {}...'.format(cfg.gallery_codec)):
+            gallery_feats = codec.fit(gallery_feats).encode(gallery_feats)
+        print('Gallery features: {:.1f}MB, {:.1f}x smaller'.format(
+            gallery_feats.nbytes / 2. ** 20, global_feats[g_inds].nbytes / float(gallery_feats.nbytes)))
+
     # Global Distance 
     with measure_time('Computing global distance...'):
         # query-gallery distance using global distance
         global_q_g_dist = loss.compute_dist_np(
-            global_feats[q_inds], global_feats[g_inds], type='euclidean')
+            global_feats[q_inds], gallery_feats, type='euclidean')
 
     with measure_time('Computing scores for Global Distance...'):
         mAP, cmc_scores = compute_score(global_q_g_dist, ids, cams, q_inds, g_inds, cfg)
@@ -86,7 +111,8 @@ def test(val_loader, model, cfg):
 
             # gallery-gallery distance using global distance
             global_g_g_dist = loss.compute_dist_np(
-                global_feats[g_inds], global_feats[g_inds], type='euclidean')
+                gallery_feats.decode() if cfg.gallery_codec != 'none' else gallery_feats,
+                gallery_feats, type='euclidean')
 
             # re-ranked global query-gallery distance
             re_r_global_q_g_dist = re_ranking(
@@ -95,8 +121,6 @@ def test(val_loader, model, cfg):
         with measure_time('Computing scores for re-ranked Global Distance...'):
             mAP, cmc_scores = compute_score(re_r_global_q_g_dist, ids, cams, q_inds, g_inds, cfg)
 
-    use_local_distance = (cfg.l_loss_weight > 0) \
-                        and cfg.local_dist_own_hard_sample
     # Local Distance 
     if use_local_distance:
         # query-gallery distance using local distance
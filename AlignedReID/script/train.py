@@ -8,10 +8,11 @@ from __future__ import print_function
 
 import sys
 sys.path.append('../')
+# the repository root, for the reid_common package
+sys.path.append('../../')
 
 import time
 import os.path as osp
-from tensorboardX import SummaryWriter
 
 import torch
 import torch.nn as nn
@@ -20,14 +21,30 @@ from torch.autograd import Variable
 import torch.backends.cudnn as cudnn
 import torch.optim as optim
 import config.config as config
-import reid_utils.common_utils as common_utils 
 import reid_utils.model_utils as model_utils
+import reid_common.log_utils as log_utils
+import reid_common.runtime_utils as runtime_utils
+import reid_common.dist_utils as dist_utils
 import model.model as model 
 import model.loss as loss
 from reid_utils.model_utils import transer_var_tensor
 
 
-def train(train_loader, model, loss_dict, optimizer, epoch, cfg):
+_scalar_logger = None
+
+
+def scalar_logger(log_dir, flush_secs=30):
+    '''
+    The ScalarLogger of the run, created on the first call.
+    '''
+    global _scalar_logger
+    if _scalar_logger is None:
+        _scalar_logger = log_utils.ScalarLogger(log_dir, flush_secs)
+    return _scalar_logger
+
+
+def train(train_loader, model, loss_dict, optimizer, epoch, cfg, scaler=None,
+          profiler=None, device_id=0):
     '''
     one epoch train function
     args:
@@ -37,36 +54,69 @@ def train(train_loader, model, loss_dict, optimizer, epoch, cfg):
         optimizer: 
         epoch: current epoch
         cfg: config
+        scaler: GradScaler kept across epochs, see `model_utils.grad_scaler`
+        profiler: StepProfiler kept across epochs, see `log_utils.StepProfiler`
+        device_id: gpu of the inputs, -1 for cpu (e.g. distributed training)
     '''
+    if scaler is None:
+        scaler = model_utils.grad_scaler(cfg)
+    if profiler is None:
+        profiler = log_utils.StepProfiler()
+
     # switch to train mode
     model.train()
 
-    meter_dict = dict(
-        g_prec_meter = model_utils.AverageMeter(),
-        g_m_meter = model_utils.AverageMeter(),
-        g_dist_ap_meter = model_utils.AverageMeter(),
-        g_dist_an_meter = model_utils.AverageMeter(),
-        g_loss_meter = model_utils.AverageMeter(),
-        l_prec_meter = model_utils.AverageMeter(),
-        l_m_meter = model_utils.AverageMeter(),
-        l_dist_ap_meter = model_utils.AverageMeter(),
-        l_dist_an_meter = model_utils.AverageMeter(),
-        l_loss_meter = model_utils.AverageMeter(),
-        id_loss_meter = model_utils.AverageMeter(),
-        loss_meter = model_utils.AverageMeter(),)
+    # the metrics stay on the device, they are only copied to the host to
+    # be logged (every cfg.log_steps steps and at the end of the epoch)
+    metrics = model_utils.MetricAccumulator([
+        'g_prec_meter', 'g_m_meter', 'g_dist_ap_meter', 'g_dist_an_meter',
+        'g_loss_meter', 'l_prec_meter', 'l_m_meter', 'l_dist_ap_meter',
+        'l_dist_an_meter', 'l_loss_meter', 'id_loss_meter', 'loss_meter'])
+    meter_dict = metrics.meters
+
+    logger = None
+    if cfg.log_to_file:
+        logger = scalar_logger(
+            osp.join(cfg.exp_dir, 'tensorboard'), cfg.log_flush_secs)
+    timer = log_utils.StepTimer()
+    num_ims = 0
+    data_wait = 0.
 
     epoch_start = time.time()
+    profiler.start()
     for step, (ims, labels) in enumerate(train_loader):
+        timer.data_ready()
+        profiler.mark('data')
         step_start = time.time()
-        # change the shape of ims and labels
-        ims = ims.view(-1, ims.size()[2], ims.size()[3], ims.size()[4])
-        labels = labels.view(-1, )
 
-        ims_var = Variable(transer_var_tensor(ims.float()))
-        labels_t = transer_var_tensor(labels.long())
+        ims_var = Variable(transer_var_tensor(ims.float(), device_id))
+        ims_var = runtime_utils.to_channels_last(ims_var, cfg.channels_last)
+        labels_t = transer_var_tensor(labels.long(), device_id)
         labels_var = Variable(labels_t)
-
-        global_feat, local_feat, logits = model(ims_var)
+        profiler.mark('h2d')
+
+        grad_cache = 0 < cfg.micro_batch_size < ims_var.size(0)
+        if grad_cache:
+            # features of the whole batch without graph, the backward pass
+            # runs micro batch by micro batch in `cached_backward`
+            global_feat, local_feat, logits = model_utils.cached_forward(
+                model, ims_var, cfg.micro_batch_size, cfg)
+        else:
+            with model_utils.autocast(cfg):
+                global_feat, local_feat, logits = model(ims_var)
+            # Mine and compute the losses in float32, the hard example margins
+            # are too small for bfloat16/float16 distances.
+            global_feat = global_feat.float()
+            local_feat = local_feat.float()
+            logits = logits.float()
+        profiler.mark('forward')
+
+        # the triplet losses mine the global batch of all ranks, the id loss
+        # stays on the batch of this rank
+        all_labels = dist_utils.all_gather(labels_t)
+        global_feat = dist_utils.all_gather(global_feat)
+        if cfg.l_loss_weight > 0:
+            local_feat = dist_utils.all_gather(local_feat)
 
         # init loss value
         g_loss = 0
@@ -76,7 +126,7 @@ def train(train_loader, model, loss_dict, optimizer, epoch, cfg):
 
         # gloabl
         g_loss, p_inds, n_inds, g_dist_ap, g_dist_an, g_dist_mat = loss.global_loss(
-            loss_dict['g_tri_loss'], global_feat, labels_t,
+            loss_dict['g_tri_loss'], global_feat, all_labels,
             normalize_feature=cfg.normalize_feature)
 
         if cfg.l_loss_weight == 0:
@@ -84,11 +134,11 @@ def train(train_loader, model, loss_dict, optimizer, epoch, cfg):
         elif cfg.local_dist_own_hard_sample:
             # Let local distance find its own hard samples.
             l_loss, l_dist_ap, l_dist_an, _ = loss.local_loss(
-                loss_dict['l_tri_loss'], local_feat, None, None, labels_t,
+                loss_dict['l_tri_loss'], local_feat, None, None, all_labels,
                 normalize_feature=cfg.normalize_feature)
         else:
             l_loss, l_dist_ap, l_dist_an = loss.local_loss(
-                loss_dict['l_tri_loss'], local_feat, p_inds, n_inds, labels_t,
+                loss_dict['l_tri_loss'], local_feat, p_inds, n_inds, all_labels,
                 normalize_feature=cfg.normalize_feature)
             
         # id loss
@@ -99,10 +149,21 @@ def train(train_loader, model, loss_dict, optimizer, epoch, cfg):
         total_loss = g_loss * cfg.g_loss_weight \
                 + l_loss * cfg.l_loss_weight \
                 + id_loss * cfg.id_loss_weight 
+        profiler.mark('loss')
 
         optimizer.zero_grad()
-        total_loss.backward()
-        optimizer.step()
+        scaler.scale(total_loss).backward()
+        if grad_cache:
+            model_utils.cached_backward(model, ims_var,
+                [global_feat, local_feat, logits], cfg.micro_batch_size, cfg)
+        profiler.mark('backward')
+        scaler.step(optimizer)
+        scaler.update()
+        profiler.mark('optimizer')
+
+        # feed the id centroids of the hard id sampler
+        if cfg.hard_id_mining:
+            train_loader.batch_sampler.update(all_labels, global_feat.data)
 
         # precision
         g_prec = (g_dist_an > g_dist_ap).data.float().mean()
@@ -111,11 +172,14 @@ def train(train_loader, model, loss_dict, optimizer, epoch, cfg):
         g_d_ap = g_dist_ap.data.mean()
         g_d_an = g_dist_an.data.mean()
 
-        meter_dict['g_prec_meter'].update(g_prec)
-        meter_dict['g_m_meter'].update(g_m)
-        meter_dict['g_dist_ap_meter'].update(g_d_ap)
-        meter_dict['g_dist_an_meter'].update(g_d_an)
-        meter_dict['g_loss_meter'].update(common_utils.to_scalar(g_loss))
+        step_metrics = dict(
+            g_prec_meter=g_prec,
+            g_m_meter=g_m,
+            g_dist_ap_meter=g_d_ap,
+            g_dist_an_meter=g_d_an,
+            g_loss_meter=g_loss,
+            id_loss_meter=id_loss,
+            loss_meter=total_loss)
 
         if cfg.l_loss_weight > 0:
             # precision
@@ -125,26 +189,38 @@ def train(train_loader, model, loss_dict, optimizer, epoch, cfg):
             l_d_ap = l_dist_ap.data.mean()
             l_d_an = l_dist_an.data.mean()
 
-            meter_dict['l_prec_meter'].update(l_prec)
-            meter_dict['l_m_meter'].update(l_m)
-            meter_dict['l_dist_ap_meter'].update(l_d_ap)
-            meter_dict['l_dist_an_meter'].update(l_d_an)
-            meter_dict['l_loss_meter'].update(common_utils.to_scalar(l_loss))
-
+            step_metrics.update(
+                l_prec_meter=l_prec,
+                l_m_meter=l_m,
+                l_dist_ap_meter=l_d_ap,
+                l_dist_an_meter=l_d_an,
+                l_loss_meter=l_loss)
 
-        if cfg.id_loss_weight > 0:
-            meter_dict['id_loss_meter'].update(common_utils.to_scalar(id_loss))
+        metrics.update(**step_metrics)
 
-        meter_dict['loss_meter'].update(common_utils.to_scalar(total_loss))
+        throughput = timer.step_done(ims.size(0))
+        num_ims += ims.size(0)
+        data_wait += throughput['data_wait']
+        if logger is not None:
+            logger.add_scalars('throughput', throughput,
+                               epoch * len(train_loader) + step)
 
         # step log
+        if step % cfg.log_steps == 0 and step != 0:
+            metrics.sync()
         step_log(meter_dict, step_start, cfg, epoch, step)
+        profiler.step()
     # Epoch Log 
-    epoch_log(meter_dict, epoch_start, cfg, epoch)
+    metrics.sync()
+    epoch_log(meter_dict, epoch_start, cfg, epoch, num_ims, data_wait)
     # tensorboar log
-    tensorBoard_log(meter_dict, cfg, epoch, writer=None)
+    tensorBoard_log(meter_dict, cfg, epoch, writer=logger)
     # save ckpt
-    model_utils.save_ckpt(model, optimizer, epoch + 1, cfg.ckpt_file)
+    # written in the background, training goes on with the next epoch; the
+    # ranks hold the same weights, rank 0 saves them
+    if dist_utils.is_main_process():
+        model_utils.save_ckpt(model, optimizer, epoch + 1, cfg.ckpt_file,
+                              writer=model_utils.checkpoint_writer(), keep=cfg.ckpt_keep)
 
 
 def step_log(meter_dict, step_start, cfg, epoch, step):
@@ -202,7 +278,7 @@ def step_log(meter_dict, step_start, cfg, epoch, step):
 
 
 
-def epoch_log(meter_dict, epoch_start, cfg, epoch):
+def epoch_log(meter_dict, epoch_start, cfg, epoch, num_ims=0, data_wait=0.):
     '''
     Log every epoch
     args:
@@ -210,8 +286,12 @@ def epoch_log(meter_dict, epoch_start, cfg, epoch):
         epoch_start: start time of the epoch 
         cfg: config 
         epoch: current epoch
+        num_ims: images trained on in the epoch
+        data_wait: seconds spent waiting for the data loader
     '''
-    time_log = 'epoch {}, {:.2f}s'.format(epoch + 1, time.time() - epoch_start, )
+    epoch_time = time.time() - epoch_start
+    time_log = 'epoch {}, {:.2f}s, {:.1f} ims/s, data wait {:.2f}s'.format(
+        epoch + 1, epoch_time, num_ims / max(epoch_time, 1e-12), data_wait)
 
     g_log = ''
     l_log = ''
@@ -257,13 +337,14 @@ def tensorBoard_log(meter_dict, cfg, epoch, writer=None):
         meter_dict: meters data
         cfg: config 
         epoch: current epoch
-        writer: the writer used to write log for tensorboard
+        writer: the ScalarLogger of the run, see `scalar_logger`
     '''
     if not cfg.log_to_file:
         return
         
     if writer is None:
-        writer = SummaryWriter(log_dir=osp.join(cfg.exp_dir, 'tensorboard'))
+        writer = scalar_logger(
+            osp.join(cfg.exp_dir, 'tensorboard'), cfg.log_flush_secs)
     
     writer.add_scalars(
         'total_loss',
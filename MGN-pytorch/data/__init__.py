@@ -2,8 +2,10 @@ from importlib import import_module
 from torchvision import transforms
 from utils.random_erasing import RandomErasing
 from utils.color_augment import ColorAugmentation
-from data.sampler import RandomSampler
+from reid_common.sampler import BatchSampler, HardIdentityBatchSampler, DistributedBatchSampler
 from torch.utils.data import dataloader
+from reid_common.runtime_utils import WorkerAffinity
+from reid_common.dist_utils import get_rank, get_world_size, shared_seed
 
 class Data:
     def __init__(self, args):
@@ -16,28 +18,52 @@ class Data:
         train_list += [transforms.ToTensor()]
         train_list += [transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])]
         if args.color_jitter:
-            train_list.append(transforms.ColorJitter(brghtness=0.2, contrast=0.15, 
+            train_list.append(transforms.ColorJitter(brightness=0.2, contrast=0.15, 
                                                     saturation=0, hue=0))
         if args.color_augment:
             train_list.append(ColorAugmentation())
 
         if args.random_erasing:
             train_list.append(RandomErasing())
-        
+        train_transform = transforms.Compose(train_list)
+
         test_transform = transforms.Compose([
             transforms.Resize((args.height, args.width), interpolation=3),
             transforms.ToTensor(),
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
         ])
 
+        worker_init_fn = WorkerAffinity(args.num_threads) if args.pin_workers else None
+
         if not args.test_only:
             module_train = import_module('data.' + args.data_train.lower())
             self.trainset = getattr(module_train, args.data_train)(args, train_transform, 'train')
+            # with --distributed, the identities of all ranks drawn the same
+            # on every rank, then split by DistributedBatchSampler
+            world_size = get_world_size() if args.distributed else 1
+            seed = shared_seed() if args.distributed else None
+            if args.hard_id_mining:
+                batch_sampler = HardIdentityBatchSampler(self.trainset.labels, args.batchid * world_size,
+                                                         args.batchimage,
+                                                         cams=self.trainset.cameras,
+                                                         hard_ratio=args.hard_ratio,
+                                                         momentum=args.centroid_momentum,
+                                                         drop_last=args.distributed,
+                                                         seed=seed)
+            else:
+                batch_sampler = BatchSampler(self.trainset.labels, args.batchid * world_size,
+                                             args.batchimage,
+                                             cams=self.trainset.cameras,
+                                             id_weight=args.id_weight,
+                                             cam_balanced=args.cam_balanced,
+                                             drop_last=args.distributed,
+                                             seed=seed)
+            if args.distributed:
+                batch_sampler = DistributedBatchSampler(batch_sampler, world_size, get_rank())
             self.train_loader = dataloader.DataLoader(self.trainset,
-                            sampler=RandomSampler(self.trainset,args.batchid,batch_image=args.batchimage),
-                            #shuffle=True,
-                            batch_size=args.batchid * args.batchimage,
-                            num_workers=args.nThread)
+                            batch_sampler=batch_sampler,
+                            num_workers=args.nThread,
+                            worker_init_fn=worker_init_fn)
         else:
             self.train_loader = None
         
@@ -49,6 +75,9 @@ class Data:
         else:
             raise Exception()
 
-        self.test_loader = dataloader.DataLoader(self.testset, batch_size=args.batchtest, num_workers=args.nThread)
-        self.query_loader = dataloader.DataLoader(self.queryset, batch_size=args.batchtest, num_workers=args.nThread)
+        pin_memory = args.prefetch_test and not args.cpu
+        self.test_loader = dataloader.DataLoader(self.testset, batch_size=args.batchtest, num_workers=args.nThread,
+                                                 pin_memory=pin_memory, worker_init_fn=worker_init_fn)
+        self.query_loader = dataloader.DataLoader(self.queryset, batch_size=args.batchtest, num_workers=args.nThread,
+                                                  pin_memory=pin_memory, worker_init_fn=worker_init_fn)
         
\ No newline at end of file
@@ -3,6 +3,8 @@
 import os
 import re
 
+import numpy as np
+
 def list_pictures(directory, ext='jpg|jpeg|bmp|png|ppm'):
     assert os.path.isdir(directory), 'dataset is not exists!{}'.format(directory)
 
@@ -10,3 +12,59 @@ def list_pictures(directory, ext='jpg|jpeg|bmp|png|ppm'):
                    for root, _, files in os.walk(directory) for f in files
                    if re.match(r'([\w]+\.(?:' + ext + '))', f)])
 
+def manifest_path(directory):
+    """
+    The manifest lives next to the directory rather than inside it, so writing
+    it does not touch the mtimes it is validated against.
+    """
+    return os.path.normpath(directory) + '.manifest.npz'
+
+def walked_dirs(directory):
+    """
+    :return: the directory and all its subdirectories, relative to it; the
+             directories `list_pictures` walks
+    """
+    return sorted(os.path.relpath(root, directory) for root, _, _ in os.walk(directory))
+
+def load_manifest(directory):
+    """
+    :param directory: dataset directory the manifest was written for
+    :return: dict of the saved columns, or None if the manifest is missing or
+             any walked directory changed (an entry added, removed or
+             renamed) since it was written
+    """
+    path = manifest_path(directory)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with np.load(path) as manifest:
+            columns = {key: manifest[key] for key in manifest.files}
+    except (IOError, OSError, ValueError):
+        return None
+    if 'dirs' not in columns or 'mtimes' not in columns:
+        return None
+    # a new subdirectory changes the mtime of its parent, which is recorded
+    for rel_dir, mtime in zip(columns.pop('dirs'), columns.pop('mtimes')):
+        try:
+            if os.stat(os.path.join(directory, rel_dir)).st_mtime != mtime:
+                return None
+        except OSError:
+            return None
+    return columns
+
+def save_manifest(directory, **columns):
+    """
+    Persist per-image columns (names relative to `directory`, ids, cameras...)
+    so that the next start skips the directory walk. The mtime of every walked
+    directory is recorded to validate it. An unwritable dataset location is
+    not an error, the manifest is simply not written.
+    """
+    path = manifest_path(directory)
+    tmp_path = path + '.tmp.npz'
+    try:
+        dirs = walked_dirs(directory)
+        mtimes = [os.stat(os.path.join(directory, d)).st_mtime for d in dirs]
+        np.savez(tmp_path, dirs=np.array(dirs), mtimes=np.array(mtimes, dtype=np.float64), **columns)
+        os.replace(tmp_path, path)
+    except (IOError, OSError):
+        pass
@@ -1,4 +1,8 @@
-from data.common import list_pictures
+import os
+
+import numpy as np
+
+from data.common import list_pictures, load_manifest, save_manifest
 
 from torch.utils.data import dataset
 from torchvision.datasets.folder import default_loader
@@ -17,14 +21,13 @@ class Market1501(dataset.Dataset):
         else:
             data_path += '/query'
 
-        
-        self.imgs = [path for path in list_pictures(data_path) if self.id(path) != -1]
+        self.imgs, self._ids, self._cams = self._index(data_path, args.no_manifest)
 
-        self._id2label = {_id: idx for idx, _id in enumerate(self.unique_ids)}
+        self._unique_ids, self._labels = np.unique(self._ids, return_inverse=True)
 
     def __getitem__(self, index):
         path = self.imgs[index]
-        target = self._id2label[self.id(path)]
+        target = int(self._labels[index])
 
         img = self.loader(path)
         if self.transform is not None:
@@ -35,6 +38,30 @@ class Market1501(dataset.Dataset):
     def __len__(self):
         return len(self.imgs)
 
+    def _index(self, data_path, no_manifest=False):
+        """
+        :param data_path: image directory of one split
+        :param no_manifest: walk the directory even if a fresh manifest exists
+        :return: image paths, person ids and camera ids (junk images removed)
+        """
+        manifest = None if no_manifest else load_manifest(data_path)
+        if manifest is not None:
+            names = manifest['names']
+            ids = manifest['ids']
+            cams = manifest['cams']
+        else:
+            paths = list_pictures(data_path)
+            names = np.array([os.path.relpath(path, data_path) for path in paths])
+            ids = np.array([self.id(path) for path in paths], dtype=np.int64)
+            cams = np.array([self.camera(path) for path in paths], dtype=np.int64)
+            keep = ids != -1
+            names, ids, cams = names[keep], ids[keep], cams[keep]
+            if not no_manifest:
+                save_manifest(data_path, names=names, ids=ids, cams=cams)
+
+        imgs = [os.path.join(data_path, name) for name in names]
+        return imgs, ids, cams
+
     @staticmethod
     def id(file_path):
         """
@@ -54,20 +81,27 @@ class Market1501(dataset.Dataset):
     @property
     def ids(self):
         """
-        :return: person id list corresponding to dataset image paths
+        :return: person id array corresponding to dataset image paths
         """
-        return [self.id(path) for path in self.imgs]
+        return self._ids
 
     @property
     def unique_ids(self):
         """
         :return: unique person ids in ascending order
         """
-        return sorted(set(self.ids))
+        return self._unique_ids
 
     @property
     def cameras(self):
         """
-        :return: camera id list corresponding to dataset image paths
+        :return: camera id array corresponding to dataset image paths
+        """
+        return self._cams
+
+    @property
+    def labels(self):
+        """
+        :return: training label (index into `unique_ids`) of every image
         """
-        return [self.camera(path) for path in self.imgs]
+        return self._labels
@@ -1,6 +1,5 @@
 import os
 import numpy as np
-from importlib import import_module
 
 import matplotlib
 matplotlib.use('Agg')
@@ -9,7 +8,8 @@ import matplotlib.pyplot as plt
 import torch
 import torch.nn as nn
 
-from loss.triplet import TripletLoss, TripletSemihardLoss
+from loss.triplet import TripletLoss
+from reid_common.dist_utils import all_gather
 
 class Loss(nn.modules.loss._Loss):
     def __init__(self, args, ckpt):
@@ -25,7 +25,7 @@ class Loss(nn.modules.loss._Loss):
             if loss_type == 'CrossEntropy':
                 loss_function = nn.CrossEntropyLoss()
             elif loss_type == 'Triplet':
-                loss_function = TripletLoss(args.margin)
+                loss_function = TripletLoss(args.margin, mining=args.triplet_mining)
 
             self.loss.append({
                 'type': loss_type,
@@ -43,6 +43,8 @@ class Loss(nn.modules.loss._Loss):
                 self.loss_module.append(l['function'])
 
         self.log = torch.Tensor()
+        # running sums of the epoch on the loss device, see sync_log
+        self.running = None
 
         device = torch.device('cpu' if args.cpu else 'cuda')
         self.loss_module.to(device)
@@ -57,32 +59,49 @@ class Loss(nn.modules.loss._Loss):
         losses = []
         for i, l in enumerate(self.loss):
             if self.args.model == 'MGN' and l['type'] == 'Triplet':
-                loss = [l['function'](output, labels) for output in outputs[1:4]]
-                loss = sum(loss) / len(loss)
+                # mean over the three global features, whose distances
+                # are computed in one batched call; with --distributed they
+                # are mined over the batches of all ranks
+                loss = l['function']([all_gather(o) for o in outputs[1:4]], all_gather(labels))
                 effective_loss = l['weight'] * loss
                 losses.append(effective_loss)
-                self.log[-1, i] += effective_loss.item()
+                self.accumulate(i, effective_loss)
             elif self.args.model == 'MGN' and l['function'] is not None:
                 loss = [l['function'](output, labels) for output in outputs[4:]]
                 loss = sum(loss) / len(loss)
                 effective_loss = l['weight'] * loss
                 losses.append(effective_loss)
-                self.log[-1, i] += effective_loss.item()
+                self.accumulate(i, effective_loss)
             else:
                 pass
         loss_sum = sum(losses)
         if len(self.loss) > 1:
-            self.log[-1, -1] += loss_sum.item()
+            self.accumulate(-1, loss_sum)
 
         return loss_sum
 
+    def accumulate(self, i, loss):
+        # summed on the device, .item() would wait for the device every step
+        if self.running is None:
+            self.running = torch.zeros(len(self.loss), device=loss.device)
+        self.running[i] += loss.detach()
+
+    def sync_log(self):
+        """Copy the running sums of the epoch to the host log."""
+        if self.running is not None:
+            self.log[-1] = self.running.cpu()
+
     def start_log(self):
         self.log = torch.cat((self.log, torch.zeros(1, len(self.loss))))
+        self.running = None
 
     def end_log(self, batches):
+        self.sync_log()
+        self.running = None
         self.log[-1].div_(batches)
 
     def display_loss(self, batch):
+        self.sync_log()
         n_samples = batch + 1
         log = []
         for l, c in zip(self.loss, self.log[-1]):
@@ -90,13 +109,14 @@ class Loss(nn.modules.loss._Loss):
 
         return ''.join(log)
 
-    def plot_loss(self, apath, epoch):
+    def plot_loss(self, apath, epoch, log=None):
+        log = self.log if log is None else log
         axis = np.linspace(1, epoch, epoch)
         for i, l in enumerate(self.loss):
             label = '{} Loss'.format(l['type'])
             fig = plt.figure()
             plt.title(label)
-            plt.plot(axis, self.log[:, i].numpy(), label=label)
+            plt.plot(axis, log[:, i].numpy(), label=label)
             plt.legend()
             plt.xlabel('Epochs')
             plt.ylabel('Loss')
@@ -115,7 +135,11 @@ class Loss(nn.modules.loss._Loss):
         else:
             return self.loss_module.module
 
-    def save(self, apath):
+    def save(self, apath, writer=None):
+        if writer is not None:
+            writer.save(self.state_dict(), os.path.join(apath, 'loss.pt'))
+            writer.save(self.log, os.path.join(apath, 'loss_log.pt'))
+            return
         torch.save(self.state_dict(), os.path.join(apath, 'loss.pt'))
         torch.save(self.log, os.path.join(apath, 'loss_log.pt'))
 
@@ -4,95 +4,130 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
-class TripletSemihardLoss(nn.Module):
+
+def pairwise_distance(inputs):
     """
-    Shape:
-        - Input: :math:`(N, C)` where `C = number of channels`
-        - Target: :math:`(N)`
-        - Output: scalar.
+    Args:
+        inputs: features with shape (batch_size, feat_dim), or
+            (branches, batch_size, feat_dim) to compute all branches at once
+    Returns:
+        euclidean distances with shape (batch_size, batch_size), or
+        (branches, batch_size, batch_size)
     """
+    squeeze = inputs.dim() == 2
+    if squeeze:
+        inputs = inputs.unsqueeze(0)
+    square = torch.pow(inputs, 2).sum(dim=-1, keepdim=True)
+    dist = torch.baddbmm(square + square.transpose(1, 2), inputs, inputs.transpose(1, 2),
+                         beta=1, alpha=-2)
+    dist = dist.clamp(min=1e-12).sqrt()  # for numerical stability
+    return dist[0] if squeeze else dist
 
-    def __init__(self, device, margin=0, size_average=True):
-        super(TripletSemihardLoss, self).__init__()
-        self.margin = margin
-        self.size_average = size_average
-        self.device = device
-
-    def forward(self, input, target):
-        y_true = target.int().unsqueeze(-1)
-        same_id = torch.eq(y_true, y_true.t()).type_as(input)
-
-        pos_mask = same_id
-        neg_mask = 1 - same_id
-
-        def _mask_max(input_tensor, mask, axis=None, keepdims=False):
-            input_tensor = input_tensor - 1e6 * (1 - mask)
-            _max, _idx = torch.max(input_tensor, dim=axis, keepdim=keepdims)
-            return _max, _idx
-
-        def _mask_min(input_tensor, mask, axis=None, keepdims=False):
-            input_tensor = input_tensor + 1e6 * (1 - mask)
-            _min, _idx = torch.min(input_tensor, dim=axis, keepdim=keepdims)
-            return _min, _idx
-
-        # output[i, j] = || feature[i, :] - feature[j, :] ||_2
-        dist_squared = torch.sum(input ** 2, dim=1, keepdim=True) + \
-                       torch.sum(input.t() ** 2, dim=0, keepdim=True) - \
-                       2.0 * torch.matmul(input, input.t())
-        dist = dist_squared.clamp(min=1e-16).sqrt()
-
-        pos_max, pos_idx = _mask_max(dist, pos_mask, axis=-1)
-        neg_min, neg_idx = _mask_min(dist, neg_mask, axis=-1)
-
-        # loss(x, y) = max(0, -y * (x1 - x2) + margin)
-        y = torch.ones(same_id.size()[0]).to(self.device)
-        return F.margin_ranking_loss(neg_min.float(),
-                                     pos_max.float(),
-                                     y,
-                                     self.margin,
-                                     self.size_average)
 
 class TripletLoss(nn.Module):
-    """Triplet loss with hard positive/negative mining.
+    """Triplet loss with batch-hard, batch-all or semi-hard mining.
 
     Reference:
     Hermans et al. In Defense of the Triplet Loss for Person Re-Identification. arXiv:1703.07737.
+    Schroff et al. FaceNet: A Unified Embedding for Face Recognition and Clustering. arXiv:1503.03832.
 
     Code imported from https://github.com/Cysu/open-reid/blob/master/reid/loss/triplet.py.
+    The mining is done with masked reductions over the whole distance matrix,
+    batch-all and semi-hard over blocks of `anchor_block` anchors.
 
     Args:
         margin (float): margin for triplet.
+        mining (str): 'batch_hard', the hardest positive and negative of every
+            anchor; 'batch_all', the mean over all triplets that violate the
+            margin; 'semihard', for every positive pair the closest negative
+            farther than the positive (the farthest negative if none is).
     """
-    def __init__(self, margin=0.3, mutual_flag = False):
+    anchor_block = 32
+
+    def __init__(self, margin=0.3, mutual_flag = False, mining='batch_hard'):
         super(TripletLoss, self).__init__()
+        assert mining in ('batch_hard', 'batch_all', 'semihard')
         self.margin = margin
         self.ranking_loss = nn.MarginRankingLoss(margin=margin)
         self.mutual = mutual_flag
+        self.mining = mining
 
     def forward(self, inputs, targets):
         """
         Args:
-            inputs: feature matrix with shape (batch_size, feat_dim)
+            inputs: feature matrix with shape (batch_size, feat_dim), or a list
+                of feature matrices of the same samples (e.g. the global
+                features of the branches), whose losses are averaged; their
+                distances are computed in one batched call
             targets: ground truth labels with shape (num_classes)
         """
-        n = inputs.size(0)
-        #inputs = 1. * inputs / (torch.norm(inputs, 2, dim=-1, keepdim=True).expand_as(inputs) + 1e-12)
-        # Compute pairwise distance, replace by the official when merged
-        dist = torch.pow(inputs, 2).sum(dim=1, keepdim=True).expand(n, n)
-        dist = dist + dist.t()
-        dist.addmm_(1, -2, inputs, inputs.t())
-        dist = dist.clamp(min=1e-12).sqrt()  # for numerical stability
+        squeeze = not isinstance(inputs, (list, tuple))
+        inputs = inputs.unsqueeze(0) if squeeze else torch.stack(inputs)
+        # shape (branches, n, n)
+        dist = pairwise_distance(inputs)
+        # shape (n, n), broadcast over the branches
+        is_pos = targets.unsqueeze(0).eq(targets.unsqueeze(1))
+
+        if self.mining == 'batch_hard':
+            loss = self.batch_hard(dist, is_pos)
+        elif self.mining == 'batch_all':
+            loss = self.batch_all(dist, is_pos)
+        else:
+            loss = self.semihard(dist, is_pos)
+        if self.mutual:
+            return loss, dist[0] if squeeze else dist
+        return loss
+
+    def batch_hard(self, dist, is_pos):
         # For each anchor, find the hardest positive and negative
-        mask = targets.expand(n, n).eq(targets.expand(n, n).t())
-        dist_ap, dist_an = [], []
-        for i in range(n):
-            dist_ap.append(dist[i][mask[i]].max().unsqueeze(0))
-            dist_an.append(dist[i][mask[i] == 0].min().unsqueeze(0))
-        dist_ap = torch.cat(dist_ap)
-        dist_an = torch.cat(dist_an)
-        # Compute ranking hinge loss
+        dist_ap = dist.masked_fill(~is_pos, float('-inf')).max(dim=-1)[0]
+        dist_an = dist.masked_fill(is_pos, float('inf')).min(dim=-1)[0]
+        # Compute ranking hinge loss, the branches have the same number of
+        # anchors, so this is the mean of the branch losses
         y = torch.ones_like(dist_an)
-        loss = self.ranking_loss(dist_an, dist_ap, y)
-        if self.mutual:
-            return loss, dist
-        return loss
\ No newline at end of file
+        return self.ranking_loss(dist_an.view(-1), dist_ap.view(-1), y.view(-1))
+
+    def batch_all(self, dist, is_pos):
+        n = is_pos.size(0)
+        eye = torch.eye(n, dtype=torch.bool, device=is_pos.device)
+        pos_pairs = is_pos & ~eye
+        is_neg = ~is_pos
+        total = dist.new_zeros(dist.size(0))
+        num_active = dist.new_zeros(dist.size(0))
+        # a block of anchors at a time, the (anchor, positive, negative) cube
+        # of the whole batch grows with n ** 3
+        for start in range(0, n, self.anchor_block):
+            end = min(start + self.anchor_block, n)
+            block = dist[:, start:end]
+            # shape (a, n, n): (anchor, positive, negative)
+            valid = pos_pairs[start:end].unsqueeze(2) & is_neg[start:end].unsqueeze(1)
+            # shape (branches, a, n, n)
+            loss = F.relu(block.unsqueeze(3) - block.unsqueeze(2) + self.margin)
+            loss = loss.masked_fill(~valid, 0)
+            total = total + loss.sum(dim=(1, 2, 3))
+            num_active = num_active + (loss > 1e-16).float().sum(dim=(1, 2, 3))
+        # average over the triplets that still violate the margin
+        return (total / num_active.clamp(min=1)).mean()
+
+    def semihard(self, dist, is_pos):
+        n = is_pos.size(0)
+        eye = torch.eye(n, dtype=torch.bool, device=is_pos.device)
+        pos_pairs = is_pos & ~eye
+        is_neg = ~is_pos
+        total = dist.new_zeros(dist.size(0))
+        # a block of anchors at a time, as in batch_all
+        for start in range(0, n, self.anchor_block):
+            end = min(start + self.anchor_block, n)
+            block = dist[:, start:end]
+            # shape (branches, a, n, n): for (anchor, positive), the negatives
+            # farther than the positive
+            outside = is_neg[start:end].unsqueeze(1) & (block.unsqueeze(2) > block.unsqueeze(3))
+            # shape (branches, a, n): the closest of them
+            semihard_an = block.unsqueeze(2).masked_fill(~outside, float('inf')).min(dim=-1)[0]
+            # shape (branches, a, 1): the farthest negative of every anchor
+            farthest_an = block.masked_fill(~is_neg[start:end], float('-inf')).max(dim=-1, keepdim=True)[0]
+            dist_an = torch.where(torch.isinf(semihard_an), farthest_an.expand_as(semihard_an), semihard_an)
+            loss = F.relu(block - dist_an + self.margin).masked_fill(~pos_pairs[start:end], 0)
+            total = total + loss.sum(dim=(1, 2))
+        # average over the positive pairs
+        return (total / pos_pairs.sum().clamp(min=1).float()).mean()
@@ -1,3 +1,7 @@
+import os
+import sys
+# the repository root, for the reid_common package
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import data
 import loss
 import torch
@@ -6,6 +10,23 @@ from trainer import Trainer
 
 from option import args
 import utils.utility as utility
+import reid_common.dist_utils as dist_utils
+import reid_common.runtime_utils as runtime_utils
+import reid_common.export_utils as export_utils
+
+local_rank, local_world_size = dist_utils.get_local_rank() if args.distributed else (0, 1)
+runtime_utils.configure_runtime(args.num_threads, args.interop_threads, args.pin_workers,
+	local_rank, local_world_size)
+if args.distributed:
+	dist_utils.init_distributed('gloo', args.dist_timeout)
+if args.tune_runtime:
+	from importlib import import_module
+	device = torch.device('cpu' if args.cpu else 'cuda')
+	make_model = lambda: import_module('model.' + args.model.lower()).make_model(args).to(device)
+	thread_counts = [int(n) for n in args.tune_threads.split(',') if n != ''] or \
+		[2 ** i for i in range(os.cpu_count().bit_length())]
+	runtime_utils.tune_runtime(make_model, (args.height, args.width), args.batchtest, thread_counts)
+	exit()
 
 ckpt = utility.checkpoint(args)
 
@@ -15,8 +36,20 @@ loss = loss.Loss(args, ckpt) if not args.test_only else None
 trainer = Trainer(args, model, loss, loader, ckpt)
 
 n = 0
-while not trainer.terminate():
+export = args.export_single_branch or args.export_torchscript or args.export_onnx or args.quantize
+if args.quantize and not trainer.quantize():
+	exit(1)
+if args.export_single_branch != '':
+	trainer.export_single_branch(args.export_single_branch)
+if args.export_torchscript != '' or args.export_onnx != '':
+	export_utils.export_model(model.get_model(), (args.height, args.width), args.export_mode,
+		torchscript_file=args.export_torchscript, onnx_file=args.export_onnx,
+		optimize=args.export_optimize)
+while not export and not trainer.terminate():
 	n += 1
 	trainer.train()
 	if args.test_every!=0 and n%args.test_every==0:
-		trainer.test()
+		# only rank 0 tests and saves, the other ranks wait for it
+		if dist_utils.is_main_process():
+			trainer.test()
+		dist_utils.barrier()
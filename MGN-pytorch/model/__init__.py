@@ -12,11 +12,20 @@ class Model(nn.Module):
         self.device = torch.device('cpu' if args.cpu else 'cuda')
         self.nGPU = args.nGPU
         self.save_models = args.save_models
+        self.keep_models = args.keep_models
 
         module = import_module('model.' + args.model.lower())
         self.model = module.make_model(args).to(self.device)
+        if args.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
 
-        if not args.cpu and args.nGPU > 1:
+        if args.distributed:
+            assert args.cpu, '--distributed trains on cpu, over gloo'
+            assert args.micro_batch == 0, 'micro batches are not supported with --distributed'
+            # the classifiers get no gradient without the CrossEntropy loss
+            self.model = nn.parallel.DistributedDataParallel(
+                self.model, find_unused_parameters='CrossEntropy' not in args.loss)
+        elif not args.cpu and args.nGPU > 1:
             self.model = nn.DataParallel(self.model, range(args.nGPU))
 
         self.load(
@@ -26,17 +35,34 @@ class Model(nn.Module):
             cpu=args.cpu
         )
 
-    def forward(self, x):
-        return self.model(x)
+    def forward(self, x, mode='train'):
+        return self.model(x, mode=mode)
 
     def get_model(self):
-        if self.nGPU == 1:
-            return self.model
-        else:
+        if isinstance(self.model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
             return self.model.module
+        else:
+            return self.model
 
-    def save(self, apath, epoch, is_best=False):
+    def save(self, apath, epoch, is_best=False, writer=None):
         target = self.get_model()
+        if writer is not None:
+            # best and per epoch models are hard links of the latest one
+            links = []
+            if is_best:
+                links.append(os.path.join(apath, 'model', 'model_best.pt'))
+            if self.save_models:
+                links.append(os.path.join(apath, 'model', 'model_{}.pt'.format(epoch)))
+            rotate = None
+            if self.save_models and self.keep_models > 0:
+                rotate = (os.path.join(apath, 'model', 'model_[0-9]*.pt'), self.keep_models)
+            writer.save(
+                target.state_dict(),
+                os.path.join(apath, 'model', 'model_latest.pt'),
+                links, rotate
+            )
+            return
+
         torch.save(
             target.state_dict(), 
             os.path.join(apath, 'model', 'model_latest.pt')
@@ -1,4 +1,5 @@
 import copy
+from collections import OrderedDict
 
 import torch
 from torch import nn
@@ -9,12 +10,332 @@ from torchvision.models.resnet import resnet50, Bottleneck
 def make_model(args):
     return MGN(args)
 
+
+REDUCTION_NAMES = ['reduction_{}'.format(i) for i in range(8)]
+CLASSIFIER_NAMES = ['fc_id_2048_0', 'fc_id_2048_1', 'fc_id_2048_2',
+                    'fc_id_256_1_0', 'fc_id_256_1_1', 'fc_id_256_2_0', 'fc_id_256_2_1', 'fc_id_256_2_2']
+BN_KEYS = ['weight', 'bias', 'running_mean', 'running_var']
+
+
+class FusedReduction(nn.Module):
+    """
+    Several reduction blocks (1x1 conv, BatchNorm, ReLU on pooled [B, C, 1, 1]
+    features) as one batched matmul and one BatchNorm over all their
+    channels, which normalizes every channel on its own like the separate
+    blocks do.
+    Args:
+        reduction: the initialized block, every group starts as a copy of it
+        groups: number of blocks
+    """
+
+    def __init__(self, reduction, groups):
+        super(FusedReduction, self).__init__()
+        conv, bn = reduction[0], reduction[1]
+        self.groups = groups
+        self.out_channels = conv.out_channels
+        # shape [groups, out, in]
+        self.weight = nn.Parameter(conv.weight.data.flatten(1).unsqueeze(0).repeat(groups, 1, 1))
+        self.bn = nn.BatchNorm1d(groups * self.out_channels, eps=bn.eps, momentum=bn.momentum)
+        for key in BN_KEYS:
+            getattr(self.bn, key).data.copy_(getattr(bn, key).data.repeat(groups))
+
+    def forward(self, x, groups=None):
+        """
+        Args:
+            x: shape [groups, B, in]
+            groups: number of blocks applied, the first ones; all of them
+                when None. Given as an int rather than read from x, so the
+                module still traces with torch.fx (--quantize)
+        Returns:
+            shape [groups, B, out]
+        """
+        groups = self.groups if groups is None else groups
+        batch = x.size(1)
+        x = torch.bmm(x, self.weight[:groups].transpose(1, 2))
+        x = x.transpose(0, 1).reshape(batch, -1)
+        if groups == self.groups:
+            x = self.bn(x)
+        else:
+            # the first groups only, on their slice of the BatchNorm
+            channels, bn = groups * self.out_channels, self.bn
+            x = F.batch_norm(x, bn.running_mean[:channels], bn.running_var[:channels],
+                             bn.weight[:channels], bn.bias[:channels],
+                             bn.training, bn.momentum, bn.eps)
+        x = F.relu(x)
+        return x.view(batch, groups, -1).transpose(0, 1)
+
+    def legacy_state(self, state_dict, prefix, parent_prefix):
+        """Pop the fused entries of a state dict, return the separate ones."""
+        legacy = {}
+        weight = state_dict.pop(prefix + 'weight')
+        bn = dict((key, state_dict.pop(prefix + 'bn.' + key)) for key in BN_KEYS)
+        num_batches_tracked = state_dict.pop(prefix + 'bn.num_batches_tracked', None)
+        for g, name in enumerate(REDUCTION_NAMES):
+            legacy[parent_prefix + name + '.0.weight'] = weight[g].unsqueeze(-1).unsqueeze(-1)
+            for key in BN_KEYS:
+                legacy[parent_prefix + name + '.1.' + key] = bn[key].view(self.groups, -1)[g]
+            if num_batches_tracked is not None:
+                legacy[parent_prefix + name + '.1.num_batches_tracked'] = num_batches_tracked
+        return legacy
+
+    @staticmethod
+    def fuse_state(state_dict, parent_prefix, prefix):
+        """Replace the separate entries of a state dict by the fused ones."""
+        names = [parent_prefix + name for name in REDUCTION_NAMES]
+        if any(name + '.0.weight' not in state_dict for name in names):
+            return
+        state_dict[prefix + 'weight'] = torch.stack(
+            [state_dict.pop(name + '.0.weight').flatten(1) for name in names])
+        for key in BN_KEYS:
+            state_dict[prefix + 'bn.' + key] = torch.cat(
+                [state_dict.pop(name + '.1.' + key) for name in names])
+        tracked = [state_dict.pop(name + '.1.num_batches_tracked', None) for name in names]
+        if tracked[0] is not None:
+            state_dict[prefix + 'bn.num_batches_tracked'] = tracked[0]
+
+
+class FusedClassifier(nn.Module):
+    """
+    Several linear classifiers over features of the same size as one batched
+    matmul.
+    """
+
+    def __init__(self, groups, in_features, out_features):
+        super(FusedClassifier, self).__init__()
+        self.groups = groups
+        self.weight = nn.Parameter(torch.empty(groups, out_features, in_features))
+        self.bias = nn.Parameter(torch.zeros(groups, out_features))
+
+    def heads(self):
+        """The classifiers as nn.Linear's sharing the fused parameters, for initialization."""
+        heads = []
+        for g in range(self.groups):
+            fc = nn.Linear(self.weight.size(2), self.weight.size(1))
+            fc.weight.data = self.weight.data[g]
+            fc.bias.data = self.bias.data[g]
+            heads.append(fc)
+        return heads
+
+    def forward(self, x):
+        """
+        Args:
+            x: shape [groups, B, in]
+        Returns:
+            shape [groups, B, out]
+        """
+        return torch.baddbmm(self.bias.unsqueeze(1), x, self.weight.transpose(1, 2))
+
+    def legacy_state(self, state_dict, prefix, parent_prefix):
+        """Pop the fused entries of a state dict, return the separate ones."""
+        weight = state_dict.pop(prefix + 'weight')
+        bias = state_dict.pop(prefix + 'bias')
+        legacy = {}
+        for g, name in enumerate(CLASSIFIER_NAMES):
+            legacy[parent_prefix + name + '.weight'] = weight[g]
+            legacy[parent_prefix + name + '.bias'] = bias[g]
+        return legacy
+
+    @staticmethod
+    def fuse_state(state_dict, parent_prefix, prefix):
+        """Replace the separate entries of a state dict by the fused ones."""
+        names = [parent_prefix + name for name in CLASSIFIER_NAMES]
+        if any(name + '.weight' not in state_dict for name in names):
+            return
+        state_dict[prefix + 'weight'] = torch.stack([state_dict.pop(name + '.weight') for name in names])
+        state_dict[prefix + 'bias'] = torch.stack([state_dict.pop(name + '.bias') for name in names])
+
+
+def grouped_conv(convs):
+    """Convolutions with the same hyper-parameters as one grouped convolution over their stacked channels."""
+    c = convs[0]
+    for other in convs[1:]:
+        assert (other.kernel_size, other.stride, other.padding, other.dilation, other.groups) == \
+            (c.kernel_size, c.stride, c.padding, c.dilation, c.groups), 'branches differ'
+    conv = nn.Conv2d(c.in_channels * len(convs), c.out_channels * len(convs), c.kernel_size,
+                     stride=c.stride, padding=c.padding, dilation=c.dilation,
+                     groups=c.groups * len(convs), bias=c.bias is not None)
+    conv.weight.data = torch.cat([other.weight.data for other in convs])
+    if c.bias is not None:
+        conv.bias.data = torch.cat([other.bias.data for other in convs])
+    return conv
+
+
+def grouped_bn(bns):
+    """BatchNorms as one over their stacked channels."""
+    bn = nn.BatchNorm2d(sum(other.num_features for other in bns), eps=bns[0].eps, momentum=bns[0].momentum)
+    for key in BN_KEYS:
+        getattr(bn, key).data = torch.cat([getattr(other, key).data for other in bns])
+    return bn
+
+
+class GroupedBottleneck(nn.Module):
+    """
+    Bottlenecks of several branches as one, every convolution grouped by
+    branch, on the branch inputs stacked along the channels.
+    """
+
+    def __init__(self, blocks):
+        super(GroupedBottleneck, self).__init__()
+        self.conv1 = grouped_conv([b.conv1 for b in blocks])
+        self.bn1 = grouped_bn([b.bn1 for b in blocks])
+        self.conv2 = grouped_conv([b.conv2 for b in blocks])
+        self.bn2 = grouped_bn([b.bn2 for b in blocks])
+        self.conv3 = grouped_conv([b.conv3 for b in blocks])
+        self.bn3 = grouped_bn([b.bn3 for b in blocks])
+        self.relu = nn.ReLU(inplace=True)
+        self.downsample = None
+        if blocks[0].downsample is not None:
+            self.downsample = nn.Sequential(
+                grouped_conv([b.downsample[0] for b in blocks]),
+                grouped_bn([b.downsample[1] for b in blocks]))
+
+    def forward(self, x):
+        identity = x if self.downsample is None else self.downsample(x)
+        out = self.relu(self.bn1(self.conv1(x)))
+        out = self.relu(self.bn2(self.conv2(out)))
+        out = self.bn3(self.conv3(out))
+        return self.relu(out + identity)
+
+
+class GroupedBranches(nn.Module):
+    """
+    p1, p2 and p3 with one grouped convolution per layer instead of three:
+    res_conv4 of the three branches on the trunk output repeated three
+    times, then res_g_conv5 of p1 (it has a stride, the others do not) and
+    the grouped res_p_conv5 of p2 and p3. The weights are copied, so build
+    it again after they change.
+    """
+
+    def __init__(self, p1, p2, p3):
+        super(GroupedBranches, self).__init__()
+        self.conv4 = nn.Sequential(*[GroupedBottleneck(blocks) for blocks in zip(p1[0], p2[0], p3[0])])
+        self.g_conv5 = p1[1]
+        self.p_conv5 = nn.Sequential(*[GroupedBottleneck(blocks) for blocks in zip(p2[1], p3[1])])
+
+    def forward(self, x):
+        channels = x.size(1)
+        x = self.conv4(x.repeat(1, 3, 1, 1))
+        p1 = self.g_conv5(x[:, :channels])
+        p2, p3 = self.p_conv5(x[:, channels:]).chunk(2, dim=1)
+        return [p1, p2, p3]
+
+
+class ForkBranches(nn.Module):
+    """
+    The branches as asynchronous tasks of torch.jit.fork. Forked tasks only
+    run concurrently in TorchScript, script the module (its parameters stay
+    shared with the branches).
+    """
+
+    def __init__(self, p1, p2, p3):
+        super(ForkBranches, self).__init__()
+        self.branches = nn.ModuleList([p1, p2, p3])
+
+    def forward(self, x):
+        futures = []
+        for branch in self.branches:
+            futures.append(torch.jit.fork(branch, x))
+        outputs = []
+        for future in futures:
+            outputs.append(torch.jit.wait(future))
+        return outputs
+
+
+class SingleBranchMGN(nn.Module):
+    """
+    MGN for deployment with the p1 branch only. The part features of p2 and
+    p3 are pooled from stripes of the p1 map (12x4 for 384x128 inputs, same
+    stripes as the original 24x8 ones) and go through the reductions of the
+    MGN they come from; a per feature affine projection, fitted by least
+    squares in `distill`, maps them to the MGN embedding. The forward
+    returns the [B, 8 * feats] embedding only.
+    Args:
+        mgn: the trained MGN, its modules are copied
+    """
+
+    def __init__(self, mgn):
+        super(SingleBranchMGN, self).__init__()
+        self.backone = copy.deepcopy(mgn.backone)
+        self.p1 = copy.deepcopy(mgn.p1)
+        pool2d = type(mgn.maxpool_zg_p1)
+        self.pool_g = copy.deepcopy(mgn.maxpool_zg_p1)
+        self.pool_2 = pool2d(kernel_size=(6, 4))
+        self.pool_3 = pool2d(kernel_size=(4, 4))
+        if mgn.fused_heads:
+            self.reduction = copy.deepcopy(mgn.reduction)
+        else:
+            state = {}
+            for name in REDUCTION_NAMES:
+                for key, value in getattr(mgn, name).state_dict().items():
+                    state[name + '.' + key] = value
+            FusedReduction.fuse_state(state, '', '')
+            self.reduction = FusedReduction(mgn.reduction_0, len(REDUCTION_NAMES))
+            self.reduction.load_state_dict(state)
+        feats = self.reduction.out_channels
+        self.projection = FusedClassifier(len(REDUCTION_NAMES), feats, feats)
+        self.projection.weight.data.copy_(torch.eye(feats).expand_as(self.projection.weight))
+
+    def features(self, x):
+        """
+        Returns:
+            the reduced features before the projection, shape [8, B, feats]
+        """
+        p1 = self.p1(self.backone(x))
+        zg = self.pool_g(p1)
+        z2 = self.pool_2(p1)
+        z3 = self.pool_3(p1)
+        # same order as MGN.forward, the three global features come from p1
+        z = torch.stack([zg, zg, zg, z2[:, :, 0:1], z2[:, :, 1:2],
+                         z3[:, :, 0:1], z3[:, :, 1:2], z3[:, :, 2:3]]).flatten(2)
+        return self.reduction(z)
+
+    def forward(self, x):
+        f = self.projection(self.features(x))
+        return f.transpose(0, 1).reshape(x.size(0), -1)
+
+    def distill(self, mgn, batches, ridge=1e-3):
+        """
+        Fit the projections so that the embedding matches the one of `mgn`:
+        ridge regression of every teacher feature on the student feature,
+        solved from the accumulated normal equations.
+        Args:
+            mgn: the MGN in eval mode
+            batches: iterable of input batches on the device of both models
+            ridge: L2 penalty of the weights, relative to the number of samples
+        Returns:
+            the relative squared error of the fitted embedding per feature
+        """
+        groups, feats = self.projection.weight.size(0), self.projection.weight.size(1)
+        xtx = torch.zeros(groups, feats + 1, feats + 1, dtype=torch.float64)
+        xty = torch.zeros(groups, feats + 1, feats, dtype=torch.float64)
+        yty = torch.zeros(groups, dtype=torch.float64)
+        n = 0
+        with torch.no_grad():
+            for x in batches:
+                # shape [8, B, feats]
+                y = mgn(x, mode='embed').view(x.size(0), groups, feats).transpose(0, 1).double().cpu()
+                s = self.features(x).double().cpu()
+                s = torch.cat([s, s.new_ones(groups, x.size(0), 1)], dim=2)
+                xtx += torch.bmm(s.transpose(1, 2), s)
+                xty += torch.bmm(s.transpose(1, 2), y)
+                yty += y.pow(2).sum(dim=(1, 2))
+                n += x.size(0)
+            reg = torch.eye(feats + 1, dtype=torch.float64) * ridge * n
+            reg[feats, feats] = 0  # no penalty on the bias
+            w = torch.linalg.solve(xtx + reg, xty)
+            # residual sum of squares: y'y - 2 w'X'y + w'X'Xw
+            rss = yty - 2 * (w * xty).sum(dim=(1, 2)) + (w * torch.bmm(xtx, w)).sum(dim=(1, 2))
+            self.projection.weight.data.copy_(w[:, :feats].transpose(1, 2))
+            self.projection.bias.data.copy_(w[:, feats])
+        return (rss / yty.clamp(min=1e-12)).tolist()
+
+
 class MGN(nn.Module):
     def __init__(self, args):
         super(MGN, self).__init__()
         num_classes = args.num_classes
 
-        resnet = resnet50(pretrained=True)
+        resnet = resnet50(pretrained=not args.random_init)
 
         self.backone = nn.Sequential(
             resnet.conv1,
@@ -39,6 +360,7 @@ class MGN(nn.Module):
         self.p1 = nn.Sequential(copy.deepcopy(res_conv4), copy.deepcopy(res_g_conv5))
         self.p2 = nn.Sequential(copy.deepcopy(res_conv4), copy.deepcopy(res_p_conv5))
         self.p3 = nn.Sequential(copy.deepcopy(res_conv4), copy.deepcopy(res_p_conv5))
+        self.branch_executor = None
         
         if args.pool == 'max':
             pool2d = nn.MaxPool2d
@@ -56,6 +378,18 @@ class MGN(nn.Module):
         reduction = nn.Sequential(nn.Conv2d(2048, args.feats, 1, bias=False), nn.BatchNorm2d(args.feats), nn.ReLU())
 
         self._init_reduction(reduction)
+        self.fused_heads = args.fused_heads
+        if self.fused_heads:
+            # the eight reductions and classifiers as two batched matmuls,
+            # state dicts keep the layout below, see _legacy_state_dict
+            self.reduction = FusedReduction(reduction, len(REDUCTION_NAMES))
+            self.fc_id = FusedClassifier(len(CLASSIFIER_NAMES), args.feats, num_classes)
+            for fc in self.fc_id.heads():
+                self._init_fc(fc)
+            self._register_state_dict_hook(self._legacy_state_dict)
+            self._register_load_state_dict_pre_hook(self._fuse_state_dict)
+            return
+
         self.reduction_0 = copy.deepcopy(reduction)
         self.reduction_1 = copy.deepcopy(reduction)
         self.reduction_2 = copy.deepcopy(reduction)
@@ -102,18 +436,86 @@ class MGN(nn.Module):
         #nn.init.normal_(fc.weight, std=0.001)
         nn.init.constant_(fc.bias, 0.)
 
-    def forward(self, x):
+    def _legacy_state_dict(self, module, state_dict, prefix, local_metadata):
+        """State dict hook: save the fused heads as the eight separate ones."""
+        state_dict.update(self.reduction.legacy_state(state_dict, prefix + 'reduction.', prefix))
+        state_dict.update(self.fc_id.legacy_state(state_dict, prefix + 'fc_id.', prefix))
+
+    def _fuse_state_dict(self, state_dict, prefix, local_metadata, strict,
+                         missing_keys, unexpected_keys, error_msgs):
+        """Load state dict pre hook: stack the eight separate heads."""
+        # heads missing from a partial state dict (see export_state_dict) keep their values
+        for name, module in (('reduction.', self.reduction), ('fc_id.', self.fc_id)):
+            current = dict((prefix + name + key, value) for key, value in module.state_dict().items())
+            legacy = module.legacy_state(current, prefix + name, prefix)
+            if any(key in state_dict for key in legacy):
+                for key, value in legacy.items():
+                    state_dict.setdefault(key, value)
+        FusedReduction.fuse_state(state_dict, prefix, prefix + 'reduction.')
+        FusedClassifier.fuse_state(state_dict, prefix, prefix + 'fc_id.')
+
+    def set_branch_executor(self, mode='serial'):
+        """
+        How the three branches run in eval mode: 'serial', one after the
+        other; 'grouped', as grouped convolutions (GroupedBranches, a copy of
+        the current weights, set it again after loading or training);
+        'fork', as concurrent TorchScript tasks (ForkBranches). Call it after
+        moving the model to its device. Training always runs serially.
+        """
+        assert mode in ('serial', 'grouped', 'fork')
+        executor = None
+        if mode == 'grouped':
+            executor = GroupedBranches(self.p1, self.p2, self.p3).to(self.backone[0].weight.device).eval()
+        elif mode == 'fork':
+            executor = torch.jit.script(ForkBranches(self.p1, self.p2, self.p3).eval())
+        # kept out of the registered submodules, so not in the state dict
+        self.__dict__['branch_executor'] = executor
+
+    def export_state_dict(self, mode='embed'):
+        """
+        The state dict of what `forward(x, mode)` runs: without the
+        classifiers, and without the part reductions for 'embed_global'.
+        It loads with strict=False, the stripped entries keep their initial
+        values.
+        """
+        assert mode in ('embed', 'embed_global')
+        skip = list(CLASSIFIER_NAMES)
+        if mode == 'embed_global':
+            skip += REDUCTION_NAMES[3:]
+        skip = tuple(name + '.' for name in skip)
+        return OrderedDict((name, value) for name, value in self.state_dict().items()
+                           if not name.startswith(skip))
+
+    def forward(self, x, mode='train'):
+        """
+        Args:
+            mode: 'train', the embedding, the global features and the logits;
+                'embed', the [B, 8 * feats] embedding only, the classifiers
+                are skipped; 'embed_global', the [B, 3 * feats] global
+                features only, the part pooling and reductions are skipped too
+        """
+        assert mode in ('train', 'embed', 'embed_global')
 
         x = self.backone(x)
 
-        p1 = self.p1(x)
-        p2 = self.p2(x)
-        p3 = self.p3(x)
+        if self.branch_executor is not None and not self.training:
+            p1, p2, p3 = self.branch_executor(x)
+        else:
+            p1 = self.p1(x)
+            p2 = self.p2(x)
+            p3 = self.p3(x)
 
         zg_p1 = self.maxpool_zg_p1(p1)
         zg_p2 = self.maxpool_zg_p2(p2)
         zg_p3 = self.maxpool_zg_p3(p3)
 
+        if mode == 'embed_global':
+            if self.fused_heads:
+                f = self.reduction(torch.stack([zg_p1, zg_p2, zg_p3]).flatten(2), groups=3)
+                return f.transpose(0, 1).reshape(f.size(1), -1)
+            return torch.cat([self.reduction_0(zg_p1), self.reduction_1(zg_p2),
+                              self.reduction_2(zg_p3)], dim=1).flatten(1)
+
         zp2 = self.maxpool_zp2(p2)
         z0_p2 = zp2[:, :, 0:1, :]
         z1_p2 = zp2[:, :, 1:2, :]
@@ -123,29 +525,40 @@ class MGN(nn.Module):
         z1_p3 = zp3[:, :, 1:2, :]
         z2_p3 = zp3[:, :, 2:3, :]
         
-        fg_p1 = self.reduction_0(zg_p1).squeeze(dim=3).squeeze(dim=2)
-        fg_p2 = self.reduction_1(zg_p2).squeeze(dim=3).squeeze(dim=2)
-        fg_p3 = self.reduction_2(zg_p3).squeeze(dim=3).squeeze(dim=2)
-        f0_p2 = self.reduction_3(z0_p2).squeeze(dim=3).squeeze(dim=2)
-        f1_p2 = self.reduction_4(z1_p2).squeeze(dim=3).squeeze(dim=2)
-        f0_p3 = self.reduction_5(z0_p3).squeeze(dim=3).squeeze(dim=2)
-        f1_p3 = self.reduction_6(z1_p3).squeeze(dim=3).squeeze(dim=2)
-        f2_p3 = self.reduction_7(z2_p3).squeeze(dim=3).squeeze(dim=2)
-
-        '''
-        l_p1 = self.fc_id_2048_0(zg_p1.squeeze(dim=3).squeeze(dim=2))
-        l_p2 = self.fc_id_2048_1(zg_p2.squeeze(dim=3).squeeze(dim=2))
-        l_p3 = self.fc_id_2048_2(zg_p3.squeeze(dim=3).squeeze(dim=2))
-        '''
-        l_p1 = self.fc_id_2048_0(fg_p1)
-        l_p2 = self.fc_id_2048_1(fg_p2)
-        l_p3 = self.fc_id_2048_2(fg_p3)
+        if self.fused_heads:
+            # shape [8, B, 2048]
+            z = torch.stack([zg_p1, zg_p2, zg_p3, z0_p2, z1_p2, z0_p3, z1_p3, z2_p3]).flatten(2)
+            f = self.reduction(z)
+            if mode == 'embed':
+                return f.transpose(0, 1).reshape(f.size(1), -1)
+            fg_p1, fg_p2, fg_p3, f0_p2, f1_p2, f0_p3, f1_p3, f2_p3 = f.unbind(0)
+            l_p1, l_p2, l_p3, l0_p2, l1_p2, l0_p3, l1_p3, l2_p3 = self.fc_id(f).unbind(0)
+        else:
+            fg_p1 = self.reduction_0(zg_p1).squeeze(dim=3).squeeze(dim=2)
+            fg_p2 = self.reduction_1(zg_p2).squeeze(dim=3).squeeze(dim=2)
+            fg_p3 = self.reduction_2(zg_p3).squeeze(dim=3).squeeze(dim=2)
+            f0_p2 = self.reduction_3(z0_p2).squeeze(dim=3).squeeze(dim=2)
+            f1_p2 = self.reduction_4(z1_p2).squeeze(dim=3).squeeze(dim=2)
+            f0_p3 = self.reduction_5(z0_p3).squeeze(dim=3).squeeze(dim=2)
+            f1_p3 = self.reduction_6(z1_p3).squeeze(dim=3).squeeze(dim=2)
+            f2_p3 = self.reduction_7(z2_p3).squeeze(dim=3).squeeze(dim=2)
+            if mode == 'embed':
+                return torch.cat([fg_p1, fg_p2, fg_p3, f0_p2, f1_p2, f0_p3, f1_p3, f2_p3], dim=1)
+
+            '''
+            l_p1 = self.fc_id_2048_0(zg_p1.squeeze(dim=3).squeeze(dim=2))
+            l_p2 = self.fc_id_2048_1(zg_p2.squeeze(dim=3).squeeze(dim=2))
+            l_p3 = self.fc_id_2048_2(zg_p3.squeeze(dim=3).squeeze(dim=2))
+            '''
+            l_p1 = self.fc_id_2048_0(fg_p1)
+            l_p2 = self.fc_id_2048_1(fg_p2)
+            l_p3 = self.fc_id_2048_2(fg_p3)
         
-        l0_p2 = self.fc_id_256_1_0(f0_p2)
-        l1_p2 = self.fc_id_256_1_1(f1_p2)
-        l0_p3 = self.fc_id_256_2_0(f0_p3)
-        l1_p3 = self.fc_id_256_2_1(f1_p3)
-        l2_p3 = self.fc_id_256_2_2(f2_p3)
+            l0_p2 = self.fc_id_256_1_0(f0_p2)
+            l1_p2 = self.fc_id_256_1_1(f1_p2)
+            l0_p3 = self.fc_id_256_2_0(f0_p3)
+            l1_p3 = self.fc_id_256_2_1(f1_p3)
+            l2_p3 = self.fc_id_256_2_2(f2_p3)
 
         predict = torch.cat([fg_p1, fg_p2, fg_p3, f0_p2, f1_p2, f0_p3, f1_p3, f2_p3], dim=1)
 
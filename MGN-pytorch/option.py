@@ -9,19 +9,57 @@ parser.add_argument('--nGPU', type=int, default=1, help='number of GPUs')
 parser.add_argument("--datadir", type=str, default="Market-1501-v15.09.15", help='dataset directory')
 parser.add_argument('--data_train', type=str, default='Market1501', help='train dataset name')
 parser.add_argument('--data_test', type=str, default='Market1501', help='test dataset name')
+parser.add_argument('--no_manifest', action='store_true', help='always walk the dataset directories instead of reading the cached manifest')
 
 parser.add_argument('--reset', action='store_true', help='reset the training')
 parser.add_argument("--epochs", type=int, default=80, help='number of epochs to train')
 parser.add_argument('--test_every', type=int, default=20, help='do test per every N epochs')
 parser.add_argument("--batchid", type=int, default=16, help='the batch for id')
 parser.add_argument("--batchimage", type=int, default=4, help='the batch of per id')
+parser.add_argument('--id_weight', type=str, default='uniform', choices=('uniform', 'count', 'sqrt'), help='how identities are drawn for a batch (uniform | count | sqrt)')
+parser.add_argument('--cam_balanced', action='store_true', help='spread the images of an identity in a batch over its cameras')
+parser.add_argument('--hard_id_mining', action='store_true', help='fill batches with confusable identities found from running feature centroids (camera balanced)')
+parser.add_argument('--hard_ratio', type=float, default=0.5, help='fraction of batches built from confusable identities')
+parser.add_argument('--centroid_momentum', type=float, default=0.5, help='weight of the previous epoch in the identity centroids')
+parser.add_argument('--micro_batch', type=int, default=0, help='forward/backward the P x K batch in chunks of this size, mining over the full batch (GradCache); 0 disables')
+parser.add_argument('--log_every', type=int, default=20, help='display the running loss every N batches, every display waits for the device')
+parser.add_argument('--log_flush_secs', type=int, default=30, help='seconds between writes of the buffered scalars (scalars.csv)')
+parser.add_argument('--profile_every', type=int, default=0, help='print the data/h2d/forward/loss/backward/optimizer time split every N steps (synchronizes the device); 0 disables')
+parser.add_argument('--profile_trace_dir', type=str, default='', help='write a torch.profiler trace of a window of steps to this directory')
+parser.add_argument('--profile_trace_start', type=int, default=10, help='first step of the profiler trace')
+parser.add_argument('--profile_trace_steps', type=int, default=5, help='number of steps in the profiler trace')
 parser.add_argument("--batchtest", type=int, default=32, help='input batch size for test')
 parser.add_argument('--test_only', action='store_true', help='set this option to test the model')
+parser.add_argument('--prefetch_test', action='store_true', help='pin the test batches and copy the next one to the device while the current one runs')
+parser.add_argument('--branch_exec', type=str, default='serial', choices=('serial', 'grouped', 'fork'), help='how the three branches run at test: one after the other, as grouped convolutions, or as forked TorchScript tasks')
+parser.add_argument('--export_single_branch', type=str, default='', help='distill the loaded model into a single branch model saved to this path, then exit')
+parser.add_argument('--distill_batches', type=int, default=50, help='number of training batches the single branch projections are fitted on')
+parser.add_argument('--export_torchscript', type=str, default='', help='save the embedding of the loaded model, BatchNorm folded, as a frozen TorchScript model to this path, then exit')
+parser.add_argument('--export_onnx', type=str, default='', help='save the embedding of the loaded model, BatchNorm folded, as an ONNX model to this path, then exit')
+parser.add_argument('--export_mode', type=str, default='embed', choices=('embed', 'embed_global'), help='embedding exported by --export_torchscript/--export_onnx')
+parser.add_argument('--export_optimize', action='store_true', help='apply torch.jit.optimize_for_inference to the TorchScript export')
+parser.add_argument('--quantize', action='store_true', help='int8 post-training quantization of the loaded model, reports the mAP/CMC change on cpu, then exits (1 if over --quant_max_map_drop)')
+parser.add_argument('--quant_calib_images', type=int, default=512, help='number of random gallery images the activation ranges are calibrated on')
+parser.add_argument('--quant_backend', type=str, default='fbgemm', choices=('fbgemm', 'x86', 'qnnpack'), help='quantized kernels: fbgemm/x86 for x86 servers, qnnpack for arm')
+parser.add_argument('--quant_max_map_drop', type=float, default=0.01, help='largest accepted mAP drop of the quantized model')
+parser.add_argument('--quant_file', type=str, default='', help='save the quantized embedding as a frozen TorchScript model to this path')
+parser.add_argument('--gallery_codec', type=str, default='none', choices=('none', 'float16', 'int8', 'pq'), help='store the test gallery features compressed, distances are computed on the codes')
+parser.add_argument('--pq_subspaces', type=int, default=64, help='bytes per vector of the pq gallery codec')
+parser.add_argument('--num_threads', type=int, default=0, help='intra-op threads of torch, 0 keeps the default')
+parser.add_argument('--interop_threads', type=int, default=0, help='inter-op threads of torch, 0 keeps the default')
+parser.add_argument('--channels_last', action='store_true', help='run the model and its inputs in channels_last (NHWC) memory format')
+parser.add_argument('--pin_workers', action='store_true', help='pin the process to its first --num_threads cores and every data loader worker to one of the other cores')
+parser.add_argument('--tune_runtime', action='store_true', help='measure the images/sec of the model for every --tune_threads count, with and without channels_last, then exit')
+parser.add_argument('--tune_threads', type=str, default='', help="comma separated thread counts of --tune_runtime, '' for powers of 2 up to the cores")
+parser.add_argument('--distributed', action='store_true', help='train with one process per rank under torchrun, DistributedDataParallel over gloo on cpu; --batchid identities per rank, the triplet loss mines the batches of all ranks')
+parser.add_argument('--dist_timeout', type=int, default=60, help='minutes the ranks wait for each other, e.g. for rank 0 to test')
 
 parser.add_argument('--model', default='MGN', help='model name')
 parser.add_argument('--loss', type=str, default='1*CrossEntropy+1*Triplet', help='loss function configuration')
 
 parser.add_argument('--act', type=str, default='relu', help='activation function')
+parser.add_argument('--random_init', action='store_true', help='do not load the imagenet weights of the backbone')
+parser.add_argument('--fused_heads', action='store_true', help='run the eight reductions and classifiers as batched matmuls (checkpoints keep the separate layout)')
 parser.add_argument('--pool', type=str, default='avg', help='pool function')
 parser.add_argument('--feats', type=int, default=256, help='number of feature maps')
 parser.add_argument('--height', type=int, default=384, help='height of the input image')
@@ -44,6 +82,7 @@ parser.add_argument('--decay_type', type=str, default='step', help='learning rat
 parser.add_argument('--lr_decay', type=int, default=60, help='learning rate decay per N epochs')
 
 parser.add_argument("--margin", type=float, default=1.2, help='')
+parser.add_argument('--triplet_mining', type=str, default='batch_hard', choices=('batch_hard', 'batch_all', 'semihard'), help='triplet mining of the Triplet loss')
 parser.add_argument("--re_rank", action='store_true', help='')
 parser.add_argument("--random_erasing", action='store_true', help='')
 parser.add_argument("--probability", type=float, default=0.5, help='')
@@ -54,6 +93,7 @@ parser.add_argument("--resume", type=int, default=0, help='resume from specific
 parser.add_argument('--save', type=str, default='test', help='file name to save')
 parser.add_argument('--load', type=str, default='', help='file name to load')
 parser.add_argument('--save_models', action='store_true', help='save all intermediate models')
+parser.add_argument('--keep_models', type=int, default=0, help='number of intermediate models kept with --save_models, 0 keeps all')
 parser.add_argument('--pre_train', type=str, default='', help='pre-trained model directory')
 
 parser.add_argument('--color_jitter', action='store_true', help='use color jitter for data augment.')
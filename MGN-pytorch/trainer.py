@@ -1,10 +1,17 @@
 import os
+import time
+import itertools
 import torch
 import numpy as np
 import utils.utility as utility
+import reid_common.log_utils as log_utils
+import reid_common.dist_utils as dist_utils
+import reid_common.runtime_utils as runtime_utils
+import reid_common.export_utils as export_utils
 from scipy.spatial.distance import cdist
 from utils.functions import cmc, mean_ap
 from utils.re_ranking import re_ranking
+from reid_common.codec import make_codec
 
 class Trainer():
     def __init__(self, args, model, loss, loader, ckpt):
@@ -22,6 +29,9 @@ class Trainer():
         self.optimizer = utility.make_optimizer(args, self.model)
         self.scheduler = utility.make_scheduler(args, self.optimizer)
         self.device = torch.device('cpu' if args.cpu else 'cuda')
+        self.profiler = log_utils.StepProfiler(
+            args.profile_every, trace_dir=args.profile_trace_dir,
+            trace_start=args.profile_trace_start, trace_steps=args.profile_trace_steps)
 
         if args.load != '':
             self.optimizer.load_state_dict(
@@ -30,55 +40,116 @@ class Trainer():
             for _ in range(len(ckpt.log)*args.test_every): self.scheduler.step()
 
     def train(self):
-        self.scheduler.step()
-        self.loss.step()
+        # the scheduler counts the finished epochs, it steps after the
+        # optimizer (torch >= 1.1)
         epoch = self.scheduler.last_epoch + 1
-        lr = self.scheduler.get_lr()[0]
+        lr = self.scheduler.get_last_lr()[0]
         if lr != self.lr:
             self.ckpt.write_log('[INFO] Epoch: {}\tLearning rate: {:.2e}'.format(epoch, lr))
             self.lr = lr
         self.loss.start_log()
         self.model.train()
 
+        timer = log_utils.StepTimer()
+        epoch_start = timer.last
+        num_ims = 0
+        data_wait = 0.
+        self.profiler.start()
         for batch, (inputs, labels) in enumerate(self.train_loader):
-            inputs = inputs.to(self.device)
+            timer.data_ready()
+            self.profiler.mark('data')
+            inputs = runtime_utils.to_channels_last(inputs.to(self.device), self.args.channels_last)
             labels = labels.to(self.device)
+            self.profiler.mark('h2d')
 
             self.optimizer.zero_grad()
-            outputs = self.model(inputs)
-            loss = self.loss(outputs, labels)
-            loss.backward()
+            if 0 < self.args.micro_batch < inputs.size(0):
+                outputs = self.cached_forward(inputs)
+                self.profiler.mark('forward')
+                loss = self.loss(outputs, labels)
+                self.profiler.mark('loss')
+                loss.backward()
+                self.cached_backward(inputs, outputs)
+            else:
+                outputs = self.model(inputs)
+                self.profiler.mark('forward')
+                loss = self.loss(outputs, labels)
+                self.profiler.mark('loss')
+                loss.backward()
+            self.profiler.mark('backward')
             self.optimizer.step()
+            self.profiler.mark('optimizer')
+            if self.args.hard_id_mining:
+                # the samplers of all ranks are fed the same features
+                self.train_loader.batch_sampler.update(
+                    dist_utils.all_gather(labels), dist_utils.all_gather(outputs[0].detach()))
+
+            throughput = timer.step_done(inputs.size(0))
+            num_ims += inputs.size(0)
+            data_wait += throughput['data_wait']
+            self.ckpt.scalars.add_scalars(
+                'throughput', throughput, (epoch - 1) * len(self.train_loader) + batch)
 
-            self.ckpt.write_log('\r[INFO] [{}/{}]\t{}/{}\t{}'.format(
-                epoch, self.args.epochs,
-                batch + 1, len(self.train_loader),
-                self.loss.display_loss(batch)), 
-            end='' if batch+1 != len(self.train_loader) else '\n')
+            # displaying the loss waits for the device, only do it every log_every batches
+            last = batch + 1 == len(self.train_loader)
+            if (batch + 1) % self.args.log_every == 0 or last:
+                self.ckpt.write_log('\r[INFO] [{}/{}]\t{}/{}\t{}'.format(
+                    epoch, self.args.epochs,
+                    batch + 1, len(self.train_loader),
+                    self.loss.display_loss(batch)), 
+                end='' if not last else '\n')
+            self.profiler.step()
 
         self.loss.end_log(len(self.train_loader))
+        epoch_time = time.time() - epoch_start
+        self.ckpt.write_log('[INFO] {:.1f} ims/s, data wait {:.2f}s'.format(
+            num_ims / max(epoch_time, 1e-12), data_wait))
+        self.ckpt.scalars.add_scalars(
+            'loss', dict((l['type'], v) for l, v in zip(self.loss.loss, self.loss.log[-1].tolist())), epoch)
+        self.scheduler.step()
+        self.loss.step()
+
+    def cached_forward(self, inputs):
+        """
+        First pass of GradCache: outputs of the whole batch computed in micro
+        batches without graph, returned as leaf tensors so the loss (and its
+        triplet mining) sees the full batch. BatchNorm running statistics are
+        restored, cached_backward forwards the same inputs again.
+        """
+        bn_buffers = [(buf, buf.clone()) for m in self.model.modules()
+                      if isinstance(m, torch.nn.modules.batchnorm._BatchNorm)
+                      for buf in m.buffers()]
+        with torch.no_grad():
+            outputs = [self.model(x) for x in inputs.split(self.args.micro_batch)]
+        for buf, saved in bn_buffers:
+            buf.copy_(saved)
+        return [torch.cat(o).requires_grad_() for o in zip(*outputs)]
+
+    def cached_backward(self, inputs, cached_outputs):
+        """
+        Second pass of GradCache: forward every micro batch with graph and
+        backpropagate the gradients the loss left on the cached outputs.
+        """
+        grads = [o.grad for o in cached_outputs]
+        start = 0
+        for x in inputs.split(self.args.micro_batch):
+            outputs = self.model(x)
+            pairs = [(o, g[start:start + x.size(0)]) for o, g in zip(outputs, grads) if g is not None]
+            torch.autograd.backward([o for o, _ in pairs], [g for _, g in pairs])
+            start += x.size(0)
 
     def test(self):
-        epoch = self.scheduler.last_epoch + 1
+        epoch = self.scheduler.last_epoch
         self.ckpt.write_log('\n[INFO] Test:')
         self.model.eval()
+        # the executor keeps the model out of DataParallel replicas, so only on one device
+        if self.args.cpu or self.args.nGPU == 1:
+            self.model.get_model().set_branch_executor(self.args.branch_exec)
 
         self.ckpt.add_log(torch.zeros(1, 5))
-        qf = self.extract_feature(self.query_loader).numpy()
-        gf = self.extract_feature(self.test_loader).numpy()
-
-        if self.args.re_rank:
-            q_g_dist = np.dot(qf, np.transpose(gf))
-            q_q_dist = np.dot(qf, np.transpose(qf))
-            g_g_dist = np.dot(gf, np.transpose(gf))
-            dist = re_ranking(q_g_dist, q_q_dist, g_g_dist)
-        else:
-            dist = cdist(qf, gf)
-        r = cmc(dist, self.queryset.ids, self.testset.ids, self.queryset.cameras, self.testset.cameras,
-                separate_camera_set=False,
-                single_gallery_shot=False,
-                first_match_break=True)
-        m_ap = mean_ap(dist, self.queryset.ids, self.testset.ids, self.queryset.cameras, self.testset.cameras)
+        # rank 0 tests alone, outside of DistributedDataParallel
+        m_ap, r = self.evaluate(self.model.get_model() if self.args.distributed else self.model, self.device)
+        self.model.get_model().set_branch_executor('serial')
 
         self.ckpt.log[-1, 0] = m_ap
         self.ckpt.log[-1, 1] = r[0]
@@ -86,6 +157,8 @@ class Trainer():
         self.ckpt.log[-1, 3] = r[4]
         self.ckpt.log[-1, 4] = r[9]
         best = self.ckpt.log.max(0)
+        self.ckpt.scalars.add_scalars(
+            'test', dict(mAP=m_ap, rank1=r[0], rank3=r[2], rank5=r[4], rank10=r[9]), epoch)
         self.ckpt.write_log(
             '[INFO] mAP: {:.4f} rank1: {:.4f} rank3: {:.4f} rank5: {:.4f} rank10: {:.4f} (Best: {:.4f} @epoch {})'.format(
             m_ap,
@@ -97,33 +170,131 @@ class Trainer():
         if not self.args.test_only:
             self.ckpt.save(self, epoch, is_best=((best[1][0] + 1)*self.args.test_every == epoch))
 
-    def fliphor(self, inputs):
-        inv_idx = torch.arange(inputs.size(3)-1,-1,-1).long()  # N x C x H x W
-        return inputs.index_select(3,inv_idx)
+    def evaluate(self, model, device):
+        """
+        Returns:
+            mAP and the CMC scores of the model on the query and gallery sets
+        """
+        qf = self.extract_feature(self.query_loader, model, device).numpy()
+        gf = self.extract_feature(self.test_loader, model, device).numpy()
 
-    def extract_feature(self, loader):
-        features = torch.FloatTensor()
-        for (inputs, labels) in loader:
-            ff = torch.FloatTensor(inputs.size(0), 2048).zero_()
-            for i in range(2):
-                if i==1:
-                    inputs = self.fliphor(inputs)
-                input_img = inputs.to(self.device)
-                outputs = self.model(input_img)
-                f = outputs[0].data.cpu()
-                ff = ff + f
+        if self.args.gallery_codec != 'none':
+            # the gallery is kept compressed, distances are computed on its codes
+            kwargs = dict(num_subspaces=self.args.pq_subspaces) if self.args.gallery_codec == 'pq' else {}
+            codec = make_codec(self.args.gallery_codec, **kwargs)
+            encoded = codec.fit(gf).encode(gf)
+            self.ckpt.write_log('[INFO] Gallery features: {:.1f}MB, {:.1f}x smaller'.format(
+                encoded.nbytes / 2. ** 20, gf.nbytes / float(encoded.nbytes)))
+            if self.args.re_rank:
+                q_g_dist = codec.dot(qf, encoded)
+                q_q_dist = np.dot(qf, np.transpose(qf))
+                g_g_dist = codec.dot(encoded.decode(), encoded)
+                dist = re_ranking(q_g_dist, q_q_dist, g_g_dist)
+            else:
+                dist = codec.dist(qf, encoded)
+        elif self.args.re_rank:
+            q_g_dist = np.dot(qf, np.transpose(gf))
+            q_q_dist = np.dot(qf, np.transpose(qf))
+            g_g_dist = np.dot(gf, np.transpose(gf))
+            dist = re_ranking(q_g_dist, q_q_dist, g_g_dist)
+        else:
+            dist = cdist(qf, gf)
+        r = cmc(dist, self.queryset.ids, self.testset.ids, self.queryset.cameras, self.testset.cameras,
+                separate_camera_set=False,
+                single_gallery_shot=False,
+                first_match_break=True)
+        m_ap = mean_ap(dist, self.queryset.ids, self.testset.ids, self.queryset.cameras, self.testset.cameras)
+        return m_ap, r
 
-            fnorm = torch.norm(ff, p=2, dim=1, keepdim=True)
-            ff = ff.div(fnorm.expand_as(ff))
+    def quantize(self):
+        """
+        int8 post-training quantization of the embedding, calibrated on
+        random gallery images; the float and the quantized model are both
+        evaluated on cpu and the mAP/CMC deltas logged.
+        Returns:
+            whether the mAP drop is within --quant_max_map_drop
+        """
+        mgn = self.model.get_model().eval()
+        cpu = torch.device('cpu')
+        rng = np.random.RandomState(0)
+        indices = rng.choice(len(self.testset), min(self.args.quant_calib_images, len(self.testset)),
+                             replace=False)
+        loader = torch.utils.data.DataLoader(torch.utils.data.Subset(self.testset, indices.tolist()),
+                                             batch_size=self.args.batchtest)
+        batches = [inputs for inputs, _ in loader]
+        quantized = export_utils.quantize_model(mgn, batches, 'embed', self.args.quant_backend)
 
-            features = torch.cat((features, ff), 0)
-        return features
+        scores = []
+        for name, model in (('float', mgn.cpu()), ('int8', quantized)):
+            start = time.time()
+            m_ap, r = self.evaluate(model, cpu)
+            scores.append([m_ap, r[0], r[4], r[9], time.time() - start])
+            self.ckpt.write_log('[INFO] {}: mAP: {:.4f} rank1: {:.4f} rank5: {:.4f} rank10: {:.4f} ({:.1f}s)'.format(
+                name, *scores[-1]))
+        (f_map, _, _, _, f_time), (q_map, _, _, _, q_time) = scores
+        self.ckpt.write_log('[INFO] delta: mAP: {:+.4f} rank1: {:+.4f} rank5: {:+.4f} rank10: {:+.4f} ({:.2f}x faster)'.format(
+            *([q - f for f, q in zip(scores[0][:4], scores[1][:4])] + [f_time / max(q_time, 1e-12)])))
+
+        if self.args.quant_file != '':
+            with torch.no_grad():
+                traced = torch.jit.freeze(torch.jit.trace(quantized.module, batches[0]))
+            torch.jit.save(traced, self.args.quant_file)
+            self.ckpt.write_log('[INFO] Quantized model saved to {}'.format(self.args.quant_file))
+        return f_map - q_map <= self.args.quant_max_map_drop
+
+    def export_single_branch(self, path):
+        """
+        Distill the model into a SingleBranchMGN fitted on training batches
+        and save the whole module to `path`.
+        """
+        from model.mgn import SingleBranchMGN
+        mgn = self.model.get_model()
+        mgn.eval()
+        student = SingleBranchMGN(mgn).to(self.device).eval()
+        batches = (inputs.to(self.device) for inputs, _ in
+                   itertools.islice(self.train_loader, self.args.distill_batches))
+        errors = student.distill(mgn, batches)
+        self.ckpt.write_log('[INFO] Single branch relative error per feature: {}'.format(
+            ' '.join('{:.4f}'.format(e) for e in errors)))
+        torch.save(student.cpu(), path)
+        self.ckpt.write_log('[INFO] Single branch model saved to {}'.format(path))
+
+    def extract_feature(self, loader, model=None, device=None):
+        """
+        L2 normalized sums of the embeddings of every image and its
+        horizontal flip, in the order of loader.dataset. A batch and its
+        flip run as one doubled batch, the features are written into a
+        preallocated tensor (pinned, to copy them back without waiting).
+        """
+        model = self.model if model is None else model
+        device = self.device if device is None else device
+        features = None
+        start = 0
+        if self.args.prefetch_test:
+            batches = utility.prefetch_to_device(loader, device)
+        else:
+            batches = loader
+        with torch.no_grad():
+            for (inputs, labels) in batches:
+                inputs = runtime_utils.to_channels_last(inputs.to(device), self.args.channels_last)
+                n = inputs.size(0)
+                # N x C x H x W, the flip of the width
+                f = model(torch.cat([inputs, torch.flip(inputs, [3])]), mode='embed')
+                ff = f[:n] + f[n:]
+                ff = ff.div(torch.norm(ff, p=2, dim=1, keepdim=True))
+                if features is None:
+                    features = torch.empty(len(loader.dataset), ff.size(1),
+                                           pin_memory=device.type == 'cuda')
+                features[start:start + n].copy_(ff, non_blocking=True)
+                start += n
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        return features[:start]
 
     def terminate(self):
         if self.args.test_only:
             self.test()
             return True
         else:
-            epoch = self.scheduler.last_epoch + 1
-            return epoch >= self.args.epochs
+            return self.scheduler.last_epoch >= self.args.epochs
 
@@ -12,13 +12,20 @@ import torch
 import torch.optim as optim
 from utils.nadam import Nadam
 from utils.n_adam import NAdam
+from reid_common.checkpoint_utils import AsyncCheckpointWriter
+from reid_common.log_utils import ScalarLogger
+from reid_common.dist_utils import is_main_process, get_rank, barrier, broadcast_object
 import torch.optim.lr_scheduler as lrs
 
 class checkpoint():
     def __init__(self, args):
         self.args = args
         self.log = torch.Tensor()
-        now = datetime.datetime.now().strftime('%Y-%m-%d-%H:%M:%S')
+        # with --distributed only rank 0 writes the experiment directory,
+        # the other ranks keep their scalars in a rank<N> subdirectory
+        self.main = is_main_process()
+        # the timestamp of rank 0, the default --save of all ranks
+        now = broadcast_object(datetime.datetime.now().strftime('%Y-%m-%d-%H:%M:%S'))
 
         if args.load == '':
             if args.save == '': args.save = now
@@ -31,19 +38,32 @@ class checkpoint():
                 self.log = torch.load(self.dir + '/map_log.pt')
                 print('Continue from epoch {}...'.format(len(self.log)*args.test_every))
 
+        # every rank has looked for the directory before rank 0 resets it
+        barrier()
         if args.reset:
-            os.system('rm -rf ' + self.dir)
+            if self.main: os.system('rm -rf ' + self.dir)
             args.load = ''
+            barrier()
 
         def _make_dir(path):
             if not os.path.exists(path): os.makedirs(path)
 
+        self.writer = AsyncCheckpointWriter()
+        if not self.main:
+            self.log_file = None
+            rank_dir = '{}/rank{}'.format(self.dir, get_rank())
+            _make_dir(rank_dir)
+            self.scalars = ScalarLogger(rank_dir, args.log_flush_secs, tensorboard=False)
+            return
+
         _make_dir(self.dir)
         _make_dir(self.dir + '/model')
         _make_dir(self.dir + '/results')
 
         open_type = 'a' if os.path.exists(self.dir + '/log.txt') else 'w'
         self.log_file = open(self.dir + '/log.txt', open_type)
+        # MGN does not depend on tensorboardX, scalars only go to scalars.csv
+        self.scalars = ScalarLogger(self.dir, args.log_flush_secs, tensorboard=False)
         with open(self.dir + '/config.txt', open_type) as f:
             f.write(now + '\n\n')
             for arg in vars(args):
@@ -51,13 +71,16 @@ class checkpoint():
             f.write('\n')
 
     def save(self, trainer, epoch, is_best=False):
-        trainer.model.save(self.dir, epoch, is_best=is_best)
-        trainer.loss.save(self.dir)
-        trainer.loss.plot_loss(self.dir, epoch)
-
-        self.plot_map_rank(epoch)
-        torch.save(self.log, os.path.join(self.dir, 'map_log.pt'))
-        torch.save(
+        if not self.main:
+            return
+        # everything is snapshotted here and written by the writer thread
+        trainer.model.save(self.dir, epoch, is_best=is_best, writer=self.writer)
+        trainer.loss.save(self.dir, writer=self.writer)
+        self.writer.submit(trainer.loss.plot_loss, self.dir, epoch, trainer.loss.log.clone())
+
+        self.writer.submit(self.plot_map_rank, epoch, self.log.clone())
+        self.writer.save(self.log, os.path.join(self.dir, 'map_log.pt'))
+        self.writer.save(
             trainer.optimizer.state_dict(),
             os.path.join(self.dir, 'optimizer.pt')
         )
@@ -66,6 +89,8 @@ class checkpoint():
         self.log = torch.cat([self.log, log])
 
     def write_log(self, log, refresh=False, end='\n'):
+        if not self.main:
+            return
         print(log, end=end)
         if end != '':
             self.log_file.write(log + end)
@@ -74,16 +99,20 @@ class checkpoint():
             self.log_file = open(self.dir + '/log.txt', 'a')
 
     def done(self):
-        self.log_file.close()
+        self.scalars.close()
+        self.writer.close()
+        if self.log_file is not None:
+            self.log_file.close()
 
-    def plot_map_rank(self, epoch):
-        axis = np.linspace(1, epoch, self.log.size(0))
+    def plot_map_rank(self, epoch, log=None):
+        log = self.log if log is None else log
+        axis = np.linspace(1, epoch, log.size(0))
         label = 'Reid on {}'.format(self.args.data_test)
         labels = ['mAP','rank1','rank3','rank5','rank10']
         fig = plt.figure()
         plt.title(label)
         for i in range(len(labels)):
-            plt.plot(axis, self.log[:, i].numpy(), label=labels[i])
+            plt.plot(axis, log[:, i].numpy(), label=labels[i])
 
         plt.legend()
         plt.xlabel('Epochs')
@@ -151,3 +180,18 @@ def make_scheduler(args, optimizer):
 
     return scheduler
 
+
+def prefetch_to_device(loader, device):
+    """
+    Yield the batches of the loader with their tensors on the device, the
+    copy of the next batch is queued before the current one is returned,
+    so with a pinned memory loader it overlaps the compute.
+    """
+    ready = None
+    for batch in loader:
+        batch = [t.to(device, non_blocking=True) if torch.is_tensor(t) else t for t in batch]
+        if ready is not None:
+            yield ready
+        ready = batch
+    if ready is not None:
+        yield ready
@@ -4,6 +4,7 @@ import os
 import torch
 from collections import OrderedDict
 from . import networks
+from reid_common.checkpoint_utils import AsyncCheckpointWriter
 
 
 class BaseModel(object):
@@ -19,6 +20,7 @@ class BaseModel(object):
         self.model_names = []
         self.visual_names = []
         self.image_paths = []
+        self.ckpt_writer = None
 
     def name(self):
         return 'BaseModel'
@@ -84,21 +86,26 @@ class BaseModel(object):
         return errors_ret
 
     def save_networks(self, which_epoch, epoch_value):
-        '''save models to the disk'''
+        '''save models to the disk, in the background: the weights are
+        snapshotted to cpu memory and written by a writer thread'''
+        if self.ckpt_writer is None:
+            self.ckpt_writer = AsyncCheckpointWriter()
+        keep = getattr(self.opt, 'keep_epochs', 0)
         for name in self.model_names:
             if isinstance(name, str):
                 save_filename = '%s_net_%s.pth' % (which_epoch, name)
                 save_path = os.path.join(self.save_dir, save_filename)
                 net = getattr(self, 'net' + name)
 
-                if len(self.gpu_ids) > 0 and torch.cuda.is_available():
+                if isinstance(net, torch.nn.DataParallel):
                     # add .module, otherwise the name will add 'module'
-                    ckpt = dict(state_dict=net.module.state_dict(),
-                            epoch=epoch_value)
-                else:
-                    ckpt = dict(state_dict=net.cpu().state_dict(),
-                            epoch=epoch_value)
-                torch.save(ckpt, save_path)
+                    net = net.module
+                ckpt = dict(state_dict=net.state_dict(),
+                        epoch=epoch_value)
+                rotate = None
+                if which_epoch != 'latest' and keep > 0:
+                    rotate = (os.path.join(self.save_dir, '[0-9]*_net_%s.pth' % name), keep)
+                self.ckpt_writer.save(ckpt, save_path, rotate=rotate)
 
     def __patch_instance_norm_state_dict(self, state_dict, module, keys, i=0):
         key = keys[i]
@@ -1,4 +1,9 @@
 #-*- coding:utf-8 -*-
+import sys
+sys.path.append('../')
+# the repository root, for the reid_common package
+sys.path.append('../../')
+
 import os
 from options.test_options import TestOptions
 from data import CreateDataset
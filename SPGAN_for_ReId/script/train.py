@@ -1,4 +1,9 @@
 #-*- coding:utf-8 -*-
+import sys
+sys.path.append('../')
+# the repository root, for the reid_common package
+sys.path.append('../../')
+
 import time
 from options.train_options import TrainOptions
 from data import CustomDatasetDataLoader
@@ -0,0 +1,177 @@
+#-*- coding:utf-8 -*-
+#===================================
+# inference throughput benchmark of the three model families
+#===================================
+"""
+Measures images/sec and the p50/p99 latency of a forward pass against batch
+size and thread count, on cpu by default, for the AlignedReID `Model`
+(ResNet-50 + local branch), the MGN `MGN` (three branches) and the SPGAN
+`ResnetGenerator`. Weights are random, nothing is downloaded, so the numbers
+only speak for speed. The report is written as JSON.
+
+    python inference_bench.py --models aligned,mgn --batch_sizes 1,16 --threads 1,8
+"""
+from __future__ import print_function
+
+import os
+import os.path as osp
+import sys
+import json
+import time
+import platform
+import argparse
+import importlib
+import importlib.util
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from kernel_bench import ROOT, load_module
+
+
+def load_package(name, rel_dir):
+    """Load a package by directory, so that its relative imports work."""
+    path = osp.join(ROOT, rel_dir)
+    spec = importlib.util.spec_from_file_location(
+        name, osp.join(path, '__init__.py'), submodule_search_locations=[path])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_aligned():
+    load_package('aligned_model', 'AlignedReID/model')
+    model = importlib.import_module('aligned_model.model')
+    return model.Model(local_conv_out_channels=128, pretrained=False)
+
+
+def make_mgn():
+    mgn = load_module('mgn_model', 'MGN-pytorch/model/mgn.py')
+    args = argparse.Namespace(num_classes=751, pool='avg', feats=256, random_init=True,
+                              fused_heads=False)
+    return mgn.MGN(args)
+
+
+def make_spgan():
+    networks = load_module('spgan_networks', 'SPGAN_for_ReId/models/networks.py')
+    # the default netG: resnet_9blocks, instance norm, no dropout
+    return networks.ResnetGenerator(3, 3, 64, norm_layer=networks.get_norm_layer('instance'),
+                                    use_dropout=False, n_blocks=9)
+
+
+# model name -> (constructor, default input size (h, w))
+MODELS = OrderedDict([
+    ('aligned', (make_aligned, (416, 208))),
+    ('mgn', (make_mgn, (384, 128))),
+    ('spgan', (make_spgan, (256, 256))),
+])
+
+
+def parse_ints(s):
+    return [int(v) for v in s.split(',') if v != '']
+
+
+def bench(model, batch_size, size, device, args):
+    """
+    Returns:
+        dict with the per batch latencies (seconds) summarized, and the
+        images per second
+    """
+    x = torch.randn(batch_size, 3, size[0], size[1], device=device)
+    with torch.no_grad():
+        for _ in range(args.warmup):
+            model(x)
+        latencies = []
+        start = time.time()
+        while len(latencies) < args.min_iters or (
+                time.time() - start < args.min_time and len(latencies) < args.max_iters):
+            t = time.time()
+            model(x)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            latencies.append(time.time() - t)
+    latencies = np.array(latencies)
+    p50, p99 = np.percentile(latencies, [50, 99])
+    return OrderedDict([
+        ('iters', len(latencies)),
+        ('latency_mean', float(latencies.mean())),
+        ('latency_p50', float(p50)),
+        ('latency_p99', float(p99)),
+        ('ims_per_sec', batch_size / float(latencies.mean())),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the inference throughput')
+    parser.add_argument('--models', type=str, default=','.join(MODELS))
+    parser.add_argument('--batch_sizes', type=str, default='1,8,32')
+    parser.add_argument('--threads', type=str, default='1,{}'.format(os.cpu_count()),
+                        help='comma separated torch thread counts')
+    parser.add_argument('--sizes', type=str, default='',
+                        help='input sizes overriding the defaults, e.g. aligned=256x128,mgn=384x128')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--mgn_branch_exec', type=str, default='serial',
+                        choices=('serial', 'grouped', 'fork'), help='see MGN.set_branch_executor')
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--min_iters', type=int, default=5)
+    parser.add_argument('--max_iters', type=int, default=200)
+    parser.add_argument('--min_time', type=float, default=3.,
+                        help='seconds every configuration runs at least (within max_iters)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='inference_bench.json')
+    args = parser.parse_args()
+
+    sizes = dict((name, size) for name, (_, size) in MODELS.items())
+    for item in args.sizes.split(','):
+        if item != '':
+            name, size = item.split('=')
+            sizes[name] = tuple(int(v) for v in size.split('x'))
+
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    results = []
+    for name in args.models.split(','):
+        assert name in MODELS, 'unknown model {}'.format(name)
+        model = MODELS[name][0]().to(device).eval()
+        if name == 'mgn':
+            model.set_branch_executor(args.mgn_branch_exec)
+        num_params = sum(p.numel() for p in model.parameters())
+        for threads in parse_ints(args.threads):
+            torch.set_num_threads(threads)
+            for batch_size in parse_ints(args.batch_sizes):
+                r = OrderedDict([
+                    ('model', name),
+                    ('input_size', list(sizes[name])),
+                    ('num_params', num_params),
+                    ('threads', threads),
+                    ('batch_size', batch_size),
+                ])
+                r.update(bench(model, batch_size, sizes[name], device, args))
+                results.append(r)
+                print('{:8s} threads {:3d} batch {:4d}: {:8.1f} ims/s, p50 {:8.1f}ms, p99 {:8.1f}ms'.format(
+                    name, threads, batch_size, r['ims_per_sec'],
+                    r['latency_p50'] * 1e3, r['latency_p99'] * 1e3))
+        del model
+
+    report = OrderedDict([
+        ('meta', OrderedDict([
+            ('time', time.strftime('%Y-%m-%d %H:%M:%S')),
+            ('platform', platform.platform()),
+            ('processor', platform.processor()),
+            ('python', platform.python_version()),
+            ('torch', torch.__version__),
+            ('cpu_count', os.cpu_count()),
+            ('device', args.device),
+            ('mgn_branch_exec', args.mgn_branch_exec),
+        ])),
+        ('results', results),
+    ])
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results saved to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
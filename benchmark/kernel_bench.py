@@ -0,0 +1,380 @@
+#-*- coding:utf-8 -*-
+#===================================
+# benchmark of the distance, mining, dp, re-ranking and metric kernels
+#===================================
+"""
+Times the hot numeric kernels of AlignedReID and MGN-pytorch on synthetic
+features shaped like the Market1501, DukeMTMC-reID and MSMT17 test sets.
+Every (kernel, scale) case runs in a fresh process, so its peak RSS is its
+own. Results (wall time, throughput, peak RSS and a digest of the output) are
+written to JSON; given a baseline JSON of an earlier run, a case that is
+slower than the tolerance or whose output changed fails the run.
+
+    python kernel_bench.py --output after.json --baseline before.json
+
+The modules are loaded by file path, the projects can not share one
+sys.path (both have a `model` package).
+"""
+from __future__ import print_function
+
+import os
+import os.path as osp
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import importlib.util
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+
+ROOT = osp.dirname(osp.dirname(osp.abspath(__file__)))
+
+# test set shapes: query images, gallery images, test ids
+SCALES = OrderedDict([
+    ('market1501', dict(num_query=3368, num_gallery=15913, num_ids=750)),
+    ('duke', dict(num_query=2228, num_gallery=17661, num_ids=1110)),
+    ('msmt17', dict(num_query=11659, num_gallery=82161, num_ids=3060)),
+])
+FEAT_DIM = 2048
+# AlignedReID local features: 8 horizontal stripes of 128 channels
+NUM_PARTS = 8
+LOCAL_DIM = 128
+# training batch, ids_per_batch x ims_per_id
+IDS_PER_BATCH = 32
+IMS_PER_ID = 4
+
+KERNELS = OrderedDict()
+
+
+def kernel(name, unit, max_query=None, max_gallery=None):
+    """
+    Register a kernel. The decorated function gets the shape of the case and
+    a RandomState, prepares the inputs and returns (run, num_items): `run()`
+    calls the kernel once and returns its output, throughput is reported in
+    `unit`s (num_items per call) per second.
+    max_query, max_gallery: caps of kernels that are quadratic in memory or
+        slow per element, applied on top of --max_query
+    """
+    def register(fn):
+        KERNELS[name] = dict(fn=fn, unit=unit, max_query=max_query, max_gallery=max_gallery)
+        return fn
+    return register
+
+
+def load_module(name, rel_path):
+    spec = importlib.util.spec_from_file_location(name, osp.join(ROOT, rel_path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def aligned_loss():
+    return load_module('aligned_loss', 'AlignedReID/model/loss.py')
+
+
+def eval_set(shape, rng, dim=FEAT_DIM):
+    """
+    L2 normalized features clustered by id, query ids are a subset of the
+    gallery ids, 6 cameras.
+    """
+    num_query, num_gallery = shape['num_query'], shape['num_gallery']
+    centers = rng.randn(shape['num_ids'], dim).astype(np.float32)
+    q_ids = rng.randint(shape['num_ids'], size=num_query)
+    g_ids = np.concatenate([q_ids, rng.randint(shape['num_ids'], size=num_gallery)])[:num_gallery]
+    rng.shuffle(g_ids)
+    q_feat = centers[q_ids] + rng.randn(num_query, dim).astype(np.float32)
+    g_feat = centers[g_ids] + rng.randn(num_gallery, dim).astype(np.float32)
+    q_feat /= np.linalg.norm(q_feat, axis=1, keepdims=True)
+    g_feat /= np.linalg.norm(g_feat, axis=1, keepdims=True)
+    q_cams = rng.randint(6, size=num_query)
+    g_cams = rng.randint(6, size=num_gallery)
+    return q_feat, g_feat, q_ids, g_ids, q_cams, g_cams
+
+
+def train_batch(rng, torch):
+    labels = np.repeat(np.arange(IDS_PER_BATCH), IMS_PER_ID)
+    feat = rng.randn(len(labels), FEAT_DIM).astype(np.float32)
+    return torch.from_numpy(feat), torch.from_numpy(labels).long()
+
+
+@kernel('aligned.compute_dist', 'pairs')
+def bench_compute_dist(shape, rng):
+    import torch
+    loss = aligned_loss()
+    q_feat, g_feat = [torch.from_numpy(f) for f in eval_set(shape, rng)[:2]]
+    return lambda: loss.compute_dist(q_feat, g_feat), len(q_feat) * len(g_feat)
+
+
+@kernel('aligned.compute_dist_np', 'pairs')
+def bench_compute_dist_np(shape, rng):
+    loss = aligned_loss()
+    q_feat, g_feat = eval_set(shape, rng)[:2]
+    return lambda: loss.compute_dist_np(q_feat, g_feat), len(q_feat) * len(g_feat)
+
+
+@kernel('aligned.hard_example_mining', 'anchors')
+def bench_hard_example_mining(shape, rng):
+    import torch
+    loss = aligned_loss()
+    feat, labels = train_batch(rng, torch)
+    dist_mat = loss.compute_dist(feat, feat)
+    return lambda: loss.hard_example_mining(dist_mat, labels, return_inds=True), len(labels)
+
+
+@kernel('aligned.shortest_dist', 'pairs')
+def bench_shortest_dist(shape, rng):
+    import torch
+    loss = aligned_loss()
+    # the local distance of the mined (anchor, sample) pairs of a batch
+    dist_mat = torch.from_numpy(
+        rng.rand(NUM_PARTS, NUM_PARTS, IDS_PER_BATCH * IMS_PER_ID).astype(np.float32))
+    return lambda: loss.shortest_dist(dist_mat), dist_mat.size(2)
+
+
+@kernel('aligned.shortest_dist_np', 'pairs', max_query=128, max_gallery=2048)
+def bench_shortest_dist_np(shape, rng):
+    loss = aligned_loss()
+    dist_mat = rng.rand(NUM_PARTS, NUM_PARTS, shape['num_query'],
+                        shape['num_gallery']).astype(np.float32)
+    return lambda: loss.shortest_dist_np(dist_mat), shape['num_query'] * shape['num_gallery']
+
+
+@kernel('aligned.local_dist_mat_np', 'pairs', max_query=64, max_gallery=2048)
+def bench_local_dist_mat_np(shape, rng):
+    loss = aligned_loss()
+    q_feat = rng.randn(shape['num_query'], NUM_PARTS, LOCAL_DIM).astype(np.float32)
+    g_feat = rng.randn(shape['num_gallery'], NUM_PARTS, LOCAL_DIM).astype(np.float32)
+    return lambda: loss.local_dist_mat_np(q_feat, g_feat), len(q_feat) * len(g_feat)
+
+
+@kernel('aligned.re_ranking', 'queries', max_query=500, max_gallery=5000)
+def bench_aligned_re_ranking(shape, rng):
+    loss = aligned_loss()
+    re_ranking = load_module('aligned_re_ranking', 'AlignedReID/reid_utils/re_ranking.py')
+    q_feat, g_feat = eval_set(shape, rng)[:2]
+    q_g = loss.compute_dist_np(q_feat, g_feat)
+    q_q = loss.compute_dist_np(q_feat, q_feat)
+    g_g = loss.compute_dist_np(g_feat, g_feat)
+    return lambda: re_ranking.re_ranking(q_g, q_q, g_g), len(q_feat)
+
+
+@kernel('mgn.re_ranking', 'queries', max_query=500, max_gallery=5000)
+def bench_mgn_re_ranking(shape, rng):
+    re_ranking = load_module('mgn_re_ranking', 'MGN-pytorch/utils/re_ranking.py')
+    q_feat, g_feat = eval_set(shape, rng)[:2]
+    # MGN re-ranks inner products of normalized features
+    q_g = np.dot(q_feat, g_feat.T)
+    q_q = np.dot(q_feat, q_feat.T)
+    g_g = np.dot(g_feat, g_feat.T)
+    return lambda: re_ranking.re_ranking(q_g, q_q, g_g), len(q_feat)
+
+
+def bench_metric(shape, rng, rel_path, fn_name):
+    loss = aligned_loss()
+    metric = load_module(rel_path.replace('/', '_')[:-3], rel_path)
+    q_feat, g_feat, q_ids, g_ids, q_cams, g_cams = eval_set(shape, rng)
+    dist = loss.compute_dist_np(q_feat, g_feat)
+    fn = getattr(metric, fn_name)
+    if fn_name == 'cmc':
+        run = lambda: fn(dist, q_ids, g_ids, q_cams, g_cams, first_match_break=True)
+    else:
+        run = lambda: fn(dist, q_ids, g_ids, q_cams, g_cams)
+    return run, len(q_ids)
+
+
+@kernel('aligned.cmc', 'queries')
+def bench_aligned_cmc(shape, rng):
+    return bench_metric(shape, rng, 'AlignedReID/reid_utils/metric.py', 'cmc')
+
+
+@kernel('aligned.mean_ap', 'queries')
+def bench_aligned_mean_ap(shape, rng):
+    return bench_metric(shape, rng, 'AlignedReID/reid_utils/metric.py', 'mean_ap')
+
+
+@kernel('mgn.cmc', 'queries')
+def bench_mgn_cmc(shape, rng):
+    return bench_metric(shape, rng, 'MGN-pytorch/utils/functions.py', 'cmc')
+
+
+@kernel('mgn.mean_ap', 'queries')
+def bench_mgn_mean_ap(shape, rng):
+    return bench_metric(shape, rng, 'MGN-pytorch/utils/functions.py', 'mean_ap')
+
+
+def to_numpy(x):
+    if hasattr(x, 'detach'):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+def digest(result):
+    """Shape and sums of every array of a kernel output, to compare runs."""
+    if isinstance(result, (tuple, list)):
+        return [digest(r) for r in result]
+    a = to_numpy(result).astype(np.float64)
+    return dict(shape=list(a.shape), sum=float(a.sum()), abs_sum=float(np.abs(a).sum()))
+
+
+def same_digest(a, b, rtol):
+    if isinstance(a, list) or isinstance(b, list):
+        return (isinstance(a, list) and isinstance(b, list) and len(a) == len(b)
+                and all(same_digest(x, y, rtol) for x, y in zip(a, b)))
+    return (a['shape'] == b['shape']
+            and np.allclose([a['sum'], a['abs_sum']], [b['sum'], b['abs_sum']], rtol=rtol, atol=1e-6))
+
+
+def max_rss_mb():
+    # kilobytes on linux, bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024. ** 2 if sys.platform == 'darwin' else rss / 1024.
+
+
+def run_case(name, scale, args):
+    """Worker process: time one kernel at one scale."""
+    if args.threads > 0:
+        import torch
+        torch.set_num_threads(args.threads)
+    spec = KERNELS[name]
+    shape = dict(SCALES[scale])
+    for key, cap in (('num_query', spec['max_query']), ('num_query', args.max_query),
+                     ('num_gallery', spec['max_gallery'])):
+        if cap:
+            shape[key] = min(shape[key], cap)
+    rng = np.random.RandomState(args.seed)
+    run, num_items = spec['fn'](shape, rng)
+    rss_before = max_rss_mb()
+
+    # first call warms up and gives the output, then as many calls per
+    # repeat as fit in --min_time
+    start = time.time()
+    result = run()
+    elapsed = time.time() - start
+    number = 1
+    while elapsed * number < args.min_time:
+        number *= 2
+    times = []
+    for _ in range(args.repeats):
+        start = time.time()
+        for _ in range(number):
+            run()
+        times.append((time.time() - start) / number)
+    rss_after = max_rss_mb()
+
+    median = float(np.median(times))
+    return OrderedDict([
+        ('kernel', name),
+        ('scale', scale),
+        ('shape', shape),
+        ('calls_per_repeat', number),
+        ('time_min', float(np.min(times))),
+        ('time_median', median),
+        ('throughput', num_items / max(median, 1e-12)),
+        ('unit', spec['unit'] + '/s'),
+        ('peak_rss_mb', rss_after),
+        ('kernel_rss_mb', max(rss_after - rss_before, 0.)),
+        ('digest', digest(result)),
+    ])
+
+
+def compare(results, baseline, tolerance, rtol):
+    """
+    Returns:
+        the failure messages of the cases that got slower than
+        baseline * (1 + tolerance) or whose output changed
+    """
+    base = dict(((r['kernel'], r['scale']), r) for r in baseline['results'])
+    failures = []
+    for r in results:
+        b = base.get((r['kernel'], r['scale']))
+        if b is None:
+            continue
+        ratio = r['time_median'] / max(b['time_median'], 1e-12)
+        r['baseline_ratio'] = ratio
+        if ratio > 1 + tolerance:
+            failures.append('{} @ {}: {:.2f}x slower than baseline'.format(
+                r['kernel'], r['scale'], ratio))
+        if b['shape'] == r['shape'] and not same_digest(r['digest'], b['digest'], rtol):
+            failures.append('{} @ {}: output differs from baseline'.format(r['kernel'], r['scale']))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the reid kernels')
+    parser.add_argument('--kernels', type=str, default='all',
+                        help='comma separated kernel names, or all: ' + ', '.join(KERNELS))
+    parser.add_argument('--scales', type=str, default='market1501,duke,msmt17')
+    parser.add_argument('--max_query', type=int, default=2000,
+                        help='cap of query images of every case, 0 runs the full query sets')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--min_time', type=float, default=0.2,
+                        help='seconds a repeat lasts at least, fast kernels are called in a loop')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='torch threads, 0 keeps the default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='kernel_bench.json')
+    parser.add_argument('--baseline', type=str, default='',
+                        help='JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slow down against the baseline')
+    parser.add_argument('--rtol', type=float, default=1e-4,
+                        help='relative tolerance of the output digests')
+    args = parser.parse_args()
+
+    names = list(KERNELS) if args.kernels == 'all' else args.kernels.split(',')
+    scales = args.scales.split(',')
+    for name in names:
+        assert name in KERNELS, 'unknown kernel {}'.format(name)
+    for scale in scales:
+        assert scale in SCALES, 'unknown scale {}'.format(scale)
+
+    # a fresh process per case, so that peak RSS is per case
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for name in names:
+        for scale in scales:
+            pool = ctx.Pool(1)
+            try:
+                r = pool.apply(run_case, (name, scale, args))
+            finally:
+                pool.close()
+                pool.join()
+            results.append(r)
+            print('{:28s} {:10s} {:10.4f}s {:14.1f} {:12s} {:8.0f}MB'.format(
+                name, scale, r['time_median'], r['throughput'], r['unit'], r['peak_rss_mb']))
+
+    failures = []
+    if args.baseline != '':
+        with open(args.baseline) as f:
+            failures = compare(results, json.load(f), args.tolerance, args.rtol)
+
+    import torch
+    report = OrderedDict([
+        ('meta', OrderedDict([
+            ('time', time.strftime('%Y-%m-%d %H:%M:%S')),
+            ('platform', platform.platform()),
+            ('python', platform.python_version()),
+            ('numpy', np.__version__),
+            ('torch', torch.__version__),
+            ('cpu_count', os.cpu_count()),
+            ('threads', args.threads if args.threads > 0 else torch.get_num_threads()),
+        ])),
+        ('results', results),
+        ('failures', failures),
+    ])
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results saved to {}'.format(args.output))
+
+    for failure in failures:
+        print('REGRESSION: ' + failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#-*- coding:utf-8 -*-
+#===================================
+# asynchronous, atomic checkpoint writing
+#===================================
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import glob
+import queue
+import shutil
+import atexit
+import threading
+
+import torch
+
+
+def snapshot_state(obj):
+    """
+    Copy every tensor of a (nested) state dict to cpu, so that training can
+    go on changing the originals. Gpu tensors are copied asynchronously into
+    pinned memory.
+    Returns:
+        the copy and a cuda event to wait on before the copy is used, or None
+    """
+    copied_from_gpu = []
+
+    def copy(value):
+        if torch.is_tensor(value):
+            value = value.detach()
+            if value.is_cuda:
+                buf = torch.empty(value.size(), dtype=value.dtype, pin_memory=True)
+                buf.copy_(value, non_blocking=True)
+                copied_from_gpu.append(buf)
+                return buf
+            return value.clone()
+        if isinstance(value, dict):
+            return type(value)((k, copy(v)) for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return type(value)(copy(v) for v in value)
+        return value
+
+    obj = copy(obj)
+    event = None
+    if copied_from_gpu:
+        event = torch.cuda.Event()
+        event.record()
+    return obj, event
+
+
+def rotate_files(pattern, keep):
+    """
+    Remove all but the `keep` newest files matching a glob pattern.
+    """
+    paths = sorted(glob.glob(pattern), key=os.path.getmtime)
+    for path in paths[:max(len(paths) - keep, 0)]:
+        os.remove(path)
+
+
+class AsyncCheckpointWriter(object):
+    """
+    Writes checkpoints on a background thread so that training does not wait
+    on the disk. `save` snapshots the tensors to cpu and returns at once; the
+    file is written to `<path>.tmp` and renamed into place, so a crash never
+    leaves a truncated checkpoint behind. Pending writes are finished at exit.
+    Args:
+        max_pending: number of queued snapshots before `save` blocks, this
+            bounds the host memory held by snapshots
+    """
+
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def save(self, obj, path, links=(), rotate=None):
+        """
+        Args:
+            obj: the object to `torch.save`, its tensors are snapshotted now
+            path: the checkpoint file
+            links: other paths that become hard links (or copies) of the file
+            rotate: optional (glob pattern, keep) applied after the write,
+                see `rotate_files`
+        """
+        self.submit(self._write, snapshot_state(obj), path, links, rotate)
+
+    def submit(self, fn, *args):
+        """Run any other slow bookkeeping (plots, logs) on the writer thread."""
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        self.queue.put((fn, args))
+
+    def wait(self):
+        """Block until everything submitted is written."""
+        self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                fn, args = job
+                fn(*args)
+            except Exception as e:
+                print('Checkpoint writer failed: {}'.format(e))
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    @staticmethod
+    def _write(state, path, links, rotate):
+        obj, event = state
+        if event is not None:
+            event.synchronize()
+        dir_name = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        tmp_path = path + '.tmp'
+        torch.save(obj, tmp_path)
+        os.replace(tmp_path, path)
+        for link in links:
+            tmp_link = link + '.tmp'
+            if os.path.lexists(tmp_link):
+                os.remove(tmp_link)
+            try:
+                os.link(path, tmp_link)
+            except OSError:
+                shutil.copy(path, tmp_link)
+            os.replace(tmp_link, link)
+        if rotate is not None:
+            rotate_files(*rotate)
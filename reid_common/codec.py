@@ -0,0 +1,249 @@
+#-*- coding:utf-8 -*-
+#===================================
+# compressed embedding storage
+#===================================
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+class EncodedEmbeddings(object):
+    """
+    Gallery features stored by a codec, `codec.dist(query, encoded)`
+    computes the distances on the codes (asymmetric: the query stays
+    float32).
+    Args:
+        codec: the EmbeddingCodec that encoded them
+        codes: shape [n, ...], the codes of every vector
+        scales: shape [n], the per vector scale of int8 codes, else None
+        sq_norms: shape [n], the squared norm of every decoded vector
+        shape: the shape of one vector before flattening, e.g. (2048,) or (8, 128)
+    """
+
+    def __init__(self, codec, codes, scales, sq_norms, shape):
+        self.codec = codec
+        self.codes = codes
+        self.scales = scales
+        self.sq_norms = sq_norms
+        self.shape = shape
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.sq_norms.nbytes + \
+            (self.scales.nbytes if self.scales is not None else 0)
+
+    def decode(self):
+        return self.codec.decode(self)
+
+
+class EmbeddingCodec(object):
+    """
+    Base of the codecs: vectors are flattened, `dot` computes the inner
+    products of float32 queries with the codes, in chunks of `chunk_size`
+    gallery vectors so no float32 copy of the gallery is made, and the
+    euclidean or cosine distance follows from the squared norms.
+    """
+
+    def __init__(self, chunk_size=65536):
+        self.chunk_size = chunk_size
+
+    def fit(self, x):
+        """Learn the codec parameters from [n, ...] features, returns self."""
+        return self
+
+    def encode(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        shape = x.shape[1:]
+        x = x.reshape(len(x), -1)
+        codes, scales = self._encode(x)
+        encoded = EncodedEmbeddings(self, codes, scales, None, shape)
+        encoded.sq_norms = np.concatenate(
+            [np.square(self._decode(encoded, s)).sum(axis=1) for s in self._chunks(len(x))] or
+            [np.zeros(0, dtype=np.float32)]).astype(np.float32)
+        return encoded
+
+    def decode(self, encoded):
+        """The float32 features, shape [n, ...]."""
+        x = self._decode(encoded, slice(0, len(encoded)))
+        return x.reshape((len(encoded),) + tuple(encoded.shape))
+
+    def dot(self, q, encoded):
+        """
+        Args:
+            q: numpy array with shape [m, d], float32 queries
+            encoded: EncodedEmbeddings of n vectors of d values
+        Returns:
+            numpy array with shape [m, n], the inner products
+        """
+        q = np.asarray(q, dtype=np.float32).reshape(len(q), -1)
+        dot = np.empty((len(q), len(encoded)), dtype=np.float32)
+        prepared = self._prepare(q)
+        for s in self._chunks(len(encoded)):
+            dot[:, s] = self._dot(prepared, encoded, s)
+        return dot
+
+    def dist(self, q, encoded, type='euclidean'):
+        """
+        The 'euclidean' or 'cosine' distances of q to the decoded gallery.
+        """
+        assert type in ['cosine', 'euclidean']
+        q = np.asarray(q, dtype=np.float32).reshape(len(q), -1)
+        dot = self.dot(q, encoded)
+        square1 = np.sum(np.square(q), axis=1)[..., np.newaxis]
+        square2 = encoded.sq_norms[np.newaxis, ...]
+        if type == 'cosine':
+            eps = np.finfo(np.float32).eps
+            return 1 - dot / ((np.sqrt(square1) + eps) * (np.sqrt(square2) + eps))
+        squared_dist = - 2 * dot + square1 + square2
+        squared_dist[squared_dist < 0] = 0
+        return np.sqrt(squared_dist)
+
+    def _chunks(self, n):
+        return [slice(i, min(i + self.chunk_size, n)) for i in range(0, n, self.chunk_size)]
+
+    def _encode(self, x):
+        raise NotImplementedError
+
+    def _decode(self, encoded, s):
+        """The float32 vectors of slice s, shape [len, d]."""
+        raise NotImplementedError
+
+    def _prepare(self, q):
+        """What `_dot` needs of the [m, d] queries, computed once per `dot`."""
+        return q
+
+    def _dot(self, q, encoded, s):
+        return np.matmul(q, self._decode(encoded, s).T)
+
+
+class Float16Codec(EmbeddingCodec):
+    """float16 values, 2x smaller."""
+
+    def _encode(self, x):
+        return x.astype(np.float16), None
+
+    def _decode(self, encoded, s):
+        return encoded.codes[s].astype(np.float32)
+
+
+class Int8Codec(EmbeddingCodec):
+    """int8 values with one float32 scale per vector (max |x| / 127), ~4x smaller."""
+
+    def _encode(self, x):
+        scales = np.abs(x).max(axis=1) / 127.
+        scales[scales == 0] = 1.
+        codes = np.clip(np.round(x / scales[:, np.newaxis]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    def _decode(self, encoded, s):
+        return encoded.codes[s].astype(np.float32) * encoded.scales[s, np.newaxis]
+
+    def _dot(self, q, encoded, s):
+        # the scale factors out of the inner product
+        return np.matmul(q, encoded.codes[s].T.astype(np.float32)) * encoded.scales[np.newaxis, s]
+
+
+class PQCodec(EmbeddingCodec):
+    """
+    Product quantization: the vector is split in `num_subspaces` parts and
+    every part is stored as the uint8 index of its nearest of
+    `num_centroids` k-means centroids, num_subspaces bytes per vector (64
+    bytes for 2048-d, 128x smaller). Inner products are summed from per
+    query lookup tables of the part-centroid products (ADC).
+    Args:
+        num_subspaces: number of parts, must divide the dimension
+        num_centroids: centroids per part, at most 256
+        iters: k-means iterations
+        max_train: number of vectors k-means is fitted on, a random sample
+    """
+
+    def __init__(self, num_subspaces=64, num_centroids=256, iters=20, max_train=65536,
+                 seed=0, chunk_size=65536):
+        super(PQCodec, self).__init__(chunk_size)
+        assert num_centroids <= 256
+        self.num_subspaces = num_subspaces
+        self.num_centroids = num_centroids
+        self.iters = iters
+        self.max_train = max_train
+        self.seed = seed
+        # shape [num_subspaces, num_centroids, sub_dim]
+        self.centroids = None
+
+    def fit(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        x = x.reshape(len(x), -1)
+        assert x.shape[1] % self.num_subspaces == 0, \
+            'dimension {} is not divisible by {} subspaces'.format(x.shape[1], self.num_subspaces)
+        rng = np.random.RandomState(self.seed)
+        if len(x) > self.max_train:
+            x = x[rng.choice(len(x), self.max_train, replace=False)]
+        k = min(self.num_centroids, len(x))
+        subs = x.reshape(len(x), self.num_subspaces, -1).transpose(1, 0, 2)
+        self.centroids = np.stack([self._kmeans(sub, k, rng) for sub in subs])
+        return self
+
+    def _kmeans(self, x, k, rng):
+        centroids = x[rng.choice(len(x), k, replace=False)].copy()
+        for _ in range(self.iters):
+            assign = self._assign(x, centroids)
+            counts = np.bincount(assign, minlength=k)
+            sums = np.stack([np.bincount(assign, weights=x[:, d], minlength=k)
+                             for d in range(x.shape[1])], axis=1)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+            # restart empty clusters on random points
+            if not filled.all():
+                centroids[~filled] = x[rng.choice(len(x), (~filled).sum())]
+        return centroids
+
+    @staticmethod
+    def _assign(x, centroids):
+        dist = np.square(centroids).sum(axis=1)[np.newaxis] - 2 * np.matmul(x, centroids.T)
+        return dist.argmin(axis=1)
+
+    def _encode(self, x):
+        assert self.centroids is not None, 'fit the codec first'
+        subs = x.reshape(len(x), self.num_subspaces, -1)
+        codes = np.empty((len(x), self.num_subspaces), dtype=np.uint8)
+        for m in range(self.num_subspaces):
+            codes[:, m] = self._assign(subs[:, m], self.centroids[m])
+        return codes, None
+
+    def _decode(self, encoded, s):
+        codes = encoded.codes[s]
+        # shape [len, num_subspaces, sub_dim]
+        x = self.centroids[np.arange(self.num_subspaces)[np.newaxis], codes]
+        return x.reshape(len(codes), -1)
+
+    def _prepare(self, q):
+        # lookup tables, shape [m, num_subspaces, num_centroids]
+        return np.einsum('qmd,mkd->qmk', q.reshape(len(q), self.num_subspaces, -1), self.centroids)
+
+    def _dot(self, tables, encoded, s):
+        codes = encoded.codes[s]
+        dot = np.zeros((len(tables), len(codes)), dtype=np.float32)
+        for m in range(self.num_subspaces):
+            dot += tables[:, m, codes[:, m]]
+        return dot
+
+
+CODECS = {
+    'float16': Float16Codec,
+    'int8': Int8Codec,
+    'pq': PQCodec,
+}
+
+
+def make_codec(name, **kwargs):
+    """
+    Args:
+        name: 'float16', 'int8' or 'pq'
+        kwargs: arguments of the codec, e.g. num_subspaces for 'pq'
+    """
+    assert name in CODECS, 'unknown codec {}'.format(name)
+    return CODECS[name](**kwargs)
@@ -0,0 +1,129 @@
+#-*- coding:utf-8 -*-
+#===================================
+# multi-process data parallel training
+#===================================
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import datetime
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend='gloo', timeout_minutes=60):
+    '''
+    Join the process group of a `torchrun` launch, read from the RANK,
+    WORLD_SIZE, MASTER_ADDR and MASTER_PORT environment variables.
+    args:
+        backend: 'gloo' runs on cpu, 'nccl' on gpus
+        timeout_minutes: how long a collective waits for the other ranks,
+            rank 0 validates alone while they wait
+    returns:
+        (rank, world_size), (0, 1) when the process was not launched by
+        torchrun
+    '''
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend,
+                                timeout=datetime.timedelta(minutes=timeout_minutes))
+    print('Rank {} of {} ({})'.format(dist.get_rank(), dist.get_world_size(), backend))
+    return dist.get_rank(), dist.get_world_size()
+
+
+def get_local_rank():
+    '''
+    (local_rank, local_world_size): the place of the process among the
+    ranks on its host, from the torchrun environment, (0, 1) without it.
+    '''
+    return int(os.environ.get('LOCAL_RANK', 0)), int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    '''
+    Rank 0, the one that saves checkpoints, logs and validates.
+    '''
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def shared_seed():
+    '''
+    A random seed drawn on rank 0 and broadcast, the samplers of all ranks
+    seeded with it draw the same batches.
+    '''
+    seed = torch.randint(0, 2 ** 31 - 1, (1,), dtype=torch.int64)
+    if is_distributed():
+        dist.broadcast(seed, 0)
+    return int(seed.item())
+
+
+def broadcast_object(obj):
+    '''
+    The obj (picklable) of rank 0 on all ranks, e.g. a name drawn from the
+    clock; obj itself when not distributed.
+    '''
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, 0)
+    return objects[0]
+
+
+class _AllGather(torch.autograd.Function):
+    '''
+    Concatenate the tensors of all ranks along dim 0. Every rank computes
+    the loss of the global batch, so the gradients of the gathered tensor
+    are summed over the ranks and the slice of this rank is returned; with
+    the gradient averaging of DistributedDataParallel the parameters get the
+    gradient of the global batch loss.
+    '''
+
+    @staticmethod
+    def forward(ctx, x):
+        x = x.contiguous()
+        out = [torch.empty_like(x) for _ in range(dist.get_world_size())]
+        dist.all_gather(out, x)
+        ctx.start = dist.get_rank() * x.size(0)
+        ctx.size = x.size(0)
+        return torch.cat(out)
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.contiguous()
+        dist.all_reduce(grad)
+        return grad[ctx.start:ctx.start + ctx.size]
+
+
+def all_gather(x):
+    '''
+    The tensors of all ranks concatenated in rank order, shape
+    [world_size * B, ...]; differentiable when x requires grad. All ranks
+    must pass the same batch size. Returns x unchanged when not distributed.
+    '''
+    if not is_distributed():
+        return x
+    if x.requires_grad:
+        return _AllGather.apply(x)
+    out = [torch.empty_like(x) for _ in range(dist.get_world_size())]
+    dist.all_gather(out, x.contiguous())
+    return torch.cat(out)
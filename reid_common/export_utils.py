@@ -0,0 +1,146 @@
+#-*- coding:utf-8 -*-
+#===================================
+# model export and quantization
+#===================================
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import os.path as osp
+import copy
+
+import torch
+
+
+def _make_parent_dir(path):
+    parent = osp.dirname(osp.abspath(path))
+    if not osp.exists(parent):
+        os.makedirs(parent)
+
+
+def fold_bn(module):
+    '''
+    Fold every eval mode BatchNorm2d into the convolution feeding it, in
+    place, the BatchNorm becomes an Identity. A pair is a child 'conv<x>'
+    with a child 'bn<x>' (conv1/bn1 of the Bottlenecks, local_conv/local_bn),
+    or adjacent entries of a Sequential (downsample, the MGN backbone and
+    reductions), so the convolution output must only go through its
+    BatchNorm.
+    args:
+        module: the model in eval mode
+    return:
+        module: the same module
+    '''
+    from torch.nn.utils.fusion import fuse_conv_bn_eval
+    for parent in list(module.modules()):
+        children = list(parent.named_children())
+        if isinstance(parent, torch.nn.Sequential):
+            pairs = [(a, b) for a, b in zip(children, children[1:])]
+        else:
+            named = dict(children)
+            pairs = [((name, child), (name.replace('conv', 'bn'), named[name.replace('conv', 'bn')]))
+                     for name, child in children
+                     if 'conv' in name and name.replace('conv', 'bn') in named]
+        for (conv_name, conv), (bn_name, bn) in pairs:
+            if isinstance(conv, torch.nn.Conv2d) and isinstance(bn, torch.nn.BatchNorm2d):
+                setattr(parent, conv_name, fuse_conv_bn_eval(conv, bn))
+                setattr(parent, bn_name, torch.nn.Identity())
+    return module
+
+
+class EmbeddingModule(torch.nn.Module):
+    '''
+    `model(x, mode=mode)` as a plain forward, for tracing.
+    '''
+
+    def __init__(self, model, mode):
+        super(EmbeddingModule, self).__init__()
+        self.model = model
+        self.mode = mode
+
+    def forward(self, x):
+        return self.model(x, mode=self.mode)
+
+
+def export_model(model, input_size, mode, torchscript_file='', onnx_file='', optimize=False):
+    '''
+    Export the embedding of a model for deployment: BatchNorm folded into
+    the convolutions, then traced and frozen to TorchScript (load it with
+    torch.jit.load) and/or exported to ONNX, with a dynamic batch size.
+    The model is modified in place, build it again to train.
+    args:
+        model: the model, its forward takes `mode`
+        input_size: (h, w) of the input images
+        mode: the forward mode, 'embed' or 'embed_global'
+        torchscript_file: path of the frozen TorchScript module, '' to skip
+        onnx_file: path of the ONNX model, '' to skip, its outputs are
+            named feat_0, feat_1, ...
+        optimize: also apply torch.jit.optimize_for_inference (cpu kernels
+            specialized for the current machine)
+    '''
+    model = fold_bn(model.cpu().eval())
+    module = EmbeddingModule(model, mode).eval()
+    example = torch.randn(2, 3, input_size[0], input_size[1])
+    with torch.no_grad():
+        if torchscript_file != '':
+            traced = torch.jit.freeze(torch.jit.trace(module, example))
+            if optimize:
+                traced = torch.jit.optimize_for_inference(traced)
+            _make_parent_dir(torchscript_file)
+            torch.jit.save(traced, torchscript_file)
+            print('TorchScript model saved to {}'.format(torchscript_file))
+        if onnx_file != '':
+            outputs = module(example)
+            num_outputs = len(outputs) if isinstance(outputs, tuple) else 1
+            output_names = ['feat_{}'.format(i) for i in range(num_outputs)]
+            dynamic_axes = dict((name, {0: 'batch'}) for name in ['images'] + output_names)
+            _make_parent_dir(onnx_file)
+            torch.onnx.export(module, example, onnx_file, input_names=['images'],
+                              output_names=output_names, dynamic_axes=dynamic_axes,
+                              opset_version=11)
+            print('ONNX model saved to {}'.format(onnx_file))
+
+
+class FixedModeModule(torch.nn.Module):
+    '''
+    A module exported for one forward mode (traced, quantized), called like
+    the model it comes from.
+    '''
+
+    def __init__(self, module, mode):
+        super(FixedModeModule, self).__init__()
+        self.module = module
+        self.mode = mode
+
+    def forward(self, x, mode=None):
+        assert mode in (None, self.mode), 'the module only computes {}'.format(self.mode)
+        return self.module(x)
+
+
+def quantize_model(model, calib_batches, mode, backend='fbgemm'):
+    '''
+    Static post-training int8 quantization (FX graph mode) of the forward
+    of one mode: conv/BatchNorm/ReLU are fused, observers record the
+    activation ranges over the calibration batches, then the model is
+    converted to quantized cpu kernels. Ops without an int8 kernel (the
+    batched matmuls of the MGN --fused_heads) stay float. The float model
+    is not modified.
+    args:
+        model: the float model, its forward takes `mode`
+        calib_batches: list of cpu image batches, the first one is also the
+            tracing example
+        mode: the forward mode, 'embed' or 'embed_global'
+        backend: the quantized engine, 'fbgemm'/'x86' or 'qnnpack'
+    return:
+        the quantized FixedModeModule, on cpu
+    '''
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    torch.backends.quantized.engine = backend
+    module = EmbeddingModule(copy.deepcopy(model).cpu().eval(), mode).eval()
+    prepared = prepare_fx(module, get_default_qconfig_mapping(backend), (calib_batches[0],))
+    with torch.no_grad():
+        for ims in calib_batches:
+            prepared(ims)
+    return FixedModeModule(convert_fx(prepared), mode).eval()
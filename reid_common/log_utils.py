@@ -0,0 +1,209 @@
+#-*- coding:utf-8 -*-
+#===================================
+# buffered scalar logging and step profiling
+#===================================
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import os.path as osp
+import time
+import atexit
+import threading
+from collections import deque
+
+import numpy as np
+import torch
+
+
+class StepTimer(object):
+    """
+    Wall time spent waiting for data and on the whole step, for throughput.
+    Call `data_ready` when the batch arrives and `step_done` after the step.
+    """
+
+    def __init__(self):
+        self.last = time.time()
+        self.data_time = 0.
+
+    def data_ready(self):
+        self.data_time = time.time() - self.last
+
+    def step_done(self, batch_size):
+        """
+        Returns:
+            dict with the images per second and the data wait (seconds) of
+            the step
+        """
+        now = time.time()
+        step_time = max(now - self.last, 1e-12)
+        self.last = now
+        return dict(ims_per_sec=batch_size / step_time, data_wait=self.data_time)
+
+
+class ScalarLogger(object):
+    """
+    One logger for a whole run. Scalars are buffered in memory and written by
+    a background thread every `flush_secs` seconds, to one tensorboard event
+    file (opened on the first flush) and to `scalars.csv`. Tensor values are
+    copied on the device and converted on the flush thread, so logging never
+    waits for the device.
+    Args:
+        log_dir: directory of the event file and scalars.csv
+        flush_secs: seconds between flushes
+        tensorboard: also write a tensorboard event file (needs tensorboardX)
+    """
+
+    def __init__(self, log_dir, flush_secs=30, tensorboard=True):
+        self.log_dir = log_dir
+        self.flush_secs = flush_secs
+        self.tensorboard = tensorboard
+        self.writer = None
+        self.csv_file = None
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def add_scalar(self, tag, value, step):
+        if torch.is_tensor(value):
+            value = value.detach().clone()
+        with self.lock:
+            self.buffer.append((tag, value, step, time.time()))
+
+    def add_scalars(self, main_tag, tag_scalar_dict, step):
+        """Same layout as SummaryWriter.add_scalars, one chart per main_tag."""
+        for tag, value in tag_scalar_dict.items():
+            self.add_scalar(main_tag + '/' + tag, value, step)
+
+    def flush(self):
+        with self.lock:
+            buffer, self.buffer = self.buffer, []
+        if not buffer:
+            return
+        with self.flush_lock:
+            self._open()
+            for tag, value, step, wall_time in buffer:
+                value = float(value)
+                if self.writer is not None:
+                    self.writer.add_scalar(tag, value, step, walltime=wall_time)
+                self.csv_file.write('{:.3f},{},{},{}\n'.format(wall_time, step, tag, value))
+            if self.writer is not None:
+                self.writer.flush()
+            self.csv_file.flush()
+
+    def close(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+        if self.csv_file is not None:
+            self.csv_file.close()
+
+    def _open(self):
+        if self.csv_file is not None:
+            return
+        if not osp.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+        if self.tensorboard:
+            from tensorboardX import SummaryWriter
+            self.writer = SummaryWriter(log_dir=self.log_dir)
+        self.csv_file = open(osp.join(self.log_dir, 'scalars.csv'), 'a')
+
+    def _run(self):
+        while not self.stopped.wait(self.flush_secs):
+            try:
+                self.flush()
+            except Exception as e:
+                print('Scalar logger failed: {}'.format(e))
+
+
+class StepProfiler(object):
+    """
+    Wall time of every phase of a training step, to tell whether a config is
+    bound by the data loader or by the device. `mark(phase)` ends a phase,
+    `step()` ends the step (whatever ran after the last mark is 'other').
+    The 'data' phase runs from the end of the previous step to the batch.
+    The device is synchronized at every mark, so its time is charged to the
+    phase that queued the work; this costs the overlap of host and device,
+    so only enable the profiler to measure.
+    The last `window` samples of every phase are kept, percentiles are
+    printed every `summary_every` steps. With `trace_dir`, a torch.profiler
+    trace of steps [trace_start, trace_start + trace_steps) is written there.
+    """
+
+    PHASES = ('data', 'h2d', 'forward', 'loss', 'backward', 'optimizer', 'other')
+
+    def __init__(self, summary_every=0, window=1000, trace_dir='', trace_start=10,
+                 trace_steps=5):
+        self.enabled = summary_every > 0 or trace_dir != ''
+        self.summary_every = summary_every
+        self.samples = dict((phase, deque(maxlen=window)) for phase in self.PHASES)
+        self.current = {}
+        self.num_steps = 0
+        self.last = time.time()
+        self.trace = None
+        if self.enabled and trace_dir != '':
+            self.trace = torch.profiler.profile(
+                activities=[torch.profiler.ProfilerActivity.CPU]
+                + ([torch.profiler.ProfilerActivity.CUDA] if torch.cuda.is_available() else []),
+                schedule=torch.profiler.schedule(
+                    wait=max(trace_start - 1, 0), warmup=1, active=trace_steps, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+                record_shapes=True)
+            self.trace.start()
+            self.trace_end = max(trace_start - 1, 0) + 1 + trace_steps
+
+    def start(self):
+        """Restart the clock, call before the first batch of an epoch."""
+        self.last = time.time()
+
+    def mark(self, phase):
+        if not self.enabled:
+            return
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        now = time.time()
+        self.current[phase] = self.current.get(phase, 0.) + now - self.last
+        self.last = now
+
+    def step(self):
+        if not self.enabled:
+            return
+        self.mark('other')
+        for phase in self.PHASES:
+            self.samples[phase].append(self.current.get(phase, 0.))
+        self.current = {}
+        self.num_steps += 1
+        if self.trace is not None:
+            self.trace.step()
+            if self.num_steps >= self.trace_end:
+                self.trace.stop()
+                self.trace = None
+        if self.summary_every > 0 and self.num_steps % self.summary_every == 0:
+            print(self.summary())
+
+    def summary(self):
+        """
+        Returns:
+            one line with the share of the step and the p50/p90/p99 time (ms)
+            of every phase over the kept window
+        """
+        times = dict((phase, np.array(self.samples[phase])) for phase in self.PHASES)
+        total = sum(t.sum() for t in times.values()) + 1e-12
+        logs = []
+        for phase in self.PHASES:
+            if len(times[phase]) == 0 or times[phase].sum() == 0:
+                continue
+            p50, p90, p99 = np.percentile(times[phase] * 1e3, [50, 90, 99])
+            logs.append('{} {:.0%} ({:.1f}/{:.1f}/{:.1f}ms)'.format(
+                phase, times[phase].sum() / total, p50, p90, p99))
+        return 'Step {} profile, p50/p90/p99: {}'.format(self.num_steps, ', '.join(logs))
@@ -0,0 +1,143 @@
+#-*- coding:utf-8 -*-
+#===================================
+# cpu runtime configuration
+#===================================
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+
+import torch
+
+# the cores of the process before configure_runtime pinned its threads, the
+# data loader workers run on the ones the threads do not use
+_process_cores = None
+
+
+def configure_runtime(num_threads=0, interop_threads=0, pin_threads=False,
+                      local_rank=0, local_world_size=1):
+    '''
+    Set the intra-op and inter-op thread counts of the process, 0 keeps the
+    torch default. Inter-op threads can only be set before the first
+    parallel work, it is skipped with a warning after.
+    args:
+        pin_threads: pin the process to its first num_threads cores (of the
+            cores it may run on), the data loader workers then use the
+            others, see WorkerAffinity
+        local_rank, local_world_size: with several training processes on
+            the host, each is pinned within its own contiguous share of the
+            cores (a socket when there is one process per socket)
+    '''
+    global _process_cores
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            print('Warning: inter-op threads not set: {}'.format(e))
+    if pin_threads and hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        share = len(cores) // local_world_size
+        if share > 0:
+            cores = cores[local_rank * share:(local_rank + 1) * share]
+        _process_cores = cores
+        os.sched_setaffinity(0, cores[:num_threads] if num_threads > 0 else cores)
+    print('Runtime: {} intra-op threads, {} inter-op threads'.format(
+        torch.get_num_threads(), torch.get_num_interop_threads()))
+
+
+class WorkerAffinity(object):
+    '''
+    `worker_init_fn` of a DataLoader: every worker runs one thread, pinned
+    to its own core among the cores the compute threads do not use (the
+    first `num_threads`), round robin when there are more workers than
+    cores left.
+    '''
+
+    def __init__(self, num_threads=0):
+        self.num_threads = num_threads
+        if _process_cores is not None:
+            self.cores = _process_cores
+        else:
+            self.cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+
+    def __call__(self, worker_id):
+        torch.set_num_threads(1)
+        free = self.cores[self.num_threads:] or self.cores
+        if free:
+            os.sched_setaffinity(0, [free[worker_id % len(free)]])
+
+
+def to_channels_last(module_or_tensor, channels_last=True):
+    '''
+    The model (its 4-D weights) or the NCHW input batch in channels_last
+    memory format, the same values with NHWC strides. Returns it unchanged
+    when channels_last is False.
+    '''
+    if not channels_last:
+        return module_or_tensor
+    if isinstance(module_or_tensor, torch.nn.Module):
+        return module_or_tensor.to(memory_format=torch.channels_last)
+    if module_or_tensor.dim() != 4:
+        return module_or_tensor
+    return module_or_tensor.contiguous(memory_format=torch.channels_last)
+
+
+def measure_throughput(model, input_size, batch_size, train=False, warmup=2, iters=10):
+    '''
+    Images per second of the forward (and backward with train) of the
+    model on random inputs.
+    args:
+        input_size: (h, w)
+    '''
+    param = next(model.parameters())
+    x = torch.randn(batch_size, 3, input_size[0], input_size[1], device=param.device)
+    if param.is_contiguous(memory_format=torch.channels_last) and param.dim() == 4:
+        x = to_channels_last(x)
+    model.train(train)
+    with torch.set_grad_enabled(train):
+        for i in range(warmup + iters):
+            if i == warmup:
+                if x.is_cuda:
+                    torch.cuda.synchronize()
+                start = time.time()
+            outputs = model(x)
+            if train:
+                outputs = outputs[0] if isinstance(outputs, (list, tuple)) else outputs
+                outputs.float().sum().backward()
+                model.zero_grad()
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return batch_size * iters / max(time.time() - start, 1e-12)
+
+
+def tune_runtime(make_model, input_size, batch_size, thread_counts, train=False, iters=10):
+    '''
+    Measure the images/sec of every thread count with and without
+    channels_last on this host, and print them, best first.
+    args:
+        make_model: builds a new model (on the target device)
+        thread_counts: intra-op thread counts to try
+    returns:
+        list of dicts (num_threads, channels_last, ims_per_sec), best first
+    '''
+    results = []
+    default_threads = torch.get_num_threads()
+    for channels_last in (False, True):
+        model = to_channels_last(make_model(), channels_last)
+        for num_threads in thread_counts:
+            torch.set_num_threads(num_threads)
+            ims_per_sec = measure_throughput(model, input_size, batch_size, train, iters=iters)
+            results.append(dict(num_threads=num_threads, channels_last=channels_last,
+                                ims_per_sec=ims_per_sec))
+            print('threads {:3d} channels_last {:5s}: {:8.1f} ims/s'.format(
+                num_threads, str(channels_last), ims_per_sec))
+        del model
+    torch.set_num_threads(default_threads)
+    results.sort(key=lambda r: -r['ims_per_sec'])
+    print('Best: {num_threads} threads, channels_last {channels_last}, {ims_per_sec:.1f} ims/s'.format(
+        **results[0]))
+    return results
@@ -0,0 +1,305 @@
+#-*- coding:utf-8 -*-
+#===================================
+# batch samplers for training
+#===================================
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from torch.utils.data import sampler
+
+
+class BatchSampler(sampler.Sampler):
+    """
+    Yields P x K batches of dataset indices: `ids_per_batch` identities with
+    `ims_per_id` images each, for `DataLoader(batch_sampler=...)`.
+
+    Args:
+        ids: identity of every image, shape [N]
+        ids_per_batch: identities per batch (P)
+        ims_per_id: images per identity (K); identities with fewer images
+            cycle through all of them
+        cams: camera of every image, shape [N]; needed by `cam_balanced`
+        id_weight: 'uniform' visits every identity once per epoch; 'count',
+            'sqrt' or an array of per-identity weights (in ascending id order)
+            draw the identities of each batch with that probability instead
+        cam_balanced: spread the K images of an identity over its cameras
+        drop_last: drop the last batch if it has fewer than P identities
+        seed: seed of the sampler's own random state
+    """
+
+    def __init__(self, ids, ids_per_batch, ims_per_id, cams=None, id_weight='uniform',
+                 cam_balanced=False, drop_last=False, seed=None):
+        self.ids_per_batch = ids_per_batch
+        self.ims_per_id = ims_per_id
+        self.drop_last = drop_last
+        self.cam_balanced = cam_balanced
+        if cam_balanced:
+            assert cams is not None, 'camera balanced sampling needs the camera of every image'
+
+        self._rng = np.random.RandomState(seed)
+        self._ids = np.asarray(ids)
+        self._cams = None if cams is None else np.asarray(cams)
+        self._unique_ids, self._inverse, self._counts = np.unique(
+            self._ids, return_inverse=True, return_counts=True)
+        # first position of every identity once images are grouped by identity
+        self._starts = np.cumsum(self._counts) - self._counts
+        self._weights = self._id_weights(id_weight)
+
+    def __iter__(self):
+        order = self._grouped_order()
+        offsets = np.arange(self.ims_per_id)
+        for batch_ids in self._id_batches():
+            positions = self._starts[batch_ids][:, None] + \
+                        offsets[None, :] % self._counts[batch_ids][:, None]
+            yield order[positions].ravel().tolist()
+
+    @property
+    def full_batches(self):
+        """Whether every batch has P identities: drop_last, or weighted draws."""
+        return self.drop_last or self._weights is not None
+
+    def __len__(self):
+        num_ids = len(self._unique_ids)
+        if self.full_batches:
+            return max(num_ids // self.ids_per_batch, 1)
+        return (num_ids + self.ids_per_batch - 1) // self.ids_per_batch
+
+    def _id_weights(self, id_weight):
+        if isinstance(id_weight, str):
+            if id_weight == 'uniform':
+                return None
+            elif id_weight == 'count':
+                weights = self._counts.astype(np.float64)
+            elif id_weight == 'sqrt':
+                weights = np.sqrt(self._counts)
+            else:
+                raise ValueError('unknown id weighting: {}'.format(id_weight))
+        else:
+            weights = np.asarray(id_weight, dtype=np.float64)
+            assert weights.shape == self._unique_ids.shape, 'one weight per identity is needed'
+        return weights / weights.sum()
+
+    def _id_batches(self):
+        """
+        :return: identity (index into unique ids) batches of this epoch
+        """
+        num_ids = len(self._unique_ids)
+        if self._weights is None:
+            perm = self._rng.permutation(num_ids)
+            return [perm[i:i + self.ids_per_batch] for i in range(0, len(self) * self.ids_per_batch, self.ids_per_batch)]
+
+        # weighted sampling of P distinct identities per batch (Gumbel top-k)
+        ids_per_batch = min(self.ids_per_batch, num_ids)
+        with np.errstate(divide='ignore'):
+            scores = np.log(self._weights)[None, :] + self._rng.gumbel(size=(len(self), num_ids))
+        return np.argpartition(-scores, ids_per_batch - 1, axis=1)[:, :ids_per_batch]
+
+    def _grouped_order(self):
+        """
+        :return: image indices grouped by identity in ascending id order,
+                 randomly ordered inside every identity
+        """
+        keys = self._rng.random_sample(len(self._ids))
+        if not self.cam_balanced:
+            return np.lexsort((keys, self._inverse))
+
+        # rank of every image inside its (identity, camera) group; ordering by
+        # rank first visits the cameras of an identity round robin
+        order = np.lexsort((keys, self._cams, self._inverse))
+        inverse, cams = self._inverse[order], self._cams[order]
+        new_group = np.ones(len(order), dtype=bool)
+        new_group[1:] = (inverse[1:] != inverse[:-1]) | (cams[1:] != cams[:-1])
+        positions = np.arange(len(order))
+        group_starts = np.maximum.accumulate(np.where(new_group, positions, 0))
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = positions - group_starts
+        return np.lexsort((keys, rank, self._inverse))
+
+
+class HardIdentityBatchSampler(BatchSampler):
+    """
+    P x K sampler whose batches gather identities the model currently confuses.
+    A running centroid per identity is kept from the training features passed
+    to `update`. When an epoch starts, the centroids are compared in a random
+    projection (approximate kNN) and `hard_ratio` of the batches are grown
+    greedily from a random seed identity and its nearest unused neighbours; the
+    remaining identities are batched at random, so every identity is still
+    visited once per epoch. Until features arrive it behaves like BatchSampler.
+
+    Args:
+        ids: training label (0..C-1) of every image, shape [N]
+        ids_per_batch, ims_per_id, cams, drop_last, seed: as in `BatchSampler`
+        cam_balanced: spread the K images of an identity over its cameras, so
+            the positives of a batch are cross camera as well
+        hard_ratio: fraction of the batches built from confusable identities
+        momentum: weight of the previous centroid in the running average
+        proj_dim: dimension of the random projection searched for neighbours
+        num_neighbors: neighbours kept per identity, 2 * ids_per_batch by default
+    """
+
+    def __init__(self, ids, ids_per_batch, ims_per_id, cams=None, cam_balanced=True,
+                 hard_ratio=0.5, momentum=0.5, proj_dim=64, num_neighbors=None,
+                 drop_last=False, seed=None):
+        super(HardIdentityBatchSampler, self).__init__(
+            ids, ids_per_batch, ims_per_id, cams=cams, cam_balanced=cam_balanced,
+            drop_last=drop_last, seed=seed)
+
+        num_ids = len(self._unique_ids)
+        assert (self._unique_ids == np.arange(num_ids)).all(), \
+            'hard identity mining needs training labels 0..C-1'
+        self.hard_ratio = hard_ratio
+        self.momentum = momentum
+        self.proj_dim = proj_dim
+        self.num_neighbors = num_neighbors or 2 * ids_per_batch
+
+        # unit length running centroids, [C, D] once the first epoch is folded
+        self._centroids = None
+        self._seen = np.zeros(num_ids, dtype=bool)
+        self._proj = None
+        # feature sums of the running epoch, kept on the device of the features
+        self._feat_sums = None
+        self._feat_counts = None
+
+    def update(self, labels, feats):
+        """
+        Accumulate the features of a training batch. Nothing is copied to the
+        host here; the sums are folded into the centroids when the next epoch
+        starts.
+        :param labels: training labels of the batch, shape [B]
+        :param feats: features of the batch, shape [B, D]
+        """
+        feats = feats.detach().float()
+        feats = feats / feats.norm(p=2, dim=1, keepdim=True).clamp(min=1e-12)
+        if self._feat_sums is None:
+            self._feat_sums = feats.new_zeros((len(self._unique_ids), feats.size(1)))
+            self._feat_counts = feats.new_zeros(len(self._unique_ids))
+        labels = labels.to(feats.device).long()
+        self._feat_sums.index_add_(0, labels, feats)
+        self._feat_counts.index_add_(0, labels, feats.new_ones(labels.size(0)))
+
+    def __iter__(self):
+        self._fold()
+        return super(HardIdentityBatchSampler, self).__iter__()
+
+    def _fold(self):
+        """
+        Move the feature sums of the last epoch into the centroid bank
+        """
+        if self._feat_sums is None:
+            return
+        sums = self._feat_sums.cpu().numpy()
+        counts = self._feat_counts.cpu().numpy()
+        self._feat_sums.zero_()
+        self._feat_counts.zero_()
+
+        seen = counts > 0
+        if self._centroids is None:
+            self._centroids = np.zeros(sums.shape, dtype=np.float32)
+        means = sums[seen] / counts[seen][:, None]
+        old = self._seen[seen]
+        means[old] = self.momentum * self._centroids[seen][old] + (1 - self.momentum) * means[old]
+        means /= np.maximum(np.linalg.norm(means, axis=1, keepdims=True), 1e-12)
+        self._centroids[seen] = means
+        self._seen |= seen
+
+    def _neighbors(self, chunk=1024):
+        """
+        :return: [C, num_neighbors] identities of every identity, the most
+                 similar centroid first, found in a random projection of the
+                 centroids; entries may be unseen identities when too few
+                 identities have a centroid
+        """
+        if self._proj is None:
+            self._proj = (self._rng.randn(self._centroids.shape[1], self.proj_dim) /
+                          np.sqrt(self.proj_dim)).astype(np.float32)
+        codes = self._centroids.dot(self._proj)
+        num_ids = len(codes)
+        k = min(self.num_neighbors, num_ids - 1)
+
+        neighbors = np.empty((num_ids, k), dtype=np.int64)
+        for start in range(0, num_ids, chunk):
+            sim = codes[start:start + chunk].dot(codes.T)
+            rows = np.arange(len(sim))
+            sim[:, ~self._seen] = -np.inf
+            sim[rows, start + rows] = -np.inf
+            top = np.argpartition(-sim, k - 1, axis=1)[:, :k]
+            top_sim = sim[rows[:, None], top]
+            neighbors[start:start + len(sim)] = top[rows[:, None], np.argsort(-top_sim, axis=1)]
+        return neighbors
+
+    def _id_batches(self):
+        num_ids = len(self._unique_ids)
+        num_hard = int(round(self.hard_ratio * len(self)))
+        if self._centroids is None or num_hard == 0 or num_ids <= self.ids_per_batch:
+            return super(HardIdentityBatchSampler, self)._id_batches()
+
+        neighbors = self._neighbors()
+        used = np.zeros(num_ids, dtype=bool)
+        batches = []
+        for seed in self._rng.permutation(np.flatnonzero(self._seen)):
+            if len(batches) == num_hard:
+                break
+            if used[seed]:
+                continue
+            cands = neighbors[seed]
+            cands = cands[self._seen[cands] & ~used[cands]][:self.ids_per_batch - 1]
+            batch = np.concatenate(([seed], cands))
+            used[batch] = True
+            if len(batch) < self.ids_per_batch:
+                # not enough confusable identities left, top up at random
+                extra = self._rng.permutation(np.flatnonzero(~used))[:self.ids_per_batch - len(batch)]
+                batch = np.concatenate((batch, extra))
+                used[extra] = True
+            batches.append(batch)
+
+        rest = self._rng.permutation(np.flatnonzero(~used))
+        batches += [rest[i:i + self.ids_per_batch] for i in range(0, len(rest), self.ids_per_batch)]
+        if self.drop_last and len(batches[-1]) < self.ids_per_batch:
+            batches.pop()
+        self._rng.shuffle(batches)
+        return batches
+
+
+class DistributedBatchSampler(sampler.Sampler):
+    """
+    The share of one rank of the global P x K batches of `batch_sampler`.
+    Every global batch is cut between identities, so each rank gets
+    P / num_replicas whole identities with all their K images, and the
+    features gathered from the ranks are the global batch again. The
+    wrapped sampler must be seeded the same on all ranks (e.g. with the
+    `shared_seed()` of the distributed helpers), and a
+    `HardIdentityBatchSampler` must be fed the gathered labels and
+    features, so that all ranks draw the same batches.
+
+    Args:
+        batch_sampler: a `BatchSampler` whose ids_per_batch is the global P,
+            a multiple of num_replicas
+        num_replicas: number of ranks
+        rank: rank of this process
+    """
+
+    def __init__(self, batch_sampler, num_replicas, rank):
+        assert batch_sampler.ids_per_batch % num_replicas == 0, \
+            '{} identities per batch can not be split over {} ranks'.format(
+                batch_sampler.ids_per_batch, num_replicas)
+        # every rank needs the same number of images in every batch
+        assert batch_sampler.full_batches, \
+            'the distributed sampler needs drop_last'
+        self.batch_sampler = batch_sampler
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.ims_per_rank = batch_sampler.ids_per_batch // num_replicas * batch_sampler.ims_per_id
+
+    def __iter__(self):
+        start = self.rank * self.ims_per_rank
+        for batch in self.batch_sampler:
+            yield batch[start:start + self.ims_per_rank]
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def update(self, labels, feats):
+        """Feed the wrapped `HardIdentityBatchSampler`, see its `update`."""
+        self.batch_sampler.update(labels, feats)